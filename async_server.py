@@ -0,0 +1,200 @@
+# async_server.py
+"""
+Engine asyncio cho ChatServer.
+
+Mọi kết nối chạy trên một event loop duy nhất bằng asyncio streams thay vì
+mỗi socket một thread. Giao thức (JSON Lines hoặc msgpack) và các bước register/login/
+chat/dm/presence/quit dùng lại y nguyên logic của ChatServer.
+"""
+import asyncio
+import threading
+
+from chat_server import ChatServer
+from framing import MAX_LINE, StreamPacketReader, next_packet
+from outbound import DEFAULT_LIMIT, DROP_OLDEST, OutboundConnection, set_nodelay
+
+
+# Độ dài tối đa một dòng JSON mà StreamReader chấp nhận
+STREAM_LIMIT = MAX_LINE
+
+# gói có thể chặn (gọi bus đồng bộ tới hub, đọc message log trên đĩa): xử
+# lý trong thread pool thay vì trên event loop, để một lượt gọi bus chậm
+# (tới CALL_TIMEOUT giây) không làm đứng mọi kết nối của worker. "stats"
+# cũng vậy: gauge messages.last_id của RemoteLog là một lượt gọi hub
+EXECUTOR_PACKETS = frozenset({"join", "history", "search", "stats"})
+
+
+class StreamConnection(OutboundConnection):
+    """
+    Bọc StreamWriter để có cùng giao diện với socket (sendall/close),
+    nhờ đó broadcast/send_dm/send_presence của ChatServer dùng được ngay.
+
+    sendall() chỉ đưa frame vào OutboundQueue; một task writer riêng rút
+    hàng đợi theo lô (tối đa write_budget byte), ghi mỗi lô bằng một lệnh
+    writelines() và chờ drain() khi buffer đầy.
+    """
+
+    def __init__(self, writer, loop, maxsize=DEFAULT_LIMIT, policy=DROP_OLDEST, metrics=None, **options):
+        super().__init__(maxsize, policy, metrics, **options)
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.task = loop.create_task(self._write_loop())
+
+    def close(self):
+        self.queue.close()
+        self._wakeup()
+
+    def abort(self):
+        self.queue.abort()
+        self._call(self.writer.transport.abort)
+
+    def join(self, timeout=None):
+        # writer là task trên event loop, không có thread để chờ
+        pass
+
+    def getpeername(self):
+        return self.writer.get_extra_info("peername")
+
+    def _wakeup(self):
+        self._call(self.ready.set)
+
+    def _call(self, fn):
+        # frame có thể được đẩy từ thread khác loop (vd. timer, executor)
+        if threading.get_ident() == self.loop_thread:
+            fn()
+        else:
+            self.loop.call_soon_threadsafe(fn)
+
+    async def _write_loop(self):
+        try:
+            while True:
+                batch = self.queue.take(self.write_budget)
+                if batch is None:
+                    if self.queue.closed:
+                        break
+                    self.ready.clear()
+                    await self.ready.wait()
+                    if self.flush_window > 0 and self.queue.pending_bytes < self.write_budget:
+                        # chờ gom thêm frame tới cùng lần ghi
+                        await asyncio.sleep(self.flush_window)
+                    continue
+                # một lô một lần ghi: transport gửi ngay bằng một send (Python
+                # 3.12+ dùng sendmsg) hoặc nối vào buffer nếu đang có dữ liệu
+                # chờ, nên không biết số syscall thật: ghi nhận là None
+                frames, first_at = batch
+                self.writer.writelines(frames)
+                self.queue.record_write(len(frames), None, first_at)
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.queue.abort()
+        finally:
+            self.writer.close()
+
+
+class AsyncChatServer(ChatServer):
+    """ChatServer chạy trên asyncio: một event loop giữ mọi kết nối."""
+
+    def __init__(self, host="127.0.0.1", port=5555, **options):
+        super().__init__(host, port, **options)
+        self.loop = None
+
+    # =====================================================
+    # START / SHUTDOWN
+    # =====================================================
+    def start(self):
+        asyncio.run(self.serve())
+
+    def call_later(self, delay, fn):
+        """Hẹn giờ trên event loop (an toàn khi gọi từ thread khác)."""
+        if self.loop is None:
+            return super().call_later(delay, fn)
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, fn)
+
+    async def serve(self):
+        self.server.bind((self.host, self.port))
+        self.server.listen()
+        self.server.setblocking(False)
+        self.loop = asyncio.get_running_loop()
+        print(f"[SERVER] Chạy trên {self.host}:{self.port} (asyncio)")
+
+        srv = await asyncio.start_server(
+            self.handle_client_async, sock=self.server, limit=STREAM_LIMIT
+        )
+        async with srv:
+            await srv.serve_forever()
+
+    # =====================================================
+    # HANDLE CLIENT
+    # =====================================================
+    async def handle_client_async(self, reader, writer):
+        # asyncio tự bật TCP_NODELAY; đặt lại theo tuỳ chọn của server
+        set_nodelay(writer.get_extra_info("socket"), self.nodelay)
+        conn = StreamConnection(
+            writer,
+            self.loop,
+            self.outbound_limit,
+            self.overflow_policy,
+            self.metrics,
+            **self.write_options,
+        )
+        print(f"[NEW] {conn.getpeername()} đã kết nối")
+        packets = StreamPacketReader(reader)
+        username = None
+        try:
+            first = await next_packet(packets)
+            if not first:
+                return
+
+            # -------- RESUME (nối lại phiên vừa rớt, không chặn loop) --------
+            if first.get("type") == "resume":
+                username = self.resume_step(conn, first)
+                if not username:
+                    first = await next_packet(packets)
+                    if not first:
+                        return
+
+            if not username:
+                # -------- REGISTER (nếu có) --------
+                if first.get("type") == "register":
+                    # băm bcrypt + chờ fsync user store: chạy ngoài event loop
+                    ok = await self.loop.run_in_executor(
+                        None, self.register_step, conn, first
+                    )
+                    if not ok:
+                        return
+                    first = await next_packet(packets)
+                    if not first:
+                        return
+
+                # -------- LOGIN --------
+                # bcrypt chạy trong process pool; chờ kết quả ngoài event loop
+                username = await self.loop.run_in_executor(
+                    None, self.login_step, conn, first
+                )
+                if not username:
+                    return
+                # vào phòng mặc định + trang history đầu: có thể đọc đĩa/bus
+                await self.loop.run_in_executor(
+                    None, self.join_session, conn, username
+                )
+            packets.set_codec(conn.codec)
+
+            # -------- Vòng lặp nhận tin --------
+            # chờ xong từng gói rồi mới đọc gói sau: giữ thứ tự trong kết nối
+            async for packet in packets:
+                if packet.get("type") in EXECUTOR_PACKETS:
+                    ok = await self.loop.run_in_executor(
+                        None, self.handle_packet, conn, username, packet
+                    )
+                else:
+                    ok = self.handle_packet(conn, username, packet)
+                if not ok:
+                    break
+
+        except Exception as e:
+            print(f"[ERROR] {e}")
+
+        finally:
+            self.leave_session(conn, username)
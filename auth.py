@@ -0,0 +1,121 @@
+# auth.py
+"""
+Băm và kiểm tra mật khẩu bằng bcrypt trong process pool.
+
+Mỗi lần bcrypt tốn khoảng 100-300 ms CPU. Chạy trong ProcessPoolExecutor
+để tận dụng nhiều core, không giữ GIL của server và không bao giờ chạy
+trong self.lock. Số yêu cầu đang chờ/đang chạy bị giới hạn (admission):
+vượt giới hạn thì từ chối ngay bằng HasherBusy thay vì xếp hàng vô hạn.
+
+Mật khẩu plaintext cũ trong users.json vẫn đăng nhập được; server băm lại
+(rehash) ở lần đăng nhập thành công đầu tiên.
+"""
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+DEFAULT_MAX_PENDING = 64
+MAX_PASSWORD_BYTES = 72  # giới hạn của bcrypt
+START_METHODS = multiprocessing.get_all_start_methods()
+
+
+class HasherBusy(Exception):
+    """Pool đã đủ số yêu cầu cho phép, người gọi nên thử lại sau."""
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.startswith(("$2a$", "$2b$", "$2y$"))
+
+
+# ----- chạy trong process con -----
+def _hash_job(password, rounds, submitted):
+    started = time.time()
+    hashed = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds))
+    return hashed.decode("ascii"), started - submitted, time.time() - started
+
+
+def _verify_job(password, stored, submitted):
+    started = time.time()
+    try:
+        ok = bcrypt.checkpw(password.encode("utf-8"), stored.encode("ascii"))
+    except ValueError:
+        ok = False
+    return ok, started - submitted, time.time() - started
+
+
+class PasswordHasher:
+    def __init__(
+        self,
+        workers=None,
+        max_pending=DEFAULT_MAX_PENDING,
+        rounds=DEFAULT_ROUNDS,
+        metrics=None,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.rounds = rounds
+        self.metrics = metrics
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        # tạo pool khi cần: công cụ/benchmark dựng ChatServer không tốn process
+        with self._pool_lock:
+            if self._pool is None:
+                # không fork thẳng từ server: process con sẽ giữ bản sao mọi
+                # socket đang mở (listen, client, bus), node chết mà kết
+                # nối của nó vẫn chưa đóng
+                method = "forkserver" if "forkserver" in START_METHODS else "spawn"
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(method),
+                )
+            return self._pool
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            self._count("auth.rejected")
+            raise HasherBusy()
+        try:
+            result, queued, spent = self._executor().submit(
+                fn, *args, time.time()
+            ).result()
+        finally:
+            self._slots.release()
+        if self.metrics is not None:
+            self.metrics.observe("auth.queue_s", max(queued, 0.0))
+            self.metrics.observe("auth.hash_s", spent)
+        return result
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+    def hash(self, password):
+        """Băm mật khẩu (chặn thread gọi tới khi xong)."""
+        return self._run(_hash_job, password, self.rounds)
+
+    def verify(self, password, stored):
+        """So khớp mật khẩu với giá trị đã lưu (bcrypt hoặc plaintext cũ)."""
+        if not is_hashed(stored):
+            # plaintext cũ: so sánh hằng thời gian, không cần pool
+            self._count("auth.legacy_verify")
+            return hmac.compare_digest(
+                password.encode("utf-8"), str(stored).encode("utf-8")
+            )
+        return self._run(_verify_job, password, stored)
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                # chờ manager thread của pool thoát hẳn: với wait=False, hook
+                # atexit của concurrent.futures (3.11) có thể ghi vào pipe
+                # đã đóng và in "Bad file descriptor" khi tắt server
+                self._pool.shutdown(wait=True, cancel_futures=True)
+                self._pool = None
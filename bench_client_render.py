@@ -0,0 +1,122 @@
+# bench_client_render.py
+"""
+Đo độ mượt của client Tkinter khi nhận một loạt tin dồn dập.
+
+Một thread giả làm server (không có mạng) đẩy --messages gói chat vào
+ChatClient của ChatClientApp (dispatch, như khi gói đến từ socket) theo
+từng đợt --burst gói, cách nhau --gap giây. Trên main
+thread, một timer hẹn mỗi FRAME_MS; khoảng cách thực giữa hai lần chạy cho
+biết UI bị đứng bao lâu:
+- max_stall_ms:   lần đứng lâu nhất,
+- dropped_frames: số khung FRAME_MS bị lỡ,
+- drain_s:        thời gian tới khi mọi tin đã hiện trong khung chat.
+
+So sánh --render-interval 0 (mỗi gói một root.after, cách cũ) với hàng đợi
+render của client (RENDER_INTERVAL_MS). Cần màn hình (hoặc Xvfb).
+
+Ví dụ:
+    python bench_client_render.py
+    python bench_client_render.py --messages 20000 --burst 500 --json
+"""
+import argparse
+import json
+import threading
+import time
+
+from chat_client import RENDER_INTERVAL_MS, ChatClientApp
+from rooms import DEFAULT_ROOM
+
+FRAME_MS = 16
+TIMEOUT = 300.0  # giây
+
+
+def run(render_interval, messages, burst, gap):
+    app = ChatClientApp()
+    app.username = "bench"
+    app.render_interval = render_interval
+
+    def packets():
+        for i in range(messages):
+            if i and i % burst == 0:
+                time.sleep(gap)
+            yield {
+                "type": "chat",
+                "from": f"user{i % 50}",
+                "text": f"tin nhắn thử số {i} trong một đợt tin dồn dập",
+                "ts": "12:00:00",
+                "room": DEFAULT_ROOM,
+                "id": i + 1,
+            }
+
+    beats = []
+    result = {}
+    start = time.perf_counter()
+
+    def beat():
+        now = time.perf_counter()
+        beats.append(now)
+        # dòng "Đăng nhập thành công" + mỗi tin một dòng (kể cả phần đã
+        # cắt sang scrollback)
+        lines = app.line_count() - 1 + app.scrollback.lines
+        if lines >= messages + 1 or now - start > TIMEOUT:
+            result["drain_s"] = now - start
+            app.root.quit()
+            return
+        app.root.after(FRAME_MS, beat)
+
+    def feed():
+        for packet in packets():
+            app.client.dispatch(packet)
+
+    app.build_chat_ui()
+    threading.Thread(target=feed, daemon=True).start()
+    app.root.after(FRAME_MS, beat)
+    app.root.mainloop()
+
+    app.closing = True
+    app.root.destroy()
+
+    gaps = [(b - a) * 1000 for a, b in zip(beats, beats[1:])]
+    return {
+        "render_interval_ms": render_interval,
+        "messages": messages,
+        "drain_s": round(result["drain_s"], 3),
+        "max_stall_ms": round(max(gaps, default=0.0), 1),
+        "dropped_frames": sum(max(0, int(g // FRAME_MS) - 1) for g in gaps),
+        "max_tick_ms": round(app.render_stats["max_tick_ms"], 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--burst", type=int, default=1000, help="số gói mỗi đợt")
+    parser.add_argument("--gap", type=float, default=0.05, help="giây giữa hai đợt")
+    parser.add_argument(
+        "--render-interval",
+        type=int,
+        nargs="+",
+        default=[0, RENDER_INTERVAL_MS],
+        help="ms giữa hai nhịp render (0 = mỗi gói một root.after)",
+    )
+    parser.add_argument("--json", action="store_true", help="in kết quả dạng JSON")
+    args = parser.parse_args(argv)
+
+    results = [
+        run(interval, args.messages, args.burst, args.gap)
+        for interval in args.render_interval
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'render_ms':>9} {'drain_s':>8} {'max_stall_ms':>12} "
+          f"{'dropped':>8} {'max_tick_ms':>11}")
+    for r in results:
+        print(f"{r['render_interval_ms']:>9} {r['drain_s']:>8} "
+              f"{r['max_stall_ms']:>12} {r['dropped_frames']:>8} "
+              f"{r['max_tick_ms']:>11}")
+
+
+if __name__ == "__main__":
+    main()
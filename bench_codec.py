@@ -0,0 +1,121 @@
+# bench_codec.py
+"""
+So sánh các codec trên dây (xem codec.py) theo từng loại gói:
+- json:        JSON Lines (mặc định),
+- msgpack:     frame nhị phân dùng thư viện msgpack (C), nếu đã cài,
+- msgpack-py:  frame nhị phân dùng bản MessagePack pure-Python dự phòng,
+- +deflate:    frame msgpack có nén deflate (ngưỡng --compress-threshold).
+
+Với mỗi loại gói in số byte trên dây (kể cả '\\n' / header độ dài) và thời
+gian encode/decode trung bình mỗi gói (micro giây). Dùng cột bytes/enc_us
+của "+deflate" để chọn --compress-threshold cho server.
+
+Ví dụ:
+    python bench_codec.py
+    python bench_codec.py --repeat 50000
+"""
+import argparse
+import time
+
+from codec import (
+    DEFAULT_COMPRESS_THRESHOLD,
+    FRAME_HEADER,
+    JSON_CODEC,
+    MSGPACK_CODEC,
+    Deflate,
+    MsgpackCodec,
+    split_header,
+)
+
+
+def sample_packets(online):
+    users = [f"người_dùng_{i}" for i in range(online)]
+    return {
+        "chat": {
+            "type": "chat",
+            "from": "người_gửi",
+            "text": "Xin chào cả phòng, hôm nay họp lúc 3 giờ chiều nhé!",
+            "ts": "12:34:56",
+        },
+        "dm": {
+            "type": "dm",
+            "from": "alice",
+            "to": "bob",
+            "text": "Tối nay đi ăn phở không?",
+            "ts": "12:34:56",
+        },
+        "paste": {
+            "type": "chat",
+            "from": "người_gửi",
+            "text": "\n".join(
+                f"Dòng {i}: báo cáo doanh thu quý {i % 4 + 1} đã được cập nhật."
+                for i in range(60)
+            ),
+            "ts": "12:34:56",
+        },
+        "system": {"type": "system", "text": "alice đã tham gia phòng chat!"},
+        "login_result": {
+            "type": "login_result",
+            "ok": True,
+            "message": "Đăng nhập thành công",
+        },
+        "presence": {"type": "presence", "users": users, "version": 1234},
+        "presence_join": {"type": "presence_join", "users": ["alice"], "version": 1235},
+    }
+
+
+def strip_frame(codec, data):
+    """Bỏ '\\n' hoặc header để decode giống FrameReader."""
+    if codec.binary:
+        _, compressed = split_header(FRAME_HEADER.unpack_from(data)[0])
+        return (memoryview(data)[FRAME_HEADER.size:], compressed)
+    return (data[:-1],)
+
+
+def measure(codec, packet, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        data = codec.encode(packet)
+    encode_s = time.perf_counter() - t0
+
+    frame = strip_frame(codec, data)
+    assert codec.decode(*frame) == packet
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        codec.decode(*frame)
+    decode_s = time.perf_counter() - t0
+    return len(data), encode_s / repeat * 1e6, decode_s / repeat * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark codec trên dây")
+    parser.add_argument("--repeat", type=int, default=20000)
+    parser.add_argument(
+        "--online", type=int, default=200, help="số user trong gói presence"
+    )
+    parser.add_argument(
+        "--compress-threshold", type=int, default=DEFAULT_COMPRESS_THRESHOLD
+    )
+    args = parser.parse_args(argv)
+
+    codecs = [("json", JSON_CODEC)]
+    if MSGPACK_CODEC.native:
+        codecs.append(("msgpack", MSGPACK_CODEC))
+    else:
+        print("(chưa cài msgpack: bỏ qua codec C)")
+    codecs.append(("msgpack-py", MsgpackCodec(native=False)))
+    codecs.append(
+        ("+deflate", MsgpackCodec(compression=Deflate(args.compress_threshold)))
+    )
+
+    print(f"{'packet':<14} {'codec':<11} {'bytes':>7} {'enc_us':>8} {'dec_us':>8}")
+    for name, packet in sample_packets(args.online).items():
+        # gói presence lớn: chạy ít vòng hơn
+        repeat = args.repeat if name != "presence" else max(1, args.repeat // 50)
+        for cname, codec in codecs:
+            size, enc, dec = measure(codec, packet, repeat)
+            print(f"{name:<14} {cname:<11} {size:>7} {enc:>8.2f} {dec:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# bench_engines.py
+"""
+So sánh engine "thread" và "asyncio" của ChatServer:
+- số kết nối đồng thời server giữ được,
+- bộ nhớ (RSS) và số thread của tiến trình server.
+
+Server được chạy trong thư mục tạm (users.json riêng) nên không đụng tới
+dữ liệu thật. Số liệu RSS/thread đọc từ /proc nên chỉ chạy trên Linux.
+
+Ví dụ:
+    python bench_engines.py --connections 2000
+    python bench_engines.py --engines asyncio --connections 5000 --login
+"""
+import argparse
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = Path(__file__).resolve().parent
+
+
+def raise_nofile_limit():
+    """Nâng giới hạn file descriptor lên mức tối đa cho phép."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def proc_status(pid):
+    """Đọc VmRSS (KB) và số thread của tiến trình từ /proc."""
+    rss_kb, threads = 0, 0
+    for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+        elif line.startswith("Threads:"):
+            threads = int(line.split()[1])
+    return rss_kb, threads
+
+
+def wait_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server không lắng nghe trên cổng {port}")
+
+
+async def drain(reader):
+    """Đọc bỏ mọi dữ liệu server gửi để server không bị nghẽn khi ghi."""
+    try:
+        while await reader.read(65536):
+            pass
+    except Exception:
+        pass
+
+
+async def open_clients(port, n, login):
+    conns, tasks = [], []
+    for i in range(n):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError as e:
+            print(f"  dừng ở {i} kết nối: {e}")
+            break
+        if login:
+            pkt = {"type": "login", "username": f"bench{i}", "password": "x"}
+            writer.write((json.dumps(pkt) + "\n").encode("utf-8"))
+        conns.append(writer)
+        tasks.append(asyncio.ensure_future(drain(reader)))
+    return conns, tasks
+
+
+async def run_engine(engine, n, login, settle):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        if login:
+            users = {f"bench{i}": "x" for i in range(n)}
+            Path(tmp, "users.json").write_text(json.dumps(users), encoding="utf-8")
+
+        proc = subprocess.Popen(
+            [sys.executable, str(HERE / "chat_server.py"),
+             "--engine", engine, "--port", str(port)],
+            cwd=tmp,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_port(port)
+            time.sleep(0.3)
+            base_rss, base_threads = proc_status(proc.pid)
+
+            t0 = time.perf_counter()
+            conns, tasks = await open_clients(port, n, login)
+            elapsed = time.perf_counter() - t0
+            await asyncio.sleep(settle)
+
+            alive = proc.poll() is None
+            rss, threads = proc_status(proc.pid) if alive else (0, 0)
+            held = len(conns) if alive else 0
+
+            for w in conns:
+                w.close()
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            proc.kill()
+            proc.wait()
+
+    return {
+        "engine": engine,
+        "connections": held,
+        "connect_s": round(elapsed, 3),
+        "rss_mb": round(rss / 1024, 1),
+        "rss_kb_per_conn": round((rss - base_rss) / max(held, 1), 1),
+        "threads": threads,
+        "base_threads": base_threads,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument(
+        "--engines", nargs="+", default=["thread", "asyncio"],
+        choices=("thread", "asyncio"),
+    )
+    parser.add_argument(
+        "--login", action="store_true",
+        help="đăng nhập mỗi kết nối (kèm presence O(N^2), chậm với N lớn)",
+    )
+    parser.add_argument("--settle", type=float, default=1.0)
+    parser.add_argument("--json", action="store_true", help="in kết quả dạng JSON")
+    args = parser.parse_args(argv)
+
+    raise_nofile_limit()
+    results = [
+        asyncio.run(run_engine(e, args.connections, args.login, args.settle))
+        for e in args.engines
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'engine':<8} {'conns':>6} {'connect_s':>10} {'rss_mb':>8} "
+          f"{'kb/conn':>8} {'threads':>8}")
+    for r in results:
+        print(f"{r['engine']:<8} {r['connections']:>6} {r['connect_s']:>10} "
+              f"{r['rss_mb']:>8} {r['rss_kb_per_conn']:>8} {r['threads']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# bench_fanout.py
+"""
+Micro-benchmark chi phí CPU của một lần broadcast theo số người nhận.
+
+So sánh:
+- per_recipient: json.dumps + encode cho từng người nhận (cách cũ),
+- encode_once:   mã hoá một lần, gửi chung frame cho mọi client
+                 (ChatServer.broadcast không có room),
+- room:          broadcast trong một phòng --room-size người (mọi client
+                 được chia vào các phòng cỡ đó): chi phí theo kích thước
+                 phòng, không theo số client của server.
+
+Socket được thay bằng đối tượng giả có sendall() rỗng để chỉ đo phần
+tuần tự hoá/fan-out, không đo syscall.
+
+Ví dụ:
+    python bench_fanout.py
+    python bench_fanout.py --recipients 100 1000 10000 --repeat 20
+    python bench_fanout.py --recipients 1000 10000 100000 --room-size 50
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from chat_server import ChatServer, encode_packet, send_frame
+from codec import JSON_CODEC
+
+
+class NullSocket:
+    """Socket giả: nhận frame và bỏ đi."""
+
+    codec = JSON_CODEC
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_server(n, room_size):
+    # users.json mẫu được tạo trong thư mục tạm hiện hành (xem main)
+    server = ChatServer(message_log_dir=None, search=False)
+    for i in range(n):
+        sock = NullSocket()
+        server.clients[sock] = f"user{i}"
+        server.user_sockets[f"user{i}"] = sock
+        server.rooms.join(f"room{i // room_size}", f"user{i}", sock)
+    return server
+
+
+def per_recipient(server, message):
+    with server.lock:
+        targets = list(server.clients.items())
+    for sock, _ in targets:
+        data = (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+        send_frame(sock, data)
+
+
+def encode_once(server, message):
+    server.broadcast(message)
+
+
+def room(server, message):
+    server.broadcast(message, room="room0")
+
+
+def measure(fn, server, message, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.process_time()
+        fn(server, message)
+        best = min(best, time.process_time() - t0)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark fan-out broadcast")
+    parser.add_argument(
+        "--recipients", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument(
+        "--room-size", type=int, default=50, help="số người mỗi phòng (cột room)"
+    )
+    args = parser.parse_args(argv)
+
+    message = {
+        "type": "chat",
+        "from": "người_gửi",
+        "text": "Xin chào cả phòng, hôm nay họp lúc 3 giờ chiều nhé!",
+        "ts": "12:34:56",
+    }
+    os.chdir(tempfile.mkdtemp())
+    print(f"frame = {len(encode_packet(message))} bytes, best of {args.repeat}, "
+          f"room = {args.room_size} người")
+    print(f"{'recipients':>10} {'per_recipient_ms':>17} {'encode_once_ms':>15} "
+          f"{'speedup':>8} {'room_ms':>8}")
+    for n in args.recipients:
+        server = make_server(n, args.room_size)
+        old = measure(per_recipient, server, message, args.repeat)
+        new = measure(encode_once, server, message, args.repeat)
+        scoped = measure(room, server, message, args.repeat)
+        print(f"{n:>10} {old * 1000:>17.3f} {new * 1000:>15.3f} "
+              f"{old / max(new, 1e-9):>7.1f}x {scoped * 1000:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# bench_framing.py
+"""
+So sánh reader JSON Lines cũ (makefile + decode + strip + json.loads(str))
+với framing.FrameReader (recv_into + split theo lô, parse từ bytes).
+
+Một thread ghi sẵn N gói vào socketpair, thread chính đọc và parse hết.
+Đo thông lượng (gói/s, MB/s) và cấp phát bộ nhớ (tracemalloc: số block
+và đỉnh bộ nhớ trong lúc đọc).
+
+Ví dụ:
+    python bench_framing.py
+    python bench_framing.py --packets 200000 --text-size 200
+"""
+import argparse
+import json
+import socket
+import threading
+import time
+import tracemalloc
+
+from framing import FrameReader
+
+
+def legacy_reader(sock):
+    """Bản sao iter_json_lines cũ của server/client."""
+    with sock.makefile("r", encoding="utf-8", newline="\n") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                yield {"type": "system", "text": f"JSON không hợp lệ: {line[:50]}..."}
+
+
+def make_payload(packets, text_size):
+    line = (
+        json.dumps(
+            {"type": "chat", "from": "người_gửi", "text": "ă" * text_size, "ts": "12:00:00"},
+            ensure_ascii=False,
+        )
+        + "\n"
+    ).encode("utf-8")
+    return line * packets
+
+
+def run(reader_factory, payload, trace):
+    a, b = socket.socketpair()
+
+    def writer():
+        a.sendall(payload)
+        a.close()
+
+    t = threading.Thread(target=writer)
+    if trace:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    t.start()
+    count = sum(1 for _ in reader_factory(b))
+    elapsed = time.perf_counter() - t0
+    blocks = peak = 0
+    if trace:
+        snapshot = tracemalloc.take_snapshot()
+        blocks = sum(s.count for s in snapshot.statistics("filename"))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    t.join()
+    b.close()
+    return count, elapsed, blocks, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark framing reader")
+    parser.add_argument("--packets", type=int, default=100_000)
+    parser.add_argument("--text-size", type=int, default=80)
+    args = parser.parse_args(argv)
+
+    payload = make_payload(args.packets, args.text_size)
+    mb = len(payload) / 1e6
+    print(f"{args.packets} gói, {mb:.1f} MB")
+    print(f"{'reader':<12} {'pkts/s':>10} {'MB/s':>8} {'peak_kb':>9}")
+    for name, factory in (("makefile", legacy_reader), ("FrameReader", FrameReader)):
+        count, elapsed, _, _ = run(factory, payload, trace=False)
+        assert count == args.packets, (name, count)
+        _, _, _, peak = run(factory, payload, trace=True)
+        print(f"{name:<12} {count / elapsed:>10.0f} {mb / elapsed:>8.1f} "
+              f"{peak / 1024:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
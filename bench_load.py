@@ -0,0 +1,471 @@
+# bench_load.py
+"""
+Tạo tải và đo độ trễ ChatServer trước khi phát hành.
+
+Server chạy cục bộ (thư mục tạm, tài khoản riêng). --clients client kịch bản
+(chat_sdk.ChatClient) được chia cho --generators tiến trình tạo tải. Mỗi
+client đăng nhập, vào phòng của mình (--room-size người mỗi phòng) rồi lặp:
+chờ ngẫu nhiên (trung bình --rate hành động/giây) và chọn một hành động
+theo --mix:
+    chat   tin vào phòng của mình (broadcast)
+    dm     tin riêng tới một client ngẫu nhiên
+    churn  rời phòng rồi vào lại (presence join/leave)
+Một tỉ lệ --slow-readers client đọc chậm: ngừng đọc socket SLOW_PAUSE giây
+mỗi chu kỳ, để hàng đợi gửi của server đầy và policy outbound phải xử lý.
+
+Mỗi tin mang thời điểm gửi (cùng máy nên cùng đồng hồ); người nhận tính độ
+trễ đầu-cuối cho từng lượt giao (fan-out), chỉ với client đọc bình thường.
+Kết quả mỗi engine:
+    msgs_per_s, deliveries_per_s   tin gửi / lượt giao tới client mỗi giây
+    p50_ms, p99_ms, p999_ms        độ trễ fan-out
+    handshake_p50_ms, _p99_ms      connect + login (bcrypt verify, pha khởi động)
+    rss_mb                         RSS server (cả worker) cuối pha đo
+    cpu_us_per_msg                 CPU server (user+sys) / số tin gửi
+    syscalls_per_frame             syscall ghi / frame gửi (gộp ghi, outbound.py;
+                                   chỉ engine thread, asyncio là None)
+    server                         bộ đếm từ gói stats của server
+Số liệu /proc nên chỉ chạy trên Linux. --output ghi JSON để lưu theo bản
+phát hành; --baseline so với một file cũ và trả mã lỗi 1 nếu có chỉ số tệ
+hơn quá --tolerance.
+
+Ví dụ:
+    python bench_load.py --clients 2000 --duration 20 --output load.json
+    python bench_load.py --mix chat=60,dm=30,churn=10 --slow-readers 0.05
+    python bench_load.py --engines asyncio --baseline load-0.2.0.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import bcrypt
+
+from auth import DEFAULT_MAX_PENDING
+from bench_engines import free_port, raise_nofile_limit, wait_port
+from bench_workers import percentile
+from chat_sdk import ChatClient
+from version import __version__
+
+HERE = Path(__file__).resolve().parent
+ACTIONS = ("chat", "dm", "churn")
+DEFAULT_MIX = "chat=80,dm=15,churn=5"
+# tổng số client bắt tay cùng lúc (chia đều cho các tiến trình tạo tải), dưới
+# giới hạn admission của auth để không bị từ chối "Server đang bận"
+HANDSHAKE_CONCURRENCY = DEFAULT_MAX_PENDING // 2
+BCRYPT_ROUNDS = 4
+GRACE = 2.0  # giây chờ các tin gửi cuối pha đo tới nơi
+SLOW_PAUSE = 0.5  # giây client đọc chậm ngừng đọc mỗi chu kỳ
+SLOW_READ = 0.05  # giây đọc lại giữa hai lần ngừng
+
+# chỉ số so với --baseline: True = càng cao càng tốt
+COMPARED = {
+    "msgs_per_s": True,
+    "deliveries_per_s": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "p999_ms": False,
+    "handshake_p99_ms": False,
+    "rss_mb": False,
+    "cpu_us_per_msg": False,
+    "syscalls_per_frame": False,
+}
+
+
+def parse_mix(text):
+    """"chat=80,dm=15,churn=5" -> {"chat": 80.0, ...}."""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f"hành động không hợp lệ: {name}")
+        try:
+            mix[name] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"trọng số không hợp lệ: {part}") from None
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("tổng trọng số phải lớn hơn 0")
+    return mix
+
+
+# =====================================================
+# TIẾN TRÌNH TẠO TẢI
+# =====================================================
+async def _slow_reader(client, stop_at):
+    while time.time() < stop_at and client.writer is not None:
+        transport = client.writer.transport
+        transport.pause_reading()
+        await asyncio.sleep(SLOW_PAUSE)
+        if client.writer is None:
+            break
+        transport.resume_reading()
+        await asyncio.sleep(SLOW_READ)
+
+
+async def _client(i, port, plan, start_at, stop_at, gate, stats):
+    username = f"bench{i}"
+    room = f"r{i // plan['room_size']}"
+    slow = i < plan["slow_clients"]
+    client = ChatClient(features=["presence_delta"], reconnect=False)
+    joined = asyncio.Event()
+
+    def on_message(packet):
+        sent, _, _ = packet.get("text", "").partition(" ")
+        try:
+            sent = float(sent)
+        except ValueError:
+            return
+        if not start_at <= sent < stop_at:
+            return
+        if slow:
+            stats["slow_deliveries"] += 1
+            return
+        stats["deliveries"] += 1
+        stats["latencies"].append(time.time() - sent)
+
+    client.on("chat", on_message)
+    client.on("dm", on_message)
+    client.on("room_joined", lambda p: joined.set())
+
+    async with gate:
+        began = time.perf_counter()
+        await client.start("127.0.0.1", port, username, "x")
+        stats["handshakes"].append(time.perf_counter() - began)
+        client.join(room)
+        await asyncio.wait_for(joined.wait(), 30)
+
+    rng = random.Random(i)
+    actions = list(plan["mix"])
+    weights = [plan["mix"][a] for a in actions]
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    if slow:
+        asyncio.ensure_future(_slow_reader(client, stop_at))
+    try:
+        while True:
+            await asyncio.sleep(rng.expovariate(plan["rate"]))
+            now = time.time()
+            if now >= stop_at or not client.connected:
+                break
+            action = rng.choices(actions, weights)[0]
+            if action == "chat":
+                client.chat(f"{now:.6f} {username}", room)
+                stats["sent"] += 1
+            elif action == "dm":
+                client.dm(f"bench{rng.randrange(plan['clients'])}", f"{now:.6f} {username}")
+                stats["sent"] += 1
+            else:
+                client.leave(room)
+                client.join(room)
+                stats["churn"] += 1
+        await asyncio.sleep(max(0.0, stop_at + GRACE - time.time()))
+        if not client.connected:
+            raise ConnectionError("mất kết nối trong pha đo")
+    finally:
+        await client.close()
+
+
+def run_load(port, indices, plan, start_at, stop_at):
+    """Chạy trong tiến trình tạo tải: indices là chỉ số các tài khoản."""
+    stats = {
+        "sent": 0,
+        "churn": 0,
+        "deliveries": 0,
+        "slow_deliveries": 0,
+        "latencies": [],
+        "handshakes": [],
+        "errors": 0,
+        "error": None,
+    }
+
+    async def main():
+        gate = asyncio.Semaphore(plan["handshake_slots"])
+        results = await asyncio.gather(
+            *(_client(i, port, plan, start_at, stop_at, gate, stats) for i in indices),
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        stats["errors"] = len(errors)
+        if errors:
+            stats["error"] = str(errors[0]) or type(errors[0]).__name__
+
+    asyncio.run(main())
+    return stats
+
+
+# =====================================================
+# SỐ LIỆU TIẾN TRÌNH SERVER (/proc)
+# =====================================================
+def process_tree(pid):
+    """pid cùng mọi tiến trình con cháu (worker, hub)."""
+    parents = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        parents[int(entry.name)] = int(stat.rsplit(")", 1)[1].split()[1])
+    tree, frontier = [pid], [pid]
+    while frontier:
+        frontier = [p for p, ppid in parents.items() if ppid in frontier]
+        tree += frontier
+    return tree
+
+
+def cpu_seconds(pids):
+    """Tổng CPU user+sys (giây) của các tiến trình."""
+    ticks = 0
+    for pid in pids:
+        try:
+            fields = Path(f"/proc/{pid}/stat").read_text().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        ticks += int(fields[11]) + int(fields[12])  # utime, stime
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def rss_kb(pids):
+    total = 0
+    for pid in pids:
+        try:
+            lines = Path(f"/proc/{pid}/status").read_text().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            if line.startswith("VmRSS:"):
+                total += int(line.split()[1])
+    return total
+
+
+def request_stats(port):
+    """Bộ đếm của server qua gói stats (tài khoản bench_stats)."""
+
+    async def main():
+        client = ChatClient(features=[], reconnect=False)
+        await client.start("127.0.0.1", port, "bench_stats", "x")
+        result = asyncio.ensure_future(_first(client.events("stats_result")))
+        await asyncio.sleep(0)
+        client.send({"type": "stats"})
+        try:
+            packet = await asyncio.wait_for(result, 10)
+            return packet.get("stats")
+        finally:
+            await client.close()
+
+    return asyncio.run(main())
+
+
+async def _first(events):
+    async for packet in events:
+        return packet
+
+
+# =====================================================
+# MỘT LẦN CHẠY
+# =====================================================
+def run_engine(engine, opts):
+    port = free_port()
+    plan = {
+        "clients": opts.clients,
+        "room_size": opts.room_size,
+        "rate": opts.rate,
+        "mix": opts.mix,
+        "slow_clients": int(opts.clients * opts.slow_readers),
+        "handshake_slots": max(1, HANDSHAKE_CONCURRENCY // opts.generators),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        # mật khẩu đã băm sẵn: login đi đúng đường bcrypt verify như thật
+        secret = bcrypt.hashpw(b"x", bcrypt.gensalt(BCRYPT_ROUNDS)).decode("ascii")
+        users = {f"bench{i}": secret for i in range(opts.clients)}
+        users["bench_stats"] = secret
+        Path(tmp, "users.json").write_text(json.dumps(users), encoding="utf-8")
+        proc = subprocess.Popen(
+            [sys.executable, str(HERE / "chat_server.py"),
+             "--engine", engine, "--port", str(port),
+             "--workers", str(opts.workers), "--bcrypt-rounds", str(BCRYPT_ROUNDS),
+             "--history-on-join", "0", *opts.server_arg],
+            cwd=tmp,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_port(port)
+            time.sleep(1.0 if opts.workers > 1 else 0.3)  # chờ mọi worker lắng nghe
+            start_at = time.time() + opts.warmup
+            stop_at = start_at + opts.duration
+            shards = [
+                list(range(i, opts.clients, opts.generators))
+                for i in range(opts.generators)
+            ]
+            with ProcessPoolExecutor(opts.generators) as pool:
+                futures = [
+                    pool.submit(run_load, port, shard, plan, start_at, stop_at)
+                    for shard in shards if shard
+                ]
+                # CPU/RSS của server đo đúng trong pha đo
+                time.sleep(max(0.0, start_at - time.time()))
+                pids = process_tree(proc.pid)
+                cpu_start = cpu_seconds(pids)
+                time.sleep(max(0.0, stop_at - time.time()))
+                pids = process_tree(proc.pid)
+                cpu = cpu_seconds(pids) - cpu_start
+                rss = rss_kb(pids)
+                try:
+                    server = request_stats(port)
+                except Exception as e:
+                    server = {"error": str(e) or type(e).__name__}
+                parts = [f.result() for f in futures]
+        finally:
+            proc.send_signal(signal.SIGINT)  # tắt gọn worker + hub
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    sent = sum(p["sent"] for p in parts)
+    latencies = [x for p in parts for x in p["latencies"]]
+    handshakes = [x for p in parts for x in p["handshakes"]]
+    errors = [p["error"] for p in parts if p["error"]]
+    return {
+        "engine": engine,
+        "workers": opts.workers,
+        "clients": opts.clients,
+        "slow_clients": plan["slow_clients"],
+        "msgs_per_s": round(sent / opts.duration, 1),
+        "deliveries_per_s": round(sum(p["deliveries"] for p in parts) / opts.duration, 1),
+        "slow_deliveries": sum(p["slow_deliveries"] for p in parts),
+        "churn": sum(p["churn"] for p in parts),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "p999_ms": round(percentile(latencies, 0.999) * 1000, 2),
+        "handshake_p50_ms": round(percentile(handshakes, 0.50) * 1000, 2),
+        "handshake_p99_ms": round(percentile(handshakes, 0.99) * 1000, 2),
+        "rss_mb": round(rss / 1024, 1),
+        "cpu_s": round(cpu, 3),
+        "cpu_us_per_msg": round(cpu * 1e6 / sent, 1) if sent else 0.0,
+        "syscalls_per_frame": (server.get("counters") or {}).get("outbound.syscalls_per_frame"),
+        "errors": sum(p["errors"] for p in parts),
+        "error": errors[0] if errors else None,
+        "server": server,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Các chỉ số tệ hơn baseline quá tolerance (tỉ lệ), theo engine."""
+    old = {r["engine"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        base = old.get(r["engine"])
+        if base is None:
+            continue
+        for key, higher_better in COMPARED.items():
+            before, after = base.get(key), r.get(key)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if (-change if higher_better else change) > tolerance:
+                regressions.append(
+                    f"{r['engine']} {key}: {before} -> {after} ({change:+.0%})"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--engines", nargs="+", default=["thread", "asyncio"],
+        choices=("thread", "asyncio"),
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--room-size", type=int, default=20)
+    parser.add_argument("--rate", type=float, default=1.0, help="hành động/giây mỗi client")
+    parser.add_argument(
+        "--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+        help=f"tỉ lệ hành động (mặc định {DEFAULT_MIX})",
+    )
+    parser.add_argument(
+        "--slow-readers", type=float, default=0.0, help="tỉ lệ client đọc chậm (0..1)"
+    )
+    parser.add_argument("--duration", type=float, default=10.0, help="giây đo")
+    parser.add_argument(
+        "--warmup", type=float, default=5.0,
+        help="giây cho mọi client đăng nhập trước pha đo",
+    )
+    parser.add_argument(
+        "--generators", type=int, default=max(1, (os.cpu_count() or 1) // 2),
+        help="số tiến trình tạo tải",
+    )
+    parser.add_argument(
+        "--server-arg", action="append", default=[],
+        help="tham số thêm cho chat_server.py (lặp lại được), vd. --server-arg=--overflow-policy=disconnect",
+    )
+    parser.add_argument("--json", action="store_true", help="in kết quả dạng JSON")
+    parser.add_argument("--output", help="ghi kết quả JSON vào file")
+    parser.add_argument("--baseline", help="file JSON của lần chạy trước để so sánh")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.10,
+        help="mức tệ đi tối đa so với baseline (0.10 = 10%%)",
+    )
+    args = parser.parse_args(argv)
+
+    raise_nofile_limit()
+    print(f"[BENCH] {os.cpu_count()} CPU, {args.clients} client", file=sys.stderr)
+    report = {
+        "version": __version__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "clients": args.clients,
+            "workers": args.workers,
+            "room_size": args.room_size,
+            "rate": args.rate,
+            "mix": args.mix,
+            "slow_readers": args.slow_readers,
+            "duration": args.duration,
+            "server_args": args.server_arg,
+        },
+        "results": [run_engine(engine, args) for engine in args.engines],
+    }
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{'engine':<8} {'msgs/s':>8} {'deliv/s':>9} {'p50_ms':>8} "
+              f"{'p99_ms':>8} {'p999_ms':>8} {'hs_p99':>8} {'rss_mb':>7} "
+              f"{'cpu_us/msg':>10} {'sys/frame':>9} {'errors':>6}")
+        for r in report["results"]:
+            print(f"{r['engine']:<8} {r['msgs_per_s']:>8} {r['deliveries_per_s']:>9} "
+                  f"{r['p50_ms']:>8} {r['p99_ms']:>8} {r['p999_ms']:>8} "
+                  f"{r['handshake_p99_ms']:>8} {r['rss_mb']:>7} "
+                  f"{r['cpu_us_per_msg']:>10} {str(r['syscalls_per_frame']):>9} "
+                  f"{r['errors']:>6}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        if baseline.get("config") != report["config"]:
+            print("[BENCH] cấu hình khác baseline, so sánh chỉ mang tính tham khảo",
+                  file=sys.stderr)
+        regressions = compare(report["results"], baseline, args.tolerance)
+        for line in regressions:
+            print(f"[REGRESSION] {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
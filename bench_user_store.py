@@ -0,0 +1,130 @@
+# bench_user_store.py
+"""
+Benchmark thông lượng đăng ký tài khoản theo backend user store.
+
+Mỗi backend bắt đầu với --existing tài khoản có sẵn (mặc định 100k, nạp
+qua migrate từ users.json), sau đó --threads thread cùng đăng ký
+--registrations tài khoản mới qua ChatServer.handle_register.
+
+"legacy" mô phỏng cách cũ: ghi lại toàn bộ users.json trong self.lock
+cho mỗi lượt đăng ký (chạy ít lượt hơn vì rất chậm).
+
+bcrypt mặc định dùng số vòng tối thiểu (--bcrypt-rounds 4) để số đo phản
+ánh chi phí lưu trữ chứ không phải chi phí băm.
+
+Ví dụ:
+    python bench_user_store.py
+    python bench_user_store.py --existing 100000 --registrations 5000 --threads 64
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+
+from chat_server import ChatServer
+from user_store import BACKENDS, save_users
+
+
+def run_registrations(server, names, threads):
+    chunks = [names[i::threads] for i in range(threads)]
+    failures = []
+
+    def worker(chunk):
+        for name in chunk:
+            ok, msg = server.handle_register(name, "secret")
+            if not ok:
+                failures.append((name, msg))
+
+    workers = [threading.Thread(target=worker, args=(c,)) for c in chunks]
+    t0 = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - t0
+    if failures:
+        print(f"  {len(failures)} lượt thất bại, vd. {failures[0]}")
+    return elapsed
+
+
+def legacy_register(server, username, password):
+    """handle_register kiểu cũ: ghi toàn bộ file trong self.lock."""
+    with server.lock:
+        if username in server.users:
+            return False, "Tên đã tồn tại"
+        server.users[username] = password
+        save_users(server.users)
+    return True, "Đăng ký thành công"
+
+
+def bench(backend, existing, registrations, threads, rounds):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        users = {f"old{i}": "secret" for i in range(existing)}
+        with open("users.json", "w", encoding="utf-8") as f:
+            json.dump(users, f)
+
+        t0 = time.perf_counter()
+        store = "json" if backend == "legacy" else backend
+        server = ChatServer(port=0, user_store=store, bcrypt_rounds=rounds)
+        load_s = time.perf_counter() - t0
+
+        if backend == "legacy":
+            server.handle_register = lambda u, p: legacy_register(server, u, p)
+
+        names = [f"new{i}" for i in range(registrations)]
+        with contextlib.redirect_stdout(io.StringIO()):  # bỏ log [REGISTER]
+            elapsed = run_registrations(server, names, threads)
+        batch = round(server.metrics.snapshot().get("users.commit_batch.avg", 1), 1)
+        server.user_store.close()
+        server.hasher.close()
+        server.server.close()
+        os.chdir("/")
+
+    return {
+        "backend": backend,
+        "existing": existing,
+        "registrations": registrations,
+        "load_s": round(load_s, 3),
+        "regs_per_s": round(registrations / elapsed, 1),
+        "avg_batch": batch,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark user store")
+    parser.add_argument("--existing", type=int, default=100_000)
+    parser.add_argument("--registrations", type=int, default=2000)
+    parser.add_argument("--legacy-registrations", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument(
+        "--backends", nargs="+", default=["legacy", *BACKENDS],
+        choices=("legacy", *BACKENDS),
+    )
+    parser.add_argument("--json", action="store_true", help="in kết quả dạng JSON")
+    args = parser.parse_args(argv)
+
+    results = []
+    for backend in args.backends:
+        n = args.legacy_registrations if backend == "legacy" else args.registrations
+        results.append(
+            bench(backend, args.existing, n, args.threads, args.bcrypt_rounds)
+        )
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'backend':<8} {'existing':>9} {'regs':>6} {'load_s':>7} "
+          f"{'regs/s':>9} {'avg_batch':>9}")
+    for r in results:
+        print(f"{r['backend']:<8} {r['existing']:>9} {r['registrations']:>6} "
+              f"{r['load_s']:>7} {r['regs_per_s']:>9} {r['avg_batch']:>9}")
+
+
+if __name__ == "__main__":
+    main()
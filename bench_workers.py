@@ -0,0 +1,195 @@
+# bench_workers.py
+"""
+Đo thông lượng chat khi server chạy 1, 2, 4... tiến trình worker
+(chat_server.py --workers N, xem workers.py).
+
+Mỗi client đăng nhập, vào một phòng (--room-size người mỗi phòng) rồi gửi
+tin theo vòng kín: gửi một tin, chờ nhận lại chính tin đó, gửi tin tiếp.
+Client được chia cho nhiều tiến trình tạo tải (--generators) để chính bộ
+tạo tải không thành nút cổ chai. Kết quả: số tin/giây server nhận, số lượt
+giao tin/giây (mỗi tin tới mọi người trong phòng) và độ trễ tới lúc nhận
+lại tin của mình.
+
+Server chạy trong thư mục tạm với tài khoản riêng. Worker chỉ tăng thông
+lượng khi máy còn lõi CPU trống: với N worker cần ít nhất N lõi cho server
+cộng thêm lõi cho bộ tạo tải.
+
+Ví dụ:
+    python bench_workers.py --workers 1 2 4 --clients 400
+    python bench_workers.py --engine asyncio --duration 10 --json
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from bench_engines import free_port, raise_nofile_limit, wait_port
+
+HERE = Path(__file__).resolve().parent
+LOGIN_TIME = 3.0  # giây chờ mọi client đăng nhập trước khi bắt đầu đo
+
+
+async def _client(port, username, room, start_at, duration, stats):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+
+    def send(pkt):
+        writer.write((json.dumps(pkt) + "\n").encode("utf-8"))
+
+    async def recv():
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("server đóng kết nối")
+        return json.loads(line)
+
+    send({"type": "login", "username": username, "password": "x"})
+    while (pkt := await recv()).get("type") != "login_result":
+        pass
+    if not pkt.get("ok"):
+        raise ConnectionError(pkt.get("message"))
+    send({"type": "join", "room": room})
+    while (await recv()).get("type") != "room_joined":
+        pass
+
+    # mọi client bắt đầu gửi cùng lúc, sau khi đã đăng nhập xong
+    await asyncio.sleep(max(0.0, start_at - time.time()))
+    stop_at = start_at + duration
+    seq = 0
+    try:
+        while time.time() < stop_at:
+            seq += 1
+            text = f"{username} {seq}"
+            sent = time.perf_counter()
+            send({"type": "chat", "room": room, "text": text})
+            while True:
+                pkt = await recv()
+                if pkt.get("type") != "chat":
+                    continue
+                stats["deliveries"] += 1
+                if pkt.get("from") == username and pkt.get("text") == text:
+                    break
+            stats["sent"] += 1
+            stats["latencies"].append(time.perf_counter() - sent)
+    finally:
+        writer.close()
+
+
+def run_load(port, users, room_size, start_at, duration):
+    """Chạy trong tiến trình tạo tải: users là danh sách chỉ số tài khoản."""
+    stats = {"sent": 0, "deliveries": 0, "latencies": [], "errors": 0}
+
+    async def main():
+        results = await asyncio.gather(
+            *(
+                _client(
+                    port, f"bench{i}", f"r{i // room_size}", start_at, duration, stats
+                )
+                for i in users
+            ),
+            return_exceptions=True,
+        )
+        stats["errors"] = sum(isinstance(r, Exception) for r in results)
+
+    asyncio.run(main())
+    return stats
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_workers(engine, workers, clients, room_size, generators, duration):
+    port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        users = {f"bench{i}": "x" for i in range(clients)}
+        Path(tmp, "users.json").write_text(json.dumps(users), encoding="utf-8")
+        proc = subprocess.Popen(
+            [sys.executable, str(HERE / "chat_server.py"),
+             "--engine", engine, "--port", str(port),
+             "--workers", str(workers), "--bcrypt-rounds", "4",
+             "--presence-window", "0.5", "--history-on-join", "0"],
+            cwd=tmp,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_port(port)
+            time.sleep(1.0 if workers > 1 else 0.3)  # chờ mọi worker lắng nghe
+            # vài giây đầu dành cho đăng nhập + vào phòng, không tính vào số liệu
+            start_at = time.time() + LOGIN_TIME
+            shards = [list(range(i, clients, generators)) for i in range(generators)]
+            with ProcessPoolExecutor(generators) as pool:
+                futures = [
+                    pool.submit(run_load, port, shard, room_size, start_at, duration)
+                    for shard in shards if shard
+                ]
+                parts = [f.result() for f in futures]
+        finally:
+            proc.send_signal(signal.SIGINT)  # tắt gọn worker + hub
+            try:
+                proc.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    sent = sum(p["sent"] for p in parts)
+    deliveries = sum(p["deliveries"] for p in parts)
+    latencies = [x for p in parts for x in p["latencies"]]
+    return {
+        "engine": engine,
+        "workers": workers,
+        "clients": clients,
+        "room_size": room_size,
+        "msgs_per_s": round(sent / duration, 1),
+        "deliveries_per_s": round(deliveries / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "errors": sum(p["errors"] for p in parts),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="asyncio")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--room-size", type=int, default=20)
+    parser.add_argument(
+        "--generators", type=int, default=max(1, (os.cpu_count() or 1) // 2),
+        help="số tiến trình tạo tải",
+    )
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--json", action="store_true", help="in kết quả dạng JSON")
+    args = parser.parse_args(argv)
+
+    raise_nofile_limit()
+    print(f"[BENCH] {os.cpu_count()} CPU", file=sys.stderr)
+    results = [
+        run_workers(
+            args.engine, n, args.clients, args.room_size, args.generators, args.duration
+        )
+        for n in args.workers
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'workers':>7} {'msgs/s':>9} {'deliv/s':>10} {'p50_ms':>8} "
+          f"{'p99_ms':>8} {'errors':>6}")
+    for r in results:
+        print(f"{r['workers']:>7} {r['msgs_per_s']:>9} {r['deliveries_per_s']:>10} "
+              f"{r['p50_ms']:>8} {r['p99_ms']:>8} {r['errors']:>6}")
+
+
+if __name__ == "__main__":
+    main()
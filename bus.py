@@ -0,0 +1,797 @@
+# bus.py
+"""
+Bus nối các node ChatServer thành một cụm (cluster): các tiến trình worker
+trên cùng máy (--workers N, xem workers.py) hoặc nhiều máy sau một load
+balancer (--bus HOST:PORT tới một hub chạy riêng: python bus.py --listen).
+
+Mọi node nối tới một hub (BusHub). Giao thức giữa node và hub là các frame
+JSON có trường "op":
+
+- "challenge" / "hello": khi node nối vào, hub gửi một nonce ngẫu nhiên;
+  node trả "hello" kèm HMAC-SHA256(secret, nonce + tên node) với shared
+  secret của cụm. Sai secret thì hub đóng kết nối; hub không nhận frame nào
+  khác từ kết nối chưa hello xong. Hub nghe qua socket bắt buộc có secret
+  (--secret-file hoặc biến môi trường UDCHAT_BUS_SECRET; supervisor của
+  --workers tự sinh secret cho các worker của nó).
+
+- "message": gói chat/dm do node nhận. Hub gán id (ghi message log nếu
+  bật) rồi phát lại theo thứ tự id: tin trong phòng tới MỌI node (kể cả
+  node gửi), DM chỉ tới node gửi và node đang giữ người nhận (theo khoá
+  đăng nhập "login:<user>"), không phát cho cả cụm. DM tới người không giữ
+  khoá đăng nhập ở node nào được hub cất vào hộp thư offline (dm_mailbox.py).
+  Frame gửi node giữ khoá có "owner": true; người nhận ở node đó chưa vào
+  phiên (đang đăng nhập) hoặc vừa thoát thì node gửi "mailbox_put" để hub
+  cất tin vào hộp thư thay vì bỏ.
+- "event": sự kiện (presence, phiên đăng nhập, tài khoản mới) phát cho các
+  node khác. Sự kiện tài khoản chỉ mang username, không mang hash mật khẩu:
+  node đọc lại từ user store dùng chung. Hub ghi lại phiên, thành viên
+  phòng và tên tài khoản mới để gửi trạng thái hiện tại cho node mới nối vào; khi một node ngắt (hoặc im lặng
+  quá NODE_TIMEOUT) hub bỏ phiên của node đó và phát "worker_down".
+- "call" / "reply": gọi đồng bộ tới hub. "claim" giữ chỗ một khoá (vd.
+  "login:alice") cho một node, nhờ đó kiểm tra đăng nhập trùng/đăng ký
+  trùng vẫn đúng trong cả cụm; "fetch"/"log_info" đọc message log;
+  "mailbox_fetch"/"mailbox_count"/"mailbox_ack" đọc/xoá hộp thư offline
+  (ghi bằng frame một chiều "mailbox_put").
+- "ping": node gửi định kỳ, hub trả "pong"; hai phía dùng để phát hiện
+  đầu kia đã chết (kể cả kết nối TCP nửa mở).
+
+Phía node là một BusNode, có hai cách truyền (transport):
+- BusClient: socket tới hub, Unix domain socket ("/đường/dẫn.sock") hoặc
+  TCP ("host:port").
+- LoopbackBus: hub nằm trong cùng tiến trình, frame đi qua hàng đợi trong
+  RAM. Dùng để chạy thử cả cụm trên một máy (--loopback-nodes N).
+
+Hub ghi tới mỗi node qua QueuedConnection (policy disconnect): một node tụt
+quá xa bị ngắt thay vì làm nghẽn cả bus.
+"""
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import queue
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from codec import JSON_CODEC
+from framing import FrameReader
+from metrics import Metrics
+from outbound import DISCONNECT, QueuedConnection
+
+BUS_MAX_FRAME = 16 * 1024 * 1024
+BUS_QUEUE_LIMIT = 100000   # frame chờ gửi tối đa cho một node
+CALL_TIMEOUT = 10.0        # giây
+FETCH_LIMIT = 1000         # số tin tối đa cho một lần "fetch"
+HEARTBEAT = 5.0            # giây giữa hai lần ping
+NODE_TIMEOUT = 3 * HEARTBEAT  # im lặng quá lâu: coi như node/hub đã chết
+DEFAULT_BUS_PORT = 5556
+SECRET_ENV = "UDCHAT_BUS_SECRET"
+
+
+class BusError(OSError):
+    """Bus đã đóng hoặc hub không trả lời."""
+
+
+def parse_address(text):
+    """'host:port' -> (host, port) cho TCP; '/x/bus.sock' hoặc 'unix:/x' -> đường dẫn."""
+    if isinstance(text, tuple):
+        return text
+    if text.startswith("unix:"):
+        return text[len("unix:"):]
+    if "/" in text:
+        return text
+    host, _, port = text.rpartition(":")
+    return (host or "127.0.0.1", int(port) if port else DEFAULT_BUS_PORT)
+
+
+def load_secret(path=None):
+    """Shared secret của cụm: nội dung file path, không có thì biến môi trường."""
+    if path:
+        with open(path, encoding="utf-8") as f:
+            return f.read().strip() or None
+    return os.environ.get(SECRET_ENV) or None
+
+
+def auth_digest(secret, nonce, worker):
+    """Chữ ký node gửi trong "hello" để chứng minh biết secret."""
+    return hmac.new(
+        secret.encode("utf-8"), f"{nonce}:{worker}".encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def _open_socket(address):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+
+# =====================================================
+# HUB
+# =====================================================
+class BusHub:
+    def __init__(self, address=None, message_log=None, metrics=None, mailbox=None, secret=None):
+        """
+        address=None: chỉ dùng với LoopbackBus trong cùng tiến trình (không
+        cần secret). Hub nghe qua socket phải có secret.
+        """
+        self.address = parse_address(address) if address is not None else None
+        self.secret = secret
+        self.message_log = message_log
+        self.mailbox = mailbox  # dm_mailbox.Mailbox cho DM tới người offline
+        self.metrics = metrics or Metrics()
+        self.lock = threading.Lock()
+        self.links = {}      # {node: link có sendall(bytes)/close()}
+        self.claims = {}     # {khoá: node}
+        self.sessions = {}   # {username: node}
+        self.members = {}    # {phòng: {username: node}}
+        self.users = set()   # tài khoản tạo/đổi mật khẩu từ khi hub chạy
+        self.last_id = message_log.last_id if message_log is not None else 0
+        self.server = None
+
+    @property
+    def path(self):
+        """Địa chỉ để node truyền cho BusClient."""
+        if isinstance(self.address, tuple):
+            return "%s:%d" % self.address
+        return self.address
+
+    def start(self):
+        if self.address is None:
+            return
+        if not self.secret:
+            raise BusError(f"Hub cần shared secret (--secret-file hoặc {SECRET_ENV})")
+        self.server = _open_socket(self.address)
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+        else:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(self.address)
+        self.server.listen()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        print(f"[BUS] Hub lắng nghe tại {self.path}")
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.close()
+            except OSError:
+                pass
+        with self.lock:
+            links = list(self.links.values())
+            self.links.clear()
+        for link in links:
+            link.close()
+        if isinstance(self.address, str):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                break  # hub đã đóng
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        # node gửi ping mỗi HEARTBEAT: im lặng quá NODE_TIMEOUT là node đã chết
+        sock.settimeout(NODE_TIMEOUT)
+        link = QueuedConnection(sock, BUS_QUEUE_LIMIT, DISCONNECT, self.metrics)
+        reader = FrameReader(sock, BUS_MAX_FRAME)
+        nonce = os.urandom(16).hex()
+        self._send(link, {"op": "challenge", "nonce": nonce})
+        node = None
+        try:
+            hello = next(reader, None)
+            if hello is None:
+                return
+            if not self.authenticate(hello, nonce):
+                self.metrics.incr("bus.auth_failed")
+                print(f"[BUS] Từ chối kết nối từ {link.getpeername()}: sai secret")
+                return
+            node = self.dispatch(None, link, hello)
+            for msg in reader:
+                if msg.get("op") == "hello":
+                    raise BusError("hello lặp lại")
+                node = self.dispatch(node, link, msg)
+        except Exception as e:
+            print(f"[BUS] Lỗi với node {node}: {e}")
+        finally:
+            link.close()
+            if node is not None:
+                self.detach(node, link)
+
+    def authenticate(self, hello, nonce):
+        """hello có chữ ký đúng với nonce đã gửi cho kết nối này."""
+        worker = hello.get("worker")
+        auth = hello.get("auth")
+        if hello.get("op") != "hello" or not isinstance(worker, str) or not isinstance(auth, str):
+            return False
+        return hmac.compare_digest(auth, auth_digest(self.secret, nonce, worker))
+
+    # ----- xử lý frame (chung cho mọi transport) -----
+    def dispatch(self, node, link, msg):
+        """
+        Xử lý một frame từ node qua link. Trả về tên node (sau "hello").
+        Kết nối socket đã được _serve() xác thực trước khi gọi tới đây.
+        """
+        op = msg.get("op")
+        if node is None and op != "hello":
+            raise BusError(f"Frame {op} trước hello")
+        if op == "message":
+            self._message(node, msg["packet"])
+        elif op == "event":
+            self._event(node, msg["event"])
+        elif op == "release":
+            with self.lock:
+                if self.claims.get(msg["key"]) == node:
+                    del self.claims[msg["key"]]
+        elif op == "mailbox_put":
+            if self.mailbox is not None:
+                self.mailbox.put(msg["user"], msg["packet"])
+        elif op == "call":
+            self._call(node, link, msg)
+        elif op == "ping":
+            self._send(link, {"op": "pong"})
+        elif op == "hello":
+            node = msg["worker"]
+            self._hello(node, link, msg["req"])
+        return node
+
+    @staticmethod
+    def _send(link, obj):
+        link.sendall(JSON_CODEC.encode(obj))
+
+    def _hello(self, node, link, req):
+        with self.lock:
+            self.links[node] = link
+            # trạng thái hiện tại; sự kiện sau đó đi cùng hàng đợi nên không lệch
+            state = {
+                "log": self.message_log is not None,
+                "mailbox": self.mailbox is not None,
+                "last_id": self.last_id,
+                "sessions": dict(self.sessions),
+                "members": {room: dict(m) for room, m in self.members.items()},
+                "users": sorted(self.users),
+            }
+            self._send(link, {"op": "reply", "req": req, "result": state})
+        print(f"[BUS] Node {node} đã kết nối")
+
+    def _message(self, node, packet):
+        # gán id + phát trong cùng lock: mọi node nhận tin theo thứ tự id
+        with self.lock:
+            if self.message_log is not None:
+                self.message_log.append(packet)
+                self.last_id = packet["id"]
+            else:
+                self.last_id += 1
+                packet["id"] = self.last_id
+            data = JSON_CODEC.encode({"op": "message", "packet": packet})
+            if packet.get("type") == "dm":
+                # chỉ node gửi và node đang giữ người nhận (đánh dấu owner:
+                # node đó cất tin vào hộp thư nếu người nhận chưa vào phiên)
+                owner = self.claims.get(f"login:{packet.get('to')}")
+                sends = []
+                if node != owner and node in self.links:
+                    sends.append((self.links[node], data))
+                if owner in self.links:
+                    sends.append((
+                        self.links[owner],
+                        JSON_CODEC.encode(
+                            {"op": "message", "packet": packet, "owner": True}
+                        ),
+                    ))
+                self.metrics.incr("bus.dm_routed")
+                if owner is None and self.mailbox is not None:
+                    # người nhận offline ở mọi node: cất vào hộp thư
+                    self.mailbox.put(packet["to"], packet)
+            else:
+                sends = [(link, data) for link in self.links.values()]
+            for link, frame in sends:
+                link.sendall(frame)
+        self.metrics.incr("bus.messages")
+
+    def _event(self, node, event):
+        kind = event.get("kind")
+        with self.lock:
+            if kind == "presence":
+                members = self.members.setdefault(event["room"], {})
+                for user in event["left"]:
+                    members.pop(user, None)
+                for user in event["joined"]:
+                    members[user] = node
+                if not members:
+                    del self.members[event["room"]]
+            elif kind == "session":
+                if event["online"]:
+                    self.sessions[event["user"]] = node
+                elif self.sessions.get(event["user"]) == node:
+                    del self.sessions[event["user"]]
+            elif kind == "user":
+                self.users.add(event["user"])
+            data = JSON_CODEC.encode({"op": "event", "worker": node, "event": event})
+            for other, link in self.links.items():
+                if other != node:
+                    link.sendall(data)
+        self.metrics.incr("bus.events")
+
+    def _call(self, node, link, msg):
+        name = msg.get("call")
+        if name == "claim":
+            with self.lock:
+                key = msg["key"]
+                owner = self.claims.get(key)
+                result = owner is None or owner == node
+                if key.startswith("user:") and key[5:] in self.users:
+                    result = False   # tên đã đăng ký xong ở node khác
+                if result:
+                    self.claims[key] = node
+        elif name == "fetch" and self.message_log is not None:
+            limit = max(1, min(int(msg.get("limit", FETCH_LIMIT)), FETCH_LIMIT))
+            result = self.message_log.read(int(msg["after"]), limit, with_times=True)
+        elif name == "log_info" and self.message_log is not None:
+            result = {
+                "first_id": self.message_log.first_id,
+                "last_id": self.message_log.last_id,
+            }
+        elif name == "mailbox_fetch" and self.mailbox is not None:
+            limit = max(1, min(int(msg.get("limit", FETCH_LIMIT)), FETCH_LIMIT))
+            result = self.mailbox.fetch(msg["user"], int(msg.get("after", 0)), limit)
+        elif name == "mailbox_count" and self.mailbox is not None:
+            result = self.mailbox.count(msg["user"])
+        elif name == "mailbox_ack" and self.mailbox is not None:
+            self.mailbox.ack(msg["user"], int(msg["upto"]), int(msg.get("first", 0)))
+            result = True
+        else:
+            result = None
+        self._send(link, {"op": "reply", "req": msg["req"], "result": result})
+        self.metrics.incr("bus.calls")
+
+    def detach(self, node, link):
+        """Bỏ khoá, phiên và thành viên phòng của node đã ngắt."""
+        with self.lock:
+            if self.links.get(node) is not link:
+                return
+            del self.links[node]
+            self.claims = {k: n for k, n in self.claims.items() if n != node}
+            self.sessions = {u: n for u, n in self.sessions.items() if n != node}
+            for room in list(self.members):
+                members = self.members[room]
+                for user in [u for u, n in members.items() if n == node]:
+                    del members[user]
+                if not members:
+                    del self.members[room]
+            data = JSON_CODEC.encode(
+                {"op": "event", "worker": node, "event": {"kind": "worker_down"}}
+            )
+            for other in self.links.values():
+                other.sendall(data)
+        print(f"[BUS] Node {node} đã ngắt kết nối")
+
+
+# =====================================================
+# NODE (trong mỗi ChatServer)
+# =====================================================
+class BusNode:
+    """
+    Phía node của bus; ChatServer chỉ dùng các hàm ở đây. Lớp con cài đặt
+    transport: _open(), _transmit(obj) và _shutdown(); frame nhận được
+    chuyển cho _receive(msg), mất kết nối thì gọi _lost().
+    """
+
+    def __init__(self, worker_id=None):
+        if worker_id is None:
+            # pid có thể trùng giữa các máy: thêm tên máy
+            worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.worker_id = worker_id
+        self.state = None     # trạng thái hub lúc kết nối (xem BusHub._hello)
+        self.closed = False
+        self.on_close = None  # gọi khi mất kết nối tới hub (không phải do close())
+        self._closing = False
+        self._lock = threading.Lock()
+        self._calls = {}      # {req: [Event, kết quả]}
+        self._reqs = itertools.count(1)
+        self._handler = None
+        self._backlog = []    # frame đến trước khi start(handler)
+
+    def connect(self):
+        """Kết nối tới hub và lấy trạng thái hiện tại (self.state)."""
+        self._open()
+        hello = {"op": "hello", "worker": self.worker_id}
+        hello.update(self._credentials())
+        self.state = self._request(hello)
+        if self.state is None:
+            raise BusError("Hub từ chối kết nối")
+
+    def start(self, handler):
+        """
+        Bắt đầu giao frame cho handler(msg), kể cả các frame đến trước đó.
+        handler chạy trên thread nhận của bus nên không được gọi call().
+        """
+        while True:
+            with self._lock:
+                if not self._backlog:
+                    self._backlog = None
+                    self._handler = handler
+                    return
+                batch, self._backlog = self._backlog, []
+            for msg in batch:
+                self._dispatch(handler, msg)
+
+    def close(self):
+        self._closing = True
+        self.closed = True
+        self._shutdown()
+
+    # ----- gửi -----
+    def send(self, obj):
+        """Gửi một frame; bỏ qua nếu bus đã đóng."""
+        if self.closed:
+            return
+        try:
+            self._transmit(obj)
+        except OSError:
+            self.closed = True
+
+    def publish_message(self, packet):
+        self.send({"op": "message", "packet": packet})
+
+    def publish_event(self, event):
+        self.send({"op": "event", "event": event})
+
+    def claim(self, key):
+        """Giữ chỗ khoá cho node này. False nếu node khác đang giữ."""
+        return bool(self.call("claim", key=key))
+
+    def release(self, key):
+        self.send({"op": "release", "key": key})
+
+    def call(self, name, **args):
+        return self._request({"op": "call", "call": name, **args})
+
+    def _request(self, msg):
+        if self.closed:
+            raise BusError("Bus đã đóng")
+        req = next(self._reqs)
+        slot = [threading.Event(), None]
+        with self._lock:
+            self._calls[req] = slot
+        msg["req"] = req
+        self.send(msg)
+        try:
+            if not slot[0].wait(CALL_TIMEOUT):
+                raise BusError(f"Hub không trả lời {msg.get('call', msg['op'])}")
+        finally:
+            with self._lock:
+                self._calls.pop(req, None)
+        if self.closed and slot[1] is None:
+            raise BusError("Bus đã đóng")
+        return slot[1]
+
+    # ----- nhận -----
+    def _receive(self, msg):
+        op = msg.get("op")
+        if op == "reply":
+            with self._lock:
+                slot = self._calls.get(msg.get("req"))
+            if slot is not None:
+                slot[1] = msg.get("result")
+                slot[0].set()
+            return
+        if op == "pong":
+            return
+        with self._lock:
+            if self._backlog is not None:
+                self._backlog.append(msg)
+                return
+            handler = self._handler
+        self._dispatch(handler, msg)
+
+    def _lost(self):
+        self.closed = True
+        with self._lock:
+            slots = list(self._calls.values())
+        for slot in slots:
+            slot[0].set()
+        if not self._closing:
+            print("[BUS] Mất kết nối tới hub")
+            if self.on_close is not None:
+                self.on_close()
+
+    @staticmethod
+    def _dispatch(handler, msg):
+        try:
+            handler(msg)
+        except Exception as e:
+            print(f"[BUS] Lỗi xử lý frame {msg.get('op')}: {e}")
+
+    # ----- transport -----
+    def _open(self):
+        raise NotImplementedError
+
+    def _credentials(self):
+        """Trường thêm vào "hello" để hub xác thực node."""
+        return {}
+
+    def _transmit(self, obj):
+        raise NotImplementedError
+
+    def _shutdown(self):
+        raise NotImplementedError
+
+
+class BusClient(BusNode):
+    """Node nối tới hub qua Unix socket (đường dẫn) hoặc TCP ("host:port")."""
+
+    def __init__(self, address, worker_id=None, secret=None):
+        super().__init__(worker_id)
+        self.address = parse_address(address)
+        self.secret = secret
+        self.sock = None
+        self.reader = None
+        self.nonce = None
+        self._send_lock = threading.Lock()
+
+    def _open(self):
+        if not self.secret:
+            raise BusError(f"Thiếu shared secret của cụm (--bus-secret-file hoặc {SECRET_ENV})")
+        self.sock = _open_socket(self.address)
+        self.sock.connect(self.address)
+        # hub trả "pong" cho mỗi ping: im lặng quá NODE_TIMEOUT là hub đã chết
+        self.sock.settimeout(NODE_TIMEOUT)
+        # frame đầu tiên của hub là challenge; đọc bằng chính reader của
+        # thread nhận để không mất byte nào phía sau
+        self.reader = FrameReader(self.sock, BUS_MAX_FRAME)
+        challenge = next(self.reader, None)
+        if not challenge or challenge.get("op") != "challenge":
+            self._shutdown()
+            raise BusError("Hub không gửi challenge")
+        self.nonce = challenge["nonce"]
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._heartbeat_loop, daemon=True).start()
+
+    def _credentials(self):
+        return {"auth": auth_digest(self.secret, self.nonce, self.worker_id)}
+
+    def _transmit(self, obj):
+        data = JSON_CODEC.encode(obj)
+        with self._send_lock:
+            self.sock.sendall(data)
+
+    def _shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def _read_loop(self):
+        try:
+            for msg in self.reader:
+                self._receive(msg)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self._lost()
+
+    def _heartbeat_loop(self):
+        while not self.closed:
+            time.sleep(HEARTBEAT)
+            self.send({"op": "ping"})
+
+
+class _LoopbackLink:
+    """Link phía hub của một LoopbackBus: frame vào hàng đợi của node."""
+
+    def __init__(self, inbox):
+        self.inbox = inbox
+
+    def sendall(self, data):
+        self.inbox.put(data)
+
+    def close(self):
+        self.inbox.put(None)
+
+
+class LoopbackBus(BusNode):
+    """
+    Node nối với BusHub trong cùng tiến trình. Frame vẫn được mã hoá JSON
+    như qua socket nên mỗi node có bản gói riêng, hành vi giống cụm thật;
+    một thread riêng giao frame cho node theo thứ tự.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, hub, worker_id=None):
+        if worker_id is None:
+            worker_id = f"loopback-{next(self._ids)}"
+        super().__init__(worker_id)
+        self.hub = hub
+        self._inbox = queue.Queue()
+        self._link = _LoopbackLink(self._inbox)
+        self._hub_lock = threading.Lock()  # giữ thứ tự frame gửi lên hub
+
+    def _open(self):
+        threading.Thread(target=self._deliver_loop, daemon=True).start()
+
+    def _transmit(self, obj):
+        msg = json.loads(JSON_CODEC.encode(obj))
+        with self._hub_lock:
+            self.hub.dispatch(self.worker_id, self._link, msg)
+
+    def _shutdown(self):
+        self.hub.detach(self.worker_id, self._link)
+        self._inbox.put(None)
+
+    def _deliver_loop(self):
+        try:
+            while True:
+                data = self._inbox.get()
+                if data is None:
+                    break
+                self._receive(json.loads(data))
+        finally:
+            self._lost()
+
+
+class RemoteLog:
+    """
+    Giao diện đọc giống MessageLog cho node; dữ liệu nằm ở message log của
+    hub. get() đọc theo khối BLOCK tin liền nhau và giữ vài khối gần nhất,
+    nên duyệt history từng id không tốn một lượt gọi bus cho mỗi tin.
+    """
+
+    BLOCK = 256
+    CACHE_BLOCKS = 16
+
+    def __init__(self, bus):
+        self.bus = bus
+        self._cache = OrderedDict()  # {số khối: {id: gói}}
+        self._lock = threading.Lock()
+
+    @property
+    def last_id(self):
+        return self.bus.call("log_info")["last_id"]
+
+    @property
+    def first_id(self):
+        return self.bus.call("log_info")["first_id"]
+
+    def read(self, after_id=0, limit=100, with_times=False):
+        out = []
+        while len(out) < limit:
+            batch = self.bus.call(
+                "fetch", after=after_id, limit=min(limit - len(out), FETCH_LIMIT)
+            )
+            if not batch:
+                break
+            out.extend(batch)
+            after_id = batch[-1][0]["id"]
+        if with_times:
+            return [(packet, ts) for packet, ts in out]
+        return [packet for packet, _ in out]
+
+    def get(self, msg_id):
+        block = msg_id // self.BLOCK
+        with self._lock:
+            packets = self._cache.get(block)
+            if packets is not None:
+                self._cache.move_to_end(block)
+        if packets is None:
+            batch = self.read(block * self.BLOCK - 1, self.BLOCK)
+            packets = {p["id"]: p for p in batch}
+            # chỉ giữ khối đã đủ tin: khối cuối còn đang được ghi thêm
+            if batch and batch[-1]["id"] >= (block + 1) * self.BLOCK - 1:
+                with self._lock:
+                    self._cache[block] = packets
+                    while len(self._cache) > self.CACHE_BLOCKS:
+                        self._cache.popitem(last=False)
+        return packets.get(msg_id)
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class RemoteMailbox:
+    """Giao diện giống dm_mailbox.Mailbox cho node; hộp thư nằm ở hub."""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def put(self, username, packet):
+        # frame một chiều, không chặn; đi cùng thứ tự với các lượt gọi sau đó
+        self.bus.send({"op": "mailbox_put", "user": username, "packet": packet})
+
+    def fetch(self, username, after_id=0, limit=FETCH_LIMIT):
+        return self.bus.call("mailbox_fetch", user=username, after=after_id, limit=limit)
+
+    def count(self, username):
+        return self.bus.call("mailbox_count", user=username)
+
+    def ack(self, username, upto_id, first_id=0):
+        self.bus.call("mailbox_ack", user=username, upto=upto_id, first=first_id)
+
+    def close(self):
+        pass
+
+
+def main(argv=None):
+    """Hub riêng cho cụm nhiều máy; các node chạy chat_server.py --bus HOST:PORT."""
+    from dm_mailbox import DEFAULT_MAX_DAYS, DEFAULT_MAX_MESSAGES, MAILBOX_FILE, Mailbox
+    from message_log import (
+        DEFAULT_RETAIN_BYTES,
+        DEFAULT_SEGMENT_BYTES,
+        LOG_DIR,
+        MessageLog,
+    )
+
+    parser = argparse.ArgumentParser(description="UD Chat cluster hub")
+    parser.add_argument(
+        "--listen",
+        default=f"127.0.0.1:{DEFAULT_BUS_PORT}",
+        help="host:port (TCP) hoặc đường dẫn Unix socket; mở cho máy khác bằng 0.0.0.0:PORT",
+    )
+    parser.add_argument(
+        "--secret-file",
+        help=f"file chứa shared secret của cụm (mặc định đọc biến môi trường {SECRET_ENV})",
+    )
+    parser.add_argument("--message-log-dir", default=LOG_DIR)
+    parser.add_argument(
+        "--no-message-log", action="store_true", help="không ghi log tin nhắn"
+    )
+    parser.add_argument("--segment-bytes", type=int, default=DEFAULT_SEGMENT_BYTES)
+    parser.add_argument("--retain-bytes", type=int, default=DEFAULT_RETAIN_BYTES)
+    parser.add_argument("--retain-hours", type=float, default=0)
+    parser.add_argument("--mailbox-path", default=MAILBOX_FILE)
+    parser.add_argument(
+        "--no-mailbox", action="store_true", help="không giữ DM cho người offline"
+    )
+    parser.add_argument("--mailbox-size", type=int, default=DEFAULT_MAX_MESSAGES)
+    parser.add_argument("--mailbox-days", type=float, default=DEFAULT_MAX_DAYS)
+    args = parser.parse_args(argv)
+    secret = load_secret(args.secret_file)
+    if not secret:
+        parser.error(f"cần shared secret: --secret-file hoặc biến môi trường {SECRET_ENV}")
+
+    message_log = None
+    if not args.no_message_log:
+        message_log = MessageLog(
+            args.message_log_dir,
+            segment_bytes=args.segment_bytes,
+            retain_bytes=args.retain_bytes,
+            retain_seconds=args.retain_hours * 3600,
+        )
+    metrics = Metrics()
+    mailbox = None
+    if not args.no_mailbox:
+        mailbox = Mailbox(
+            args.mailbox_path,
+            max_messages=args.mailbox_size,
+            max_age=args.mailbox_days * 86400,
+            metrics=metrics,
+        )
+    hub = BusHub(args.listen, message_log, metrics, mailbox, secret)
+    hub.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\n[BUS] Nhận Ctrl+C, đang tắt hub...")
+    finally:
+        hub.close()
+        if message_log is not None:
+            message_log.close()
+        if mailbox is not None:
+            mailbox.close()
+        print(f"[STATS] {hub.metrics.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,49 @@
 # chat_client.py
-import socket
+import argparse
+import asyncio
+from collections import deque
 import threading
-import json
+import time
 import tkinter as tk
 from tkinter import messagebox
 from tkinter.scrolledtext import ScrolledText
 
 from version import __version__  # dùng chung version với server
+from chat_sdk import ChatClient, ChatError, CommandError, parse_input
+from rooms import DEFAULT_ROOM
+from scrollback import ScrollbackStore
+from user_list import OnlineUsers
+
+# Thread nhận đẩy việc cập nhật UI vào hàng đợi render; main thread rút theo
+# nhịp RENDER_INTERVAL_MS (~30 khung/giây) và chèn mọi dòng mới của một nhịp
+# bằng một lệnh Tk. 0 = cách cũ, mỗi gói một root.after(0, ...).
+RENDER_INTERVAL_MS = 33
+RENDER_BUDGET = 2000  # số việc tối đa mỗi nhịp, còn lại để nhịp sau
+
+# Khung chat giữ tối đa SCROLLBACK_LINES dòng (+ một khối); phần cũ hơn cắt
+# theo khối SCROLLBACK_CHUNK dòng sang ScrollbackStore, cuộn lên thì nạp lại
+SCROLLBACK_LINES = 5000
+SCROLLBACK_CHUNK = 500
+
+# Số tin xin thêm mỗi lần cuộn lên đầu cửa sổ chat
+HISTORY_PAGE = 50
 
 
 class ChatClientApp:
-    def __init__(self):
+    def __init__(self, scrollback_lines=SCROLLBACK_LINES):
         # ---- single Tk root ----
         self.root = tk.Tk()
         self.root.title(f"UD Chat v{__version__}")
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
-        # socket & state
-        self.client_socket = None
+        # giao thức do chat_sdk.ChatClient đảm nhận, chạy trên một event loop
+        # asyncio ở thread nền; callback của nó chuyển việc sang UI bằng post
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.client = ChatClient()
         self.username = ""
-        self.connected = False
+        self.closing = False
+        self.login_busy = False  # đang kết nối/đăng nhập ở nền
 
         # UI references
         self.login_frame = None
@@ -30,38 +54,122 @@ class ChatClientApp:
         self.pm_label = None
         self.pm_target = None
 
+        # phòng đang xem: gửi chat vào phòng này, danh sách online là của phòng này
+        self.room = DEFAULT_ROOM
+
+        # danh sách online (OnlineUsers, tạo cùng Listbox) + version presence
+        self.online_users = None
+        self.user_filter = None
+        self.presence_version = None
+        self.presence_syncing = False
+
+        # lịch sử: id tin cũ nhất đang hiển thị, còn tin cũ hơn không,
+        # đang chờ trang history (tránh xin trùng khi cuộn)
+        self.history_oldest = None
+        self.history_newest = None  # id tin mới nhất đang hiển thị
+        self.history_more = True
+        self.history_loading = True  # server tự gửi lịch sử khi đăng nhập
+        self.history_scrollback = False  # trang đang chờ là do người dùng cuộn lên
+        self.history_buffer = []
+
+        # hàng đợi render (xem post/render_tick); render_batch gom các dòng
+        # safe_append trong một nhịp. render_stats: số nhịp, số nhịp quá
+        # RENDER_INTERVAL_MS (mất khung) và nhịp lâu nhất.
+        self.render_interval = RENDER_INTERVAL_MS
+        self.render_queue = deque()
+        self.render_batch = None
+        self.render_stats = {"ticks": 0, "late_ticks": 0, "max_tick_ms": 0.0}
+
+        # scrollback: số dòng tối đa trong khung chat, phần đã cắt nằm trong
+        # self.scrollback (tạo cùng khung chat)
+        self.scrollback_lines = max(scrollback_lines, SCROLLBACK_CHUNK)
+        self.scrollback = None
+        self.scrollback_restoring = False
+
+        self.bind_client()
+
         # build Login UI first
         self.build_login_ui()
 
     # =========================================================
-    # helpers for JSON line protocol
+    # CLIENT (chat_sdk) <-> UI
     # =========================================================
     def send_json(self, obj):
-        """
-        Gửi một dict dưới dạng JSON line qua socket client.
-        """
-        if not self.client_socket:
-            return
-        try:
-            data_str = json.dumps(obj, ensure_ascii=False) + "\n"
-            data_bytes = data_str.encode("utf-8")
-            self.client_socket.sendall(data_bytes)
-        except Exception:
-            pass
+        """Gửi một gói (từ main thread): ChatClient xếp hàng và gộp frame."""
+        self.loop.call_soon_threadsafe(self.client.send, obj)
 
-    def iter_json_lines(self):
+    def bind_client(self):
         """
-        Generator đọc từng dòng JSON từ socket.
+        Đăng ký callback cho gói từ server. Callback chạy trên thread của
+        event loop nên chỉ chuyển việc sang main thread (post).
         """
-        f = self.client_socket.makefile("r", encoding="utf-8", newline="\n")
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                yield json.loads(line)
-            except json.JSONDecodeError:
-                yield {"type": "system", "text": f"JSON không hợp lệ: {line[:50]}..."}
+        on = self.client.on
+        on(
+            "system",
+            lambda p: self.post(
+                lambda: self.safe_append(
+                    self.room_prefix(p) + p.get("text", "") + "\n", "sys"
+                )
+            ),
+        )
+        on(
+            "presence",
+            lambda p: self.post(
+                lambda: self.update_online_users(
+                    p.get("users", []), p.get("version"), p.get("room", DEFAULT_ROOM)
+                )
+            ),
+        )
+        for ptype in ("presence_join", "presence_leave", "presence_delta"):
+            on(ptype, self.on_presence_delta)
+        for ptype in ("room_joined", "room_left", "rooms"):
+            on(ptype, lambda p: self.post(lambda: self.handle_room_packet(p)))
+        on("chat", lambda p: self.post(lambda: self.show_message(p)))
+        on("dm", lambda p: self.post(lambda: self.show_message(p)))
+        on("search_result", lambda p: self.post(lambda: self.show_search_results(p)))
+        on("mailbox", lambda p: self.post(lambda: self.show_mailbox(p)))
+        on("history_page", self.on_history_page)
+
+        # sự kiện kết nối của ChatClient
+        on(
+            "disconnected",
+            lambda p: self.post(
+                lambda: self.safe_append(
+                    f"[Hệ thống]: Mất kết nối tới server ({p['error']}), "
+                    "đang kết nối lại...\n",
+                    "sys",
+                )
+            ),
+        )
+        on(
+            "reconnect_failed",
+            lambda p: self.post(
+                lambda: self.safe_append(
+                    f"[Hệ thống]: Chưa kết nối lại được: {p['error']}\n", "sys"
+                )
+            ),
+        )
+        on("reconnected", lambda p: self.post(lambda: self.on_reconnected(p["resumed"])))
+
+    def on_presence_delta(self, packet):
+        ptype = packet.get("type")
+        users = packet.get("users", [])
+        joined = packet.get("joined", users if ptype == "presence_join" else [])
+        left = packet.get("left", users if ptype == "presence_leave" else [])
+        version = packet.get("version")
+        room = packet.get("room", DEFAULT_ROOM)
+        self.post(lambda: self.apply_presence_delta(joined, left, version, room))
+
+    def on_history_page(self, packet):
+        # gom các trang, vẽ một lần khi nhận trang cuối
+        self.history_buffer.extend(packet.get("messages", []))
+        if packet.get("final"):
+            messages, self.history_buffer = self.history_buffer, []
+            self.post(
+                lambda: self.prepend_history(
+                    messages, packet.get("cursor"), packet.get("more", False)
+                )
+            )
 
     # =========================================================
     # UI BUILDERS
@@ -106,6 +214,9 @@ class ChatClientApp:
         self.btn_register.grid(row=4, column=0, pady=(10, 0))
         self.btn_login.grid(row=4, column=1, pady=(10, 0), sticky="w")
 
+        self.login_status = tk.Label(self.login_frame, text="", fg="#555")
+        self.login_status.grid(row=5, column=0, columnspan=3, pady=(8, 0))
+
         # Enter = login
         self.root.bind("<Return>", lambda e: self.handle_login())
 
@@ -139,8 +250,19 @@ class ChatClientApp:
         tk.Label(self.chat_frame, text="👥 Online:").grid(
             row=1, column=2, sticky="w"
         )
-        self.users_list = tk.Listbox(self.chat_frame, height=18, width=24)
-        self.users_list.grid(row=2, column=2, sticky="ns")
+        users_frame = tk.Frame(self.chat_frame)
+        users_frame.grid(row=2, column=2, sticky="ns")
+        # gõ để lọc theo tiền tố tên (Esc để xoá)
+        self.user_filter = tk.StringVar()
+        filter_entry = tk.Entry(users_frame, textvariable=self.user_filter, width=24)
+        filter_entry.pack(fill="x", pady=(0, 4))
+        filter_entry.bind("<Escape>", lambda e: self.user_filter.set(""))
+        self.users_list = tk.Listbox(users_frame, height=17, width=24)
+        self.users_list.pack(fill="y", expand=True)
+        self.online_users = OnlineUsers(self.users_list)
+        self.user_filter.trace_add(
+            "write", lambda *_: self.online_users.set_filter(self.user_filter.get())
+        )
         self.pm_target = None
         self.users_list.bind("<Double-Button-1>", self.toggle_pm_target)
 
@@ -179,90 +301,45 @@ class ChatClientApp:
         self.chat_window.tag_config(
             "sys", foreground="#888888", font=("Segoe UI", 9, "italic")
         )
+        # cuộn lên đầu -> nạp lại dòng đã cắt, hết thì xin trang lịch sử cũ hơn
+        self.chat_window.configure(yscrollcommand=self.on_chat_scroll)
+        self.scrollback = ScrollbackStore()
 
-        # start background receive thread
-        threading.Thread(target=self.receive_messages, daemon=True).start()
+        # bắt đầu vẽ các gói ChatClient đã nhận (kể cả trước khi có khung chat)
+        if self.render_interval > 0:
+            self.root.after(self.render_interval, self.render_tick)
         self.safe_append("[Hệ thống]: Đăng nhập thành công.\n", "sys")
 
     # =========================================================
     # LOGIN / REGISTER ACTIONS
     # =========================================================
-    def _connect(self):
+    def parse_server(self):
+        """Đọc "ip:port" ở ô Server (mặc định cổng 5555)."""
         server_str = self.entry_server.get().strip()
         if ":" in server_str:
             host, port = server_str.split(":", 1)
-            host = host.strip()
-            port = int(port.strip())
-        else:
-            host = server_str.strip()
-            port = 5555
-
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.connect((host, port))
+            return host.strip(), int(port.strip())
+        return server_str, 5555
 
     def handle_register(self):
         """
         Xử lý đăng ký + login ngay sau khi đăng ký.
         """
-        username = self.entry_username.get().strip()
-        password = self.entry_password.get().strip()
-
-        if not username or not password:
-            messagebox.showwarning(
-                "Thiếu thông tin", "Hãy nhập Tên đăng nhập và Mật khẩu."
-            )
-            return
-
-        try:
-            self._connect()
-
-            # gửi gói đăng ký
-            self.send_json(
-                {"type": "register", "username": username, "password": password}
-            )
-
-            resp = next(self.iter_json_lines(), None)
-            if not resp or resp.get("type") != "register_result":
-                raise RuntimeError("Phản hồi đăng ký không hợp lệ")
-
-            if not resp.get("ok"):
-                self.client_socket.close()
-                self.client_socket = None
-                messagebox.showerror(
-                    "Đăng ký thất bại", resp.get("message", "Không xác định")
-                )
-                return
-
-            # đăng ký ok -> login luôn
-            self.username = username
-            self.send_json(
-                {"type": "login", "username": username, "password": password}
-            )
-            login_resp = next(self.iter_json_lines(), None)
-            if login_resp and login_resp.get("ok"):
-                self.connected = True
-                self.build_chat_ui()
-            else:
-                self.client_socket.close()
-                self.client_socket = None
-                messagebox.showerror(
-                    "Đăng nhập thất bại",
-                    (login_resp or {}).get("message", "Không xác định"),
-                )
-
-        except Exception as e:
-            if self.client_socket:
-                try:
-                    self.client_socket.close()
-                except Exception:
-                    pass
-            self.client_socket = None
-            messagebox.showerror("Lỗi đăng ký", f"{e}")
+        self.start_auth(register=True)
 
     def handle_login(self):
         """
         Xử lý đăng nhập khi bấm nút Login hoặc Enter.
         """
+        self.start_auth(register=False)
+
+    def start_auth(self, register):
+        """
+        Kiểm tra ô nhập rồi chạy kết nối + đăng ký/đăng nhập trên event loop
+        (ChatClient.start); cửa sổ vẫn phản hồi trong lúc chờ server.
+        """
+        if self.login_busy:
+            return
         username = self.entry_username.get().strip()
         password = self.entry_password.get().strip()
 
@@ -271,39 +348,60 @@ class ChatClientApp:
                 "Thiếu thông tin", "Hãy nhập Tên đăng nhập và Mật khẩu."
             )
             return
-
         try:
-            self._connect()
-            self.username = username
-
-            self.send_json(
-                {"type": "login", "username": username, "password": password}
-            )
-
-            resp = next(self.iter_json_lines(), None)
-            if not resp or resp.get("type") != "login_result":
-                raise RuntimeError("Phản hồi đăng nhập không hợp lệ")
-
-            if not resp.get("ok"):
-                self.client_socket.close()
-                self.client_socket = None
-                messagebox.showerror(
-                    "Đăng nhập thất bại", resp.get("message", "Không xác định")
-                )
-                return
+            addr = self.parse_server()
+        except ValueError:
+            messagebox.showerror("Không thể kết nối", "Địa chỉ server không hợp lệ.")
+            return
 
-            self.connected = True
-            self.build_chat_ui()
+        self.set_login_busy(True)
+        future = asyncio.run_coroutine_threadsafe(
+            self.client.start(addr[0], addr[1], username, password, register),
+            self.loop,
+        )
+        future.add_done_callback(
+            lambda f: self.deliver(lambda: self.on_auth_result(f, username, register))
+        )
 
+    def deliver(self, fn):
+        """Chuyển kết quả từ thread nền về main thread (ngoài nhịp render)."""
+        try:
+            self.root.after(0, fn)
+        except RuntimeError:
+            pass  # cửa sổ đã đóng trong lúc chờ server
+
+    def set_login_busy(self, busy):
+        self.login_busy = busy
+        state = "disabled" if busy else "normal"
+        self.btn_login.config(state=state)
+        self.btn_register.config(state=state)
+        self.login_status.config(text="Đang kết nối tới server..." if busy else "")
+
+    def on_auth_result(self, future, username, register):
+        """Kết quả connect + register/login (main thread)."""
+        if self.closing:
+            return
+        try:
+            future.result()
+        except ChatError as e:
+            self.set_login_busy(False)
+            title = (
+                "Đăng ký thất bại"
+                if e.reply.get("type") == "register_result"
+                else "Đăng nhập thất bại"
+            )
+            messagebox.showerror(title, str(e))
+            return
         except Exception as e:
-            self.connected = False
-            if self.client_socket:
-                try:
-                    self.client_socket.close()
-                except Exception:
-                    pass
-            self.client_socket = None
-            messagebox.showerror("Không thể kết nối", f"Lỗi: {e}")
+            self.set_login_busy(False)
+            messagebox.showerror(
+                "Lỗi đăng ký" if register else "Không thể kết nối",
+                f"Lỗi: {str(e) or type(e).__name__}",
+            )
+            return
+        self.login_busy = False
+        self.username = username
+        self.build_chat_ui()
 
     # =========================================================
     # CHAT ACTIONS
@@ -327,182 +425,398 @@ class ChatClientApp:
             self.pm_label.config(text=f"Chế độ: Riêng → {sel}", fg="#6a1b9a")
 
     def send_message(self):
-        if not self.connected or not self.client_socket:
+        if not self.client.connected:
             messagebox.showwarning(
                 "Chưa kết nối", "Bạn chưa kết nối tới server."
             )
             return
 
-        msg = self.message_entry.get().strip()
-        if not msg:
+        try:
+            packet = parse_input(
+                self.message_entry.get(), room=self.room, pm_target=self.pm_target
+            )
+        except CommandError as e:
+            self.safe_append(f"[Hệ thống]: {e}\n", "sys")
+            return
+        if packet is None:
             return
 
-        try:
-            if self.pm_target:
-                self.send_json(
-                    {"type": "dm", "to": self.pm_target, "text": msg}
-                )
-                self.safe_append(
-                    f"[PM tới {self.pm_target}]: {msg}\n", "pm_me"
-                )
-            else:
-                if msg.startswith("/pm ") or msg.startswith("/dm "):
-                    parts = msg.split(maxsplit=2)
-                    if len(parts) < 3:
-                        self.safe_append(
-                            "[Hệ thống]: Cú pháp: /pm <user> <nội dung>\n",
-                            "sys",
-                        )
-                        return
-                    _, to_user, text = parts
-                    self.send_json(
-                        {"type": "dm", "to": to_user, "text": text}
-                    )
-                    self.safe_append(
-                        f"[PM tới {to_user}]: {text}\n", "pm_me"
-                    )
-                else:
-                    self.send_json({"type": "chat", "text": msg})
-                    self.safe_append(f"[Bạn]: {msg}\n", "me")
+        self.send_json(packet)
+        if packet["type"] == "dm":
+            self.safe_append(f"[PM tới {packet['to']}]: {packet['text']}\n", "pm_me")
+        elif packet["type"] == "chat":
+            self.safe_append(f"[Bạn]: {packet['text']}\n", "me")
+        self.message_entry.delete(0, tk.END)
 
-            self.message_entry.delete(0, tk.END)
-        except Exception as e:
+    # =========================================================
+    # RECONNECT / RESUME
+    # =========================================================
+    def on_reconnected(self, resumed):
+        """ChatClient đã nối lại (main thread); resume thì không mất gói nào."""
+        if self.closing:
+            return
+        if not resumed:
+            # phiên mới: server đưa về phòng mặc định, gửi lại presence
+            self.room = DEFAULT_ROOM
+            self.presence_version = None
+            self.presence_syncing = False
+            self.root.title(f"UD Chat v{__version__} - {self.username}")
+        self.safe_append(
+            "[Hệ thống]: Đã kết nối lại.\n"
+            if resumed
+            else "[Hệ thống]: Đã kết nối lại (phiên mới).\n",
+            "sys",
+        )
+
+    # =========================================================
+    # MESSAGES / HISTORY
+    # =========================================================
+    def room_prefix(self, packet):
+        """'[#dev] ' cho tin của phòng khác phòng đang xem."""
+        room = packet.get("room")
+        return f"[#{room}] " if room and room != self.room else ""
+
+    def format_message(self, packet):
+        """Trả về (dòng hiển thị, tag) cho gói chat/dm."""
+        frm = packet.get("from")
+        text = packet.get("text")
+        ts = packet.get("ts", "")
+        prefix = (f"[{ts}] " if ts else "") + self.room_prefix(packet)
+        if packet.get("type") == "chat":
+            return f"{prefix}{frm}: {text}\n", None
+        to = packet.get("to")
+        if frm != self.username and to == self.username:
+            return f"{prefix}[PM từ {frm}]: {text}\n", "pm_in"
+        return f"{prefix}[PM tới {to}]: {text}\n", "pm_me"
+
+    def show_message(self, packet):
+        """Hiển thị tin mới đến (chạy trên main thread)."""
+        msg_id = packet.get("id")
+        if isinstance(msg_id, int):
+            if self.history_oldest is None or msg_id < self.history_oldest:
+                self.history_oldest = msg_id
+            if self.history_newest is None or msg_id > self.history_newest:
+                self.history_newest = msg_id
+        line, tag = self.format_message(packet)
+        self.safe_append(line, tag)
+
+    def show_mailbox(self, packet):
+        """Hiển thị một trang DM gửi tới lúc mình offline (gói mailbox)."""
+        messages = packet.get("messages", [])
+        total = packet.get("total", len(messages))
+        if total - packet.get("remaining", 0) == len(messages):
+            # trang đầu
+            self.safe_append(
+                f"[Hệ thống]: {total} tin nhắn riêng gửi tới lúc bạn offline:\n", "sys"
+            )
+        for message in messages:
+            msg_id = message.get("id", 0)
+            # lịch sử lúc đăng nhập có thể đã hiện tin này
+            if (
+                self.history_oldest is not None
+                and self.history_newest is not None
+                and self.history_oldest <= msg_id <= self.history_newest
+            ):
+                continue
+            line, tag = self.format_message(message)
+            self.safe_append("    " + line, tag)
+
+    def show_search_results(self, packet):
+        """In kết quả /search (một trang) vào cửa sổ chat."""
+        results = packet.get("results", [])
+        total = packet.get("total", 0)
+        header = f"[Tìm kiếm] \"{packet.get('q', '')}\": {total} kết quả"
+        if not packet.get("complete", True):
+            header += " (chưa đầy đủ: server đang dựng chỉ mục hoặc chỉ duyệt tin gần đây)"
+        self.safe_append(header + "\n", "sys")
+        for result in results:
+            line, tag = self.format_message(result)
+            self.safe_append("    " + line, tag)
+        if packet.get("next_offset") is not None:
             self.safe_append(
-                f"[Hệ thống]: Lỗi khi gửi tin nhắn: {e}\n", "sys"
+                f"    ... còn {total - packet['next_offset']} kết quả nữa\n", "sys"
             )
 
-    def receive_messages(self):
-        """Nhận dữ liệu từ server trong thread nền."""
-        try:
-            for packet in self.iter_json_lines():
-                ptype = packet.get("type")
-
-                if ptype == "system":
-                    self.root.after(
-                        0,
-                        lambda p=packet: self.safe_append(
-                            p.get("text", "") + "\n", "sys"
-                        ),
-                    )
-
-                elif ptype == "presence":
-                    users = packet.get("users", [])
-                    self.root.after(
-                        0, lambda u=users: self.update_online_users(u)
-                    )
-
-                elif ptype == "chat":
-                    frm = packet.get("from")
-                    text = packet.get("text")
-                    ts = packet.get("ts", "")
-                    line = (
-                        f"[{ts}] {frm}: {text}\n"
-                        if ts
-                        else f"{frm}: {text}\n"
-                    )
-                    self.root.after(
-                        0, lambda l=line: self.safe_append(l)
-                    )
-
-                elif ptype == "dm":
-                    frm = packet.get("from")
-                    to = packet.get("to")
-                    text = packet.get("text")
-                    ts = packet.get("ts", "")
-                    if frm != self.username and to == self.username:
-                        line = (
-                            f"[{ts}] [PM từ {frm}]: {text}\n"
-                            if ts
-                            else f"[PM từ {frm}]: {text}\n"
-                        )
-                        self.root.after(
-                            0,
-                            lambda l=line: self.safe_append(l, "pm_in"),
-                        )
-                    else:
-                        line = (
-                            f"[{ts}] [PM tới {to}]: {text}\n"
-                            if ts
-                            else f"[PM tới {to}]: {text}\n"
-                        )
-                        self.root.after(
-                            0,
-                            lambda l=line: self.safe_append(l, "pm_me"),
-                        )
+    def prepend_history(self, messages, cursor, more):
+        """Chèn các tin lịch sử lên đầu cửa sổ chat, giữ nguyên vị trí đang xem."""
+        self.history_loading = False
+        self.history_more = bool(more)
+        scrolled, self.history_scrollback = self.history_scrollback, False
+        if not self.chat_window:
+            return
+        # tin mới hơn mọi tin đang hiện (gửi trong lúc mất kết nối, nhận qua
+        # trang history của phiên mới): nối vào cuối như tin đến trực tiếp
+        newer = []
+        if self.history_newest is not None:
+            newer = [m for m in messages if m.get("id", 0) > self.history_newest]
+        # bỏ các tin đã hiện (tin đến trực tiếp trong lúc chờ lịch sử)
+        if self.history_oldest is not None:
+            messages = [
+                m for m in messages if m.get("id", 0) < self.history_oldest
+            ]
+        if isinstance(cursor, int) and (
+            self.history_oldest is None or cursor < self.history_oldest
+        ):
+            self.history_oldest = cursor
+        for packet in newer:
+            self.show_message(packet)
+        if not messages:
+            return
+        newest = max(m.get("id", 0) for m in messages)
+        if self.history_newest is None or newest > self.history_newest:
+            self.history_newest = newest
 
-        except Exception as e:
-            self.root.after(
-                0,
-                lambda: self.safe_append(
-                    f"[Hệ thống]: Lỗi nhận dữ liệu: {e}\n", "sys"
-                ),
-            )
-        finally:
-            self.connected = False
-            if self.client_socket:
-                try:
-                    self.client_socket.close()
-                except Exception:
-                    pass
-            self.client_socket = None
-            self.root.after(
-                0,
-                lambda: self.safe_append(
-                    "[Hệ thống]: Mất kết nối tới server.\n", "sys"
-                ),
-            )
+        top = self.chat_window.index("@0,0")
+        self.chat_window.configure(state="normal")
+        inserted = 0
+        for packet in reversed(messages):
+            line, tag = self.format_message(packet)
+            inserted += line.count("\n")
+            if tag:
+                self.chat_window.insert("1.0", line, tag)
+            else:
+                self.chat_window.insert("1.0", line)
+        self.chat_window.configure(state="disabled")
+        if scrolled:
+            # giữ dòng đang xem ở đầu cửa sổ sau khi chèn phía trên
+            row = int(top.split(".")[0]) + inserted
+            self.chat_window.yview(f"{row}.0")
+        else:
+            self.chat_window.see("end")
+
+    def request_older_history(self):
+        """Xin trang lịch sử cũ hơn tin cũ nhất đang hiển thị."""
+        if self.history_loading or not self.history_more or not self.client.connected:
+            return
+        self.history_loading = True
+        self.history_scrollback = True
+        packet = {"type": "history", "limit": HISTORY_PAGE}
+        if self.history_oldest is not None:
+            packet["before"] = self.history_oldest
+        self.send_json(packet)
+
+    def on_chat_scroll(self, first, last):
+        self.chat_window.vbar.set(first, last)
+        if float(first) > 0.0:
+            return
+        if self.scrollback:
+            # không sửa widget ngay trong callback cuộn
+            if not self.scrollback_restoring:
+                self.scrollback_restoring = True
+                self.root.after_idle(self.restore_scrollback)
+        else:
+            self.request_older_history()
+
+    # =========================================================
+    # SCROLLBACK (khung chat có giới hạn số dòng)
+    # =========================================================
+    def line_count(self):
+        return int(self.chat_window.index("end-1c").split(".")[0])
+
+    def text_runs(self, start, end):
+        """Nội dung khung chat trong [start, end) thành [[text, tag], ...]."""
+        runs = []
+        tags = []
+        for key, value, _ in self.chat_window.dump(start, end, text=True, tag=True):
+            if key == "tagon" and value != "sel":
+                tags.append(value)
+            elif key == "tagoff" and value in tags:
+                tags.remove(value)
+            elif key == "text":
+                tag = tags[-1] if tags else ""
+                if runs and runs[-1][1] == tag:
+                    runs[-1][0] += value
+                else:
+                    runs.append([value, tag])
+        return runs
+
+    def trim_scrollback(self):
+        """Cắt các khối dòng cũ nhất khi khung chat vượt giới hạn."""
+        excess = self.line_count() - self.scrollback_lines
+        if excess < SCROLLBACK_CHUNK or self.scrollback is None:
+            return
+        chunks = excess // SCROLLBACK_CHUNK
+        # khối cũ nhất cất trước: khối cất sau cùng nằm sát đầu khung chat
+        for i in range(chunks):
+            first = 1 + i * SCROLLBACK_CHUNK
+            runs = self.text_runs(f"{first}.0", f"{first + SCROLLBACK_CHUNK}.0")
+            self.scrollback.push(runs, SCROLLBACK_CHUNK)
+        self.chat_window.delete("1.0", f"{1 + chunks * SCROLLBACK_CHUNK}.0")
+
+    def restore_scrollback(self):
+        """Nạp lại khối dòng vừa cắt lên đầu khung chat, giữ chỗ đang xem."""
+        self.scrollback_restoring = False
+        if not self.scrollback or not self.chat_window:
+            return
+        runs, lines = self.scrollback.pop()
+        top = self.chat_window.index("@0,0")
+        args = []
+        for text, tag in runs:
+            args += [text, tag or ()]
+        self.chat_window.configure(state="normal")
+        self.chat_window.insert("1.0", *args)
+        self.chat_window.configure(state="disabled")
+        row = int(top.split(".")[0]) + lines
+        self.chat_window.yview(f"{row}.0")
 
     # =========================================================
     # UI HELPERS
     # =========================================================
+    def post(self, fn):
+        """Chuyển một việc cập nhật UI từ thread nền sang main thread."""
+        if self.render_interval > 0:
+            self.render_queue.append(fn)  # deque.append an toàn giữa các thread
+        else:
+            self.root.after(0, fn)
+
+    def render_tick(self):
+        """
+        Một nhịp render (main thread): chạy các việc đang chờ, các dòng
+        safe_append trong lúc đó được chèn một lần ở cuối nhịp.
+        """
+        start = time.perf_counter()
+        self.render_batch = []
+        try:
+            for _ in range(min(len(self.render_queue), RENDER_BUDGET)):
+                fn = self.render_queue.popleft()
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"[UI] Lỗi cập nhật giao diện: {e}")
+        finally:
+            lines, self.render_batch = self.render_batch, None
+            self.append_lines(lines)
+
+        elapsed = (time.perf_counter() - start) * 1000
+        stats = self.render_stats
+        stats["ticks"] += 1
+        if elapsed > self.render_interval:
+            stats["late_ticks"] += 1
+        stats["max_tick_ms"] = max(stats["max_tick_ms"], elapsed)
+        self.root.after(self.render_interval, self.render_tick)
+
     def safe_append(self, text, tag=None):
         """Ghi văn bản vào cửa sổ chat một cách an toàn."""
-        if not self.chat_window:
+        if self.render_batch is not None:
+            self.render_batch.append((text, tag))  # chèn ở cuối nhịp render
+            return
+        self.append_lines([(text, tag)])
+
+    def append_lines(self, lines):
+        """
+        Chèn [(text, tag)] vào cuối cửa sổ chat bằng một lệnh insert (các
+        dòng liền nhau cùng tag được nối thành một đoạn) và cuộn một lần.
+        """
+        if not self.chat_window or not lines:
             return
+        args = []
+        for text, tag in lines:
+            tags = tag or ()
+            if args and args[-1] == tags:
+                args[-2] += text
+            else:
+                args += [text, tags]
         self.chat_window.configure(state="normal")
-        if tag:
-            self.chat_window.insert("end", text, tag)
-        else:
-            self.chat_window.insert("end", text)
+        self.chat_window.insert("end", *args)
+        self.trim_scrollback()
         self.chat_window.see("end")
         self.chat_window.configure(state="disabled")
 
-    def update_online_users(self, users):
-        if not self.users_list:
+    def handle_room_packet(self, packet):
+        """room_joined / room_left / rooms (chạy trên main thread)."""
+        ptype = packet.get("type")
+        room = packet.get("room")
+        if ptype == "room_joined":
+            # chuyển sang phòng mới: snapshot presence của phòng theo sau
+            self.room = room
+            self.presence_version = None
+            self.root.title(f"UD Chat v{__version__} - #{room}")
+            self.safe_append(f"[Hệ thống]: Đang ở phòng #{room}\n", "sys")
+        elif ptype == "room_left":
+            self.safe_append(f"[Hệ thống]: Đã rời phòng #{room}\n", "sys")
+            if room == self.room and room != DEFAULT_ROOM:
+                self.send_json({"type": "join", "room": DEFAULT_ROOM})
+        else:
+            names = ", ".join(
+                f"#{r['name']} ({r['members']})" + (" *" if r.get("joined") else "")
+                for r in packet.get("rooms", [])
+            )
+            self.safe_append(f"[Hệ thống]: Các phòng: {names}\n", "sys")
+
+    def update_online_users(self, users, version=None, room=DEFAULT_ROOM):
+        """
+        Áp snapshot presence đầy đủ (lúc login, đổi phòng hoặc đồng bộ lại):
+        Listbox chỉ nhận phần chênh lệch so với danh sách đang hiện.
+        """
+        if not self.users_list or room != self.room:
             return
-        self.users_list.delete(0, "end")
-        for u in users:
-            if u:
-                self.users_list.insert("end", u)
+        self.presence_version = version
+        self.presence_syncing = False
+        self.online_users.replace(users)
 
-        if self.pm_target and self.pm_target not in users:
+        if self.pm_target and self.pm_target not in self.online_users:
             self.pm_target = None
             self.pm_label.config(text="Chế độ: Công khai", fg="#555")
 
+    def apply_presence_delta(self, joined, left, version, room=DEFAULT_ROOM):
+        """
+        Áp delta presence_join/presence_leave/presence_delta của phòng đang
+        xem vào Listbox (chèn/xoá từng dòng).
+        Nếu version bị lệch (mất gói) thì xin server gửi lại snapshot.
+        """
+        if not self.users_list or room != self.room:
+            return
+        if self.presence_syncing:
+            return  # đang chờ snapshot mới
+        if self.presence_version is not None and version <= self.presence_version:
+            return  # delta cũ đã có trong snapshot
+        if self.presence_version is None or version != self.presence_version + 1:
+            self.presence_syncing = True
+            self.send_json({"type": "presence_sync", "room": self.room})
+            return
+        self.presence_version = version
+
+        for u in left:
+            self.online_users.discard(u)
+            if u == self.pm_target:
+                self.pm_target = None
+                self.pm_label.config(text="Chế độ: Công khai", fg="#555")
+
+        for u in joined:
+            if u:
+                self.online_users.add(u)
+
     # =========================================================
     # APP LIFECYCLE
     # =========================================================
     def on_close(self):
+        self.closing = True
+        if self.scrollback is not None:
+            self.scrollback.close()
+        # ChatClient gửi quit, ghi nốt hàng đợi rồi đóng kết nối
+        future = asyncio.run_coroutine_threadsafe(self.client.close(), self.loop)
         try:
-            if self.connected and self.client_socket:
-                self.send_json({"type": "quit"})
-        except Exception:
-            pass
-        try:
-            if self.client_socket:
-                self.client_socket.shutdown(socket.SHUT_RDWR)
-        except Exception:
-            pass
-        try:
-            if self.client_socket:
-                self.client_socket.close()
+            future.result(timeout=2.0)
         except Exception:
             pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
         self.root.destroy()
 
     def run(self):
         self.root.mainloop()
 
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UD Chat client")
+    parser.add_argument(
+        "--scrollback",
+        type=int,
+        default=SCROLLBACK_LINES,
+        help="số dòng tối đa giữ trong khung chat (phần cũ hơn nạp lại khi cuộn lên)",
+    )
+    args = parser.parse_args(argv)
+    ChatClientApp(scrollback_lines=args.scrollback).run()
+
+
 if __name__ == "__main__":
-    ChatClientApp().run()
+    main()
@@ -0,0 +1,490 @@
+# chat_sdk.py
+"""
+Client asyncio không giao diện cho giao thức UD Chat (bot, tích hợp, công cụ
+đo tải). Client Tkinter (chat_client.py) cũng chạy trên thư viện này, nên
+mọi client dùng chung một cài đặt giao thức:
+- bắt tay register/login, thương lượng mã hoá (msgpack + deflate nếu có
+  thư viện msgpack C, xem codec.py), timeout cho kết nối và mỗi phản hồi,
+- đọc gói ở một task riêng, phân phát theo "type" tới callback (on) và
+  async iterator (events),
+- gửi pipeline: send() không chờ; mọi frame gửi trong cùng một vòng event
+  loop được nối lại và ghi bằng một lần write,
+- nối lại phiên khi rớt mạng: resume token + số gói đã nhận, chờ ngẫu nhiên
+  tăng dần giữa các lần thử; không resume được thì đăng nhập lại.
+
+Ngoài các gói của server, client phát các sự kiện cục bộ:
+    {"type": "disconnected", "error": ...}     mất kết nối
+    {"type": "reconnect_failed", "error": ...} một lần nối lại thất bại
+    {"type": "reconnected", "resumed": bool}   nối lại xong (False: phiên mới)
+
+Ví dụ (bot trả lời "ping"):
+    async def main():
+        async with ChatClient() as client:
+            await client.start("127.0.0.1", 5555, "bot", "secret")
+            async for packet in client.events("chat"):
+                if packet.get("text") == "ping":
+                    client.chat("pong", packet.get("room", DEFAULT_ROOM))
+
+Mọi method (trừ khi ghi chú khác) phải gọi trên thread của event loop; từ
+thread khác dùng loop.call_soon_threadsafe / asyncio.run_coroutine_threadsafe.
+"""
+import asyncio
+import random
+
+from codec import (
+    DEFLATE,
+    JSON_CODEC,
+    MSGPACK,
+    MSGPACK_CODEC,
+    Deflate,
+    MsgpackCodec,
+    get_codec,
+)
+from framing import MAX_LINE, StreamPacketReader, next_packet
+from rooms import DEFAULT_ROOM
+
+DEFAULT_PORT = 5555
+
+# Tính năng client khai báo với server trong gói login
+CLIENT_FEATURES = ["presence_delta", "history", "mailbox", "resume"]
+
+# Chỉ xin frame msgpack khi có thư viện msgpack (C); bản pure-Python dự
+# phòng chậm hơn json của thư viện chuẩn nên khi đó giữ JSON Lines.
+CLIENT_ENCODING = MSGPACK if MSGPACK_CODEC.native else None
+# Nén deflate cho frame lớn (chỉ dùng được cùng frame msgpack)
+CLIENT_COMPRESSION = DEFLATE if CLIENT_ENCODING else None
+
+# giây chờ kết nối + mỗi phản hồi register/login
+CONNECT_TIMEOUT = 10.0
+
+# Tự kết nối lại khi rớt mạng: chờ ngẫu nhiên trong [0, delay], delay gấp
+# đôi sau mỗi lần thất bại (bắt đầu RECONNECT_BASE, tối đa RECONNECT_MAX)
+RECONNECT_BASE = 0.5
+RECONNECT_MAX = 30.0
+RECONNECT_TIMEOUT = 5.0  # giây chờ kết nối + trả lời resume/login
+
+CLOSE_TIMEOUT = 1.0  # giây chờ ghi nốt dữ liệu (kể cả quit) khi đóng
+
+
+class ChatError(Exception):
+    """Server từ chối register/login (reply là gói trả lời) hoặc trả lời sai."""
+
+    def __init__(self, message, reply=None):
+        super().__init__(message)
+        self.reply = reply or {}
+
+
+class CommandError(ValueError):
+    """Dòng lệnh gõ sai cú pháp; message là hướng dẫn cú pháp."""
+
+
+def parse_input(text, room=DEFAULT_ROOM, pm_target=None):
+    """
+    Dịch một dòng người dùng gõ thành gói gửi server:
+        /join <phòng>, /leave [phòng], /rooms, /search <truy vấn>,
+        /pm|/dm <user> <nội dung>; còn lại là chat vào room
+        (hoặc DM tới pm_target nếu đang ở chế độ riêng).
+    Trả về None nếu dòng rỗng, sai cú pháp thì ném CommandError.
+    """
+    msg = text.strip()
+    if not msg:
+        return None
+    command = msg.split()
+    if command[0] == "/join":
+        if len(command) != 2:
+            raise CommandError("Cú pháp: /join <phòng>")
+        return {"type": "join", "room": command[1]}
+    if command[0] == "/leave" and len(command) <= 2:
+        return {"type": "leave", "room": command[1] if len(command) == 2 else room}
+    if command[0] == "/rooms":
+        return {"type": "list_rooms"}
+    if msg == "/search" or msg.startswith("/search "):
+        query = msg[len("/search"):].strip()
+        if not query:
+            raise CommandError(
+                'Cú pháp: /search <từ khoá> ["cụm từ"] '
+                "[from:user] [since:2024-05-01] [until:...]"
+            )
+        return {"type": "search", "q": query}
+    if pm_target:
+        return {"type": "dm", "to": pm_target, "text": msg}
+    if msg.startswith("/pm ") or msg.startswith("/dm "):
+        parts = msg.split(maxsplit=2)
+        if len(parts) < 3:
+            raise CommandError("Cú pháp: /pm <user> <nội dung>")
+        _, to_user, text = parts
+        return {"type": "dm", "to": to_user, "text": text}
+    return {"type": "chat", "text": msg, "room": room}
+
+
+class ChatClient:
+    def __init__(
+        self,
+        features=CLIENT_FEATURES,
+        encoding=CLIENT_ENCODING,
+        compression=CLIENT_COMPRESSION,
+        reconnect=True,
+        connect_timeout=CONNECT_TIMEOUT,
+    ):
+        self.features = list(features)
+        self.encoding = encoding
+        self.compression = compression
+        self.reconnect = reconnect
+        self.connect_timeout = connect_timeout
+
+        self.loop = None
+        self.address = None
+        self.reader = None  # StreamPacketReader của kết nối hiện tại
+        self.writer = None
+        self.codec = JSON_CODEC
+        self.username = None
+        self.password = None  # giữ để đăng nhập lại khi resume không được
+        self.connected = False  # đang trong phiên đã đăng nhập
+        self.closing = False
+
+        # resume: token server cấp khi login + số gói đã nhận trong phiên
+        self.resume_token = None
+        self.resume_seq = 0
+
+        self.handlers = {}  # type -> [callback]; "*" nhận mọi gói
+        self.subscribers = []  # [(các type, asyncio.Queue)] của events()
+        self.receiver = None  # task đọc gói
+
+        # frame chờ ghi trong vòng event loop hiện tại (xem send/_flush)
+        self.pending = []
+        self.flush_scheduled = False
+
+        # bộ đếm: gói gửi, lần write, gói nhận, lần nối lại
+        self.stats = {"sent": 0, "writes": 0, "received": 0, "reconnects": 0}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # =========================================================
+    # KẾT NỐI / BẮT TAY
+    # =========================================================
+    async def connect(self, host, port=DEFAULT_PORT):
+        self.codec = JSON_CODEC
+        await self._open((host, port), self.connect_timeout)
+
+    async def register(self, username, password):
+        """Đăng ký tài khoản trên kết nối hiện tại; thất bại -> ChatError."""
+        resp = await self._request(
+            {"type": "register", "username": username, "password": password},
+            self.connect_timeout,
+        )
+        if resp.get("type") != "register_result":
+            raise ChatError("Phản hồi đăng ký không hợp lệ", resp)
+        if not resp.get("ok"):
+            raise ChatError(resp.get("message", "Không xác định"), resp)
+        return resp
+
+    async def login(self, username, password):
+        """
+        Đăng nhập rồi bắt đầu đọc gói ở nền; thất bại -> ChatError.
+        Trả về gói login_result.
+        """
+        resp = await self._request(
+            self.login_packet(username, password), self.connect_timeout
+        )
+        if resp.get("type") != "login_result":
+            raise ChatError("Phản hồi đăng nhập không hợp lệ", resp)
+        if not resp.get("ok"):
+            raise ChatError(resp.get("message", "Không xác định"), resp)
+        self.username = username
+        self.password = password
+        self._begin_session(resp)
+        self.receiver = self.loop.create_task(self._receive_loop())
+        return resp
+
+    async def start(self, host, port, username, password, register=False):
+        """connect + (register) + login; lỗi thì đóng kết nối rồi ném lại."""
+        try:
+            await self.connect(host, port)
+            if register:
+                await self.register(username, password)
+            return await self.login(username, password)
+        except BaseException:
+            self._close_writer()
+            raise
+
+    def login_packet(self, username, password):
+        packet = {
+            "type": "login",
+            "username": username,
+            "password": password,
+            "features": self.features,
+        }
+        if self.encoding:
+            packet["encoding"] = self.encoding
+        if self.compression:
+            packet["compression"] = self.compression
+        return packet
+
+    async def _open(self, address, timeout):
+        self._close_writer()
+        self.loop = asyncio.get_running_loop()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(*address, limit=MAX_LINE), timeout
+            )
+        except asyncio.TimeoutError:
+            raise ConnectionError("hết thời gian chờ kết nối") from None
+        self.address = address
+        self.reader = StreamPacketReader(reader)
+        self.writer = writer
+
+    async def _request(self, packet, timeout):
+        """Gửi một gói bắt tay (luôn là JSON line) và chờ gói trả lời."""
+        if self.writer is None:
+            raise ConnectionError("chưa kết nối")
+        self.writer.write(JSON_CODEC.encode(packet))
+        try:
+            resp = await asyncio.wait_for(next_packet(self.reader), timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError("hết thời gian chờ server") from None
+        if resp is None:
+            raise ConnectionError("server đóng kết nối")
+        return resp
+
+    def _begin_session(self, login_result):
+        """Bắt đầu phiên sau login_result ok: mã hoá + resume token."""
+        if login_result.get("compression") == DEFLATE:
+            self.codec = MsgpackCodec(compression=Deflate())
+        else:
+            self.codec = get_codec(login_result.get("encoding"))
+        self.reader.set_codec(self.codec)
+        self.resume_token = login_result.get("resume")
+        self.resume_seq = 0
+        self.connected = True
+
+    def _close_writer(self):
+        self.connected = False
+        self.pending = []
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+
+    # =========================================================
+    # GỬI (pipeline + gộp frame)
+    # =========================================================
+    def send(self, packet):
+        """
+        Gửi một gói, không chờ. Frame được xếp hàng; mọi frame gửi trong
+        cùng một vòng event loop được ghi bằng một lần write, theo đúng thứ
+        tự gọi. Trả về False (gói bị bỏ) nếu đang không có kết nối.
+        """
+        if self.writer is None:
+            return False
+        self.pending.append(self.codec.encode(packet))
+        self.stats["sent"] += 1
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self._flush)
+        return True
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if not self.pending or self.writer is None:
+            return
+        data = b"".join(self.pending) if len(self.pending) > 1 else self.pending[0]
+        self.pending = []
+        self.writer.write(data)
+        self.stats["writes"] += 1
+
+    async def drain(self):
+        """Ghi ngay các frame đang chờ và đợi buffer ghi của socket vơi bớt."""
+        self._flush()
+        if self.writer is not None:
+            await self.writer.drain()
+
+    def chat(self, text, room=DEFAULT_ROOM):
+        return self.send({"type": "chat", "text": text, "room": room})
+
+    def dm(self, to, text):
+        return self.send({"type": "dm", "to": to, "text": text})
+
+    def join(self, room):
+        return self.send({"type": "join", "room": room})
+
+    def leave(self, room):
+        return self.send({"type": "leave", "room": room})
+
+    def list_rooms(self):
+        return self.send({"type": "list_rooms"})
+
+    def search(self, query):
+        return self.send({"type": "search", "q": query})
+
+    def history(self, before=None, limit=None, room=None):
+        packet = {"type": "history"}
+        if before is not None:
+            packet["before"] = before
+        if limit is not None:
+            packet["limit"] = limit
+        if room is not None:
+            packet["room"] = room
+        return self.send(packet)
+
+    def presence_sync(self, room=DEFAULT_ROOM):
+        return self.send({"type": "presence_sync", "room": room})
+
+    # =========================================================
+    # NHẬN / PHÂN PHÁT
+    # =========================================================
+    def on(self, ptype, callback):
+        """Gọi callback(packet) cho mỗi gói type ptype ("*" = mọi gói)."""
+        self.handlers.setdefault(ptype, []).append(callback)
+        return callback
+
+    def off(self, ptype, callback):
+        self.handlers.get(ptype, []).remove(callback)
+
+    async def events(self, *types):
+        """
+        Async iterator các gói nhận được (chỉ các type cho trước nếu có).
+        Kết thúc khi client đóng hoặc mất kết nối mà không nối lại.
+        """
+        queue = asyncio.Queue()
+        entry = (frozenset(types), queue)
+        self.subscribers.append(entry)
+        try:
+            while True:
+                packet = await queue.get()
+                if packet is None:
+                    return
+                yield packet
+        finally:
+            self.subscribers.remove(entry)
+
+    def dispatch(self, packet):
+        """Đưa một gói tới các callback và events() (an toàn khi callback lỗi)."""
+        ptype = packet.get("type")
+        for fn in self.handlers.get(ptype, []) + self.handlers.get("*", []):
+            try:
+                fn(packet)
+            except Exception as e:
+                print(f"[SDK] Lỗi xử lý gói {ptype}: {e}")
+        for types, queue in self.subscribers:
+            if not types or ptype in types:
+                queue.put_nowait(packet)
+
+    async def _receive_loop(self):
+        while True:
+            error = "server đóng kết nối"
+            try:
+                async for packet in self.reader:
+                    # gói thứ resume_seq của phiên; gửi lại khi resume để
+                    # server chỉ phát lại phần còn thiếu
+                    self.resume_seq += 1
+                    self.stats["received"] += 1
+                    self.dispatch(packet)
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            self._close_writer()
+            if self.closing:
+                break
+            self.dispatch({"type": "disconnected", "error": error})
+            if not self.reconnect:
+                break
+            resumed = await self._reconnect()
+            if resumed is None:
+                break
+            self.dispatch({"type": "reconnected", "resumed": resumed})
+        for _, queue in self.subscribers:
+            queue.put_nowait(None)
+
+    # =========================================================
+    # NỐI LẠI / RESUME
+    # =========================================================
+    async def _reconnect(self):
+        """
+        Kết nối lại tới khi được (hoặc client đóng), backoff lũy thừa có
+        jitter để cả nghìn client rớt cùng lúc không dồn vào server một lượt.
+        Trả về True/False như _try_reconnect, None nếu client đã đóng.
+        """
+        delay = RECONNECT_BASE
+        last_error = None
+        while not self.closing:
+            await asyncio.sleep(random.uniform(0, delay))
+            delay = min(delay * 2, RECONNECT_MAX)
+            if self.closing:
+                break
+            try:
+                resumed = await self._try_reconnect()
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                if error != last_error:
+                    last_error = error
+                    self.dispatch({"type": "reconnect_failed", "error": error})
+                continue
+            self.stats["reconnects"] += 1
+            return resumed
+        return None
+
+    async def _try_reconnect(self):
+        """
+        Một lần kết nối lại: gửi resume (token + số gói đã nhận) để nhận đúng
+        các gói bị lỡ; token hết hạn thì đăng nhập lại trên cùng kết nối.
+        Trả về True nếu phiên cũ được nối lại, False nếu là phiên mới.
+        """
+        await self._open(self.address, RECONNECT_TIMEOUT)
+        try:
+            if self.resume_token:
+                resp = await self._request(
+                    {
+                        "type": "resume",
+                        "token": self.resume_token,
+                        "seq": self.resume_seq,
+                    },
+                    RECONNECT_TIMEOUT,
+                )
+                if resp.get("ok"):
+                    self.reader.set_codec(self.codec)
+                    self.connected = True
+                    return True
+                self.resume_token = None
+
+            resp = await self._request(
+                self.login_packet(self.username, self.password), RECONNECT_TIMEOUT
+            )
+            if not resp.get("ok"):
+                raise ChatError(resp.get("message", "đăng nhập thất bại"), resp)
+            self._begin_session(resp)
+            return False
+        except BaseException:
+            self._close_writer()
+            raise
+
+    # =========================================================
+    # ĐÓNG
+    # =========================================================
+    async def close(self):
+        """Gửi quit (nếu đang trong phiên), ghi nốt dữ liệu rồi đóng kết nối."""
+        if self.closing:
+            return
+        self.closing = True
+        writer = self.writer
+        if writer is not None:
+            if self.connected:
+                self.send({"type": "quit"})
+            self._flush()
+            try:
+                await asyncio.wait_for(writer.drain(), CLOSE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                pass
+        self._close_writer()
+        receiver = self.receiver
+        if receiver is not None and receiver is not asyncio.current_task():
+            receiver.cancel()
+            await asyncio.gather(receiver, return_exceptions=True)
+        for _, queue in self.subscribers:
+            queue.put_nowait(None)
+
+    async def wait_closed(self):
+        """Chờ tới khi client dừng đọc gói (đóng, hoặc mất kết nối hẳn)."""
+        if self.receiver is not None:
+            await asyncio.gather(self.receiver, return_exceptions=True)
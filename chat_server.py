@@ -1,73 +1,292 @@
+import argparse
+import os
+import secrets
 import socket
 import threading
-import json
+import time
 from datetime import datetime
-from pathlib import Path
-import bcrypt  # <- thêm bcrypt
 
 from version import __version__  # lấy version dùng chung
+from auth import (
+    DEFAULT_MAX_PENDING,
+    DEFAULT_ROUNDS,
+    MAX_PASSWORD_BYTES,
+    HasherBusy,
+    PasswordHasher,
+    is_hashed,
+)
+from bus import RemoteLog, RemoteMailbox
+from codec import (
+    DEFAULT_COMPRESS_THRESHOLD,
+    DEFLATE,
+    JSON_CODEC,
+    MSGPACK,
+    Deflate,
+    MsgpackCodec,
+    PacketFrames,
+    get_codec,
+)
+from dm_mailbox import (
+    DEFAULT_MAX_DAYS,
+    DEFAULT_MAX_MESSAGES,
+    MAILBOX_FILE,
+    PAGE_SIZE as MAILBOX_PAGE,
+    Mailbox,
+)
+from framing import FrameReader
+from history import (
+    DEFAULT_CAPACITY,
+    DEFAULT_JOIN_LIMIT,
+    MAX_LIMIT,
+    SCAN_LIMIT,
+    HistoryBuffer,
+    paginate,
+    visible_to,
+)
+from message_log import (
+    DEFAULT_RETAIN_BYTES,
+    DEFAULT_SEGMENT_BYTES,
+    LOG_DIR,
+    MessageLog,
+)
+from metrics import Metrics
+from outbound import (
+    DEFAULT_FLUSH_WINDOW,
+    DEFAULT_LIMIT,
+    DEFAULT_WRITE_BUDGET,
+    DEFAULT_WRITER_THREADS,
+    DROP_OLDEST,
+    POLICIES,
+    QueuedConnection,
+    ReplayBuffer,
+    WriterPool,
+    set_nodelay,
+)
+from presence import DEFAULT_WINDOW, PresenceAggregator, format_names
+from rooms import DEFAULT_ROOM, MAX_ROOMS_PER_USER, RoomIndex, valid_room
+from search import DEFAULT_LIMIT as SEARCH_LIMIT
+from search import SearchIndex, parse_time
+from user_store import (  # load_users/save_users giữ lại cho code cũ
+    BACKENDS,
+    USERS_FILE,
+    UserExists,
+    load_users,
+    open_user_store,
+    save_users,
+)
 
-USERS_FILE = Path("users.json")
+# Tính năng client có thể khai báo trong gói login ("features": [...])
+FEATURE_PRESENCE_DELTA = "presence_delta"
+FEATURE_HISTORY = "history"  # nhận lịch sử gần nhất ngay khi đăng nhập
+FEATURE_MAILBOX = "mailbox"  # nhận DM lúc offline thành trang "mailbox"
+FEATURE_RESUME = "resume"  # nhận resume token, nối lại phiên khi rớt mạng
 
+DEFAULT_RESUME_WINDOW = 30.0  # giây giữ phiên đã rớt chờ client resume
 
-def load_users():
-    if USERS_FILE.exists():
-        return json.loads(USERS_FILE.read_text(encoding="utf-8"))
-    # Tài khoản mẫu được sử dụng lần đầu
-    users = {"admin": "admin123", "user1": "pass1", "user2": "pass2"}
-    USERS_FILE.write_text(
-        json.dumps(users, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
-    return users
+MAILBOX_SEND_TIMEOUT = 30.0  # giây chờ client nhận xong một trang hộp thư
 
+# Mã hoá server chấp nhận khi client xin trong gói login ("encoding": ...)
+SUPPORTED_ENCODINGS = (MSGPACK,)
 
-def save_users(users):
-    USERS_FILE.write_text(
-        json.dumps(users, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
 
+def encode_packet(obj, codec=JSON_CODEC):
+    """Tuần tự hoá một gói thành frame (bytes, bất biến) theo codec."""
+    return codec.encode(obj)
 
-def send_json(sock, obj):
+
+def send_frame(sock, data):
+    """Gửi một frame đã mã hoá sẵn; dùng chung một frame cho nhiều người nhận."""
     try:
-        data = (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
         sock.sendall(data)
     except Exception:
         pass
 
 
+def send_json(sock, obj):
+    """Gửi một gói theo mã hoá đã thương lượng của kết nối (mặc định JSON)."""
+    send_frame(sock, encode_packet(obj, getattr(sock, "codec", JSON_CODEC)))
+
+
 def iter_json_lines(sock):
     """
-    Đọc từng gói JSON từ socket.
+    Đọc từng gói JSON từ socket (xem framing.FrameReader).
     - Bỏ qua dòng rỗng.
     - Nếu JSON không hợp lệ, trả về gói thông báo lỗi hệ thống.
+    Mỗi lần gọi tạo reader mới: trong một kết nối chỉ nên gọi một lần.
     """
-    with sock.makefile("r", encoding="utf-8", newline="\n") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                yield json.loads(line)
-            except json.JSONDecodeError:
-                yield {
-                    "type": "system",
-                    "text": f"JSON không hợp lệ: {line[:50]}...",
-                }
+    return FrameReader(sock)
 
 
 class ChatServer:
-    def __init__(self, host="127.0.0.1", port=5555):
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=5555,
+        outbound_limit=DEFAULT_LIMIT,
+        overflow_policy=DROP_OLDEST,
+        flush_window=DEFAULT_FLUSH_WINDOW,
+        write_budget=DEFAULT_WRITE_BUDGET,
+        nodelay=True,
+        writer_threads=DEFAULT_WRITER_THREADS,
+        presence_window=DEFAULT_WINDOW,
+        user_store="json",
+        user_store_path=None,
+        auth_workers=None,
+        auth_max_pending=DEFAULT_MAX_PENDING,
+        bcrypt_rounds=DEFAULT_ROUNDS,
+        compression=True,
+        compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+        message_log_dir=LOG_DIR,
+        segment_bytes=DEFAULT_SEGMENT_BYTES,
+        retain_bytes=DEFAULT_RETAIN_BYTES,
+        retain_hours=0,
+        history_size=DEFAULT_CAPACITY,
+        history_on_join=DEFAULT_JOIN_LIMIT,
+        search=True,
+        mailbox_path=MAILBOX_FILE,
+        mailbox_size=DEFAULT_MAX_MESSAGES,
+        mailbox_days=DEFAULT_MAX_DAYS,
+        resume_window=DEFAULT_RESUME_WINDOW,
+        reuse_port=False,
+        bus=None,
+    ):
         self.host = host
         self.port = port
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse_port:
+            # nhiều worker cùng lắng nghe một cổng, kernel chia kết nối mới
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-        self.clients = {}          # {socket: username}
-        self.user_sockets = {}     # {username: socket}
-        self.users = load_users()
+        # chế độ nhiều worker (workers.py): bus tới hub đã kết nối; hub gán id
+        # tin, giữ message log và phát tin/sự kiện cho mọi worker
+        self.bus = bus
+        self.remote_sessions = {}  # {username: worker} đăng nhập ở worker khác
+
+        self.clients = {}          # {conn: username}
+        self.user_sockets = {}     # {username: conn}
+        self.pending_logins = set()  # đã xác thực xong, chưa join_session
         self.lock = threading.Lock()
 
+        # resume: phiên rớt kết nối được giữ resume_window giây (vẫn trong
+        # phòng, frame gửi tới được ghi vào ReplayBuffer) để client nối lại
+        # bằng token mà không đăng nhập/phát presence lại. Nhiều node: tắt,
+        # vì kết nối lại có thể tới worker/node khác.
+        self.resume_window = resume_window if bus is None else 0
+        self.resume_tokens = {}    # {token: ReplayBuffer}
+
+        self.metrics = Metrics()
+        self.metrics.register_gauge("sessions", lambda: len(self.clients))
+
+        # self.users là bản trong RAM; user_store ghi xuống đĩa (group commit)
+        self.user_store = open_user_store(user_store, user_store_path, self.metrics)
+        self.users = self.user_store.load()
+
+        # chat/dm được ghi vào log segment (group commit ở thread riêng);
+        # message_log_dir=None để tắt. Worker đọc log của hub qua bus.
+        self.message_log = None
+        if bus is not None:
+            if bus.state["log"]:
+                self.message_log = RemoteLog(bus)
+        elif message_log_dir:
+            self.message_log = MessageLog(
+                message_log_dir,
+                segment_bytes=segment_bytes,
+                retain_bytes=retain_bytes,
+                retain_seconds=retain_hours * 3600,
+                metrics=self.metrics,
+            )
+        if self.message_log is not None:
+            self.metrics.register_gauge(
+                "messages.last_id", lambda: self.message_log.last_id
+            )
+
+        # DM tới người offline được giữ trong hộp thư tới lần đăng nhập sau
+        # (xem dm_mailbox.py); mailbox_path=None để tắt. Nhiều node: hộp thư
+        # nằm ở hub, hub tự cất DM khi người nhận không đăng nhập ở đâu.
+        self.mailbox = None
+        if bus is not None:
+            if bus.state["mailbox"]:
+                self.mailbox = RemoteMailbox(bus)
+        elif mailbox_path:
+            self.mailbox = Mailbox(
+                mailbox_path,
+                max_messages=mailbox_size,
+                max_age=mailbox_days * 86400,
+                metrics=self.metrics,
+            )
+
+        # tin gần nhất trong RAM cho gói history; message_lock giữ thứ tự
+        # gán id và thêm vào ring buffer
+        self.history = HistoryBuffer(history_size)
+        self.history_on_join = history_on_join
+        self.message_lock = threading.Lock()
+        if self.message_log is not None:
+            for packet in self.message_log.read(
+                self.message_log.last_id - history_size, history_size
+            ):
+                self.history.add(packet)
+            self.history.last_id = self.message_log.last_id
+        if bus is not None:
+            self.history.last_id = max(self.history.last_id, bus.state["last_id"])
+
+        # chỉ mục tìm kiếm: log_message chỉ xếp hàng, thread indexer cập nhật
+        # (dựng lại từ message log lúc khởi động); search=False để tắt
+        self.search_index = None
+        if search:
+            self.search_index = SearchIndex(
+                self.load_message, self.first_message_id, self.metrics
+            )
+            self.metrics.register_gauge(
+                "search.docs", lambda: len(self.search_index.docs)
+            )
+            self.metrics.register_gauge(
+                "search.terms", lambda: len(self.search_index.postings)
+            )
+            self.search_index.start(self.message_log)
+
+        # bcrypt chạy trong process pool, không giữ GIL/self.lock
+        self.hasher = PasswordHasher(
+            auth_workers, auth_max_pending, bcrypt_rounds, self.metrics
+        )
+
+        # phòng chat: mỗi phòng có tập thành viên, version presence và
+        # PresenceAggregator riêng (xem rooms.py). presence_lock giữ thứ tự
+        # gửi delta để mọi client nhận version theo đúng thứ tự.
+        self.presence_window = presence_window
+        self.presence_lock = threading.Lock()
+        self.rooms = RoomIndex(self.make_room_presence)
+        self.metrics.register_gauge("rooms", lambda: len(self.rooms.rooms))
+        if bus is not None:
+            self.rooms.remote = {
+                room: dict(members) for room, members in bus.state["members"].items()
+            }
+            self.remote_sessions = dict(bus.state["sessions"])
+            self.reload_users(bus.state["users"])
+
+        # mỗi kết nối có hàng đợi gửi riêng (xem outbound.py)
+        self.outbound_limit = outbound_limit
+        self.overflow_policy = overflow_policy
+        # writer gộp frame đang chờ thành một lần ghi vectored
+        self.write_options = dict(flush_window=flush_window, write_budget=write_budget)
+        self.nodelay = nodelay
+        self.metrics.register_gauge("outbound.syscalls_per_frame", self.syscalls_per_frame)
+        # engine thread: writer dùng chung cho mọi kết nối, tạo khi start()
+        # (0: mỗi kết nối một writer thread, tốn thêm một thread/kết nối)
+        self.writer_threads = writer_threads
+        self.writer_pool = None
+
+        # codec msgpack + deflate dùng chung cho mọi phiên đã thương lượng
+        # nén, nhờ đó PacketFrames chỉ nén mỗi gói broadcast một lần
+        self.deflate_codec = None
+        if compression:
+            self.deflate_codec = MsgpackCodec(
+                compression=Deflate(compress_threshold, metrics=self.metrics)
+            )
+
+        # nhận tin/sự kiện từ worker khác (kể cả các frame đến trong lúc khởi tạo)
+        if bus is not None:
+            bus.start(self.on_bus_message)
+
     # =====================================================
     # START / SHUTDOWN
     # =====================================================
@@ -75,6 +294,8 @@ class ChatServer:
         self.server.bind((self.host, self.port))
         self.server.listen()
         print(f"[SERVER] Chạy trên {self.host}:{self.port}")
+        if self.writer_threads > 0:
+            self.writer_pool = WriterPool(self.writer_threads, self.metrics)
 
         while True:
             try:
@@ -84,203 +305,687 @@ class ChatServer:
                 break
 
             print(f"[NEW] {address} đã kết nối")
+            set_nodelay(client_socket, self.nodelay)
+            conn = QueuedConnection(
+                client_socket,
+                self.outbound_limit,
+                self.overflow_policy,
+                self.metrics,
+                self.writer_pool,
+                **self.write_options,
+            )
             threading.Thread(
                 target=self.handle_client,
-                args=(client_socket,),
+                args=(conn,),
                 daemon=True,
             ).start()
 
+    def call_later(self, delay, fn):
+        """Hẹn giờ gọi fn sau delay giây (engine thread dùng timer thread)."""
+        timer = threading.Timer(delay, fn)
+        timer.daemon = True
+        timer.start()
+
     def shutdown(self):
         """Đóng tất cả kết nối client + socket server một cách an toàn."""
         print("[SERVER] Đang đóng tất cả kết nối client...")
+        notice = PacketFrames(
+            {
+                "type": "system",
+                "text": "Server đang tắt, bạn sẽ bị ngắt kết nối.",
+            }
+        )
         with self.lock:
-            for sock, uname in list(self.clients.items()):
-                try:
-                    send_json(
-                        sock,
-                        {
-                            "type": "system",
-                            "text": "Server đang tắt, bạn sẽ bị ngắt kết nối.",
-                        },
-                    )
-                except Exception:
-                    pass
+            conns = list(self.clients)
+            for conn in conns:
+                send_frame(conn, notice.get(conn.codec))
                 try:
-                    sock.close()
+                    conn.close()
                 except Exception:
                     pass
             self.clients.clear()
             self.user_sockets.clear()
 
+        # cho writer gửi nốt thông báo trước khi thoát (tối đa ~1 giây)
+        deadline = time.monotonic() + 1.0
+        for conn in conns:
+            conn.join(timeout=max(0.0, deadline - time.monotonic()))
+
         try:
             self.server.close()
         except Exception:
             pass
         print("[SERVER] Đã đóng socket server.")
+        self.user_store.close()
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.search_index is not None:
+            self.search_index.close()
+        if self.mailbox is not None:
+            self.mailbox.close()
+        self.hasher.close()
+        print(f"[STATS] {self.metrics.snapshot()}")
+        if self.bus is not None:
+            self.bus.close()
 
     # =====================================================
     # HANDLE CLIENT
     # =====================================================
-    def handle_client(self, client_socket):
+    def handle_client(self, conn):
+        """Vòng đời một kết nối ở engine thread (mỗi socket một thread)."""
         username = None
+        # một reader cho cả vòng đời kết nối: không mất byte giữa các giai đoạn
+        packets = FrameReader(conn.sock)
         try:
             # Lấy gói đầu tiên
-            first = next(iter_json_lines(client_socket), None)
+            first = next(packets, None)
             if not first:
-                client_socket.close()
                 return
 
-            # -------- REGISTER (nếu có) --------
-            if first.get("type") == "register":
-                username = first.get("username", "").strip()
-                password = first.get("password", "")
-                ok, msg = self.handle_register(username, password)
+            # -------- RESUME (nối lại phiên vừa rớt) --------
+            if first.get("type") == "resume":
+                username = self.resume_step(conn, first)
+                if not username:
+                    # token hết hạn: client đăng nhập lại trên kết nối này
+                    first = next(packets, None)
+                    if not first:
+                        return
+
+            if not username:
+                # -------- REGISTER (nếu có) --------
+                if first.get("type") == "register":
+                    if not self.register_step(conn, first):
+                        return
+
+                    # Cho phép người dùng tiếp tục đăng nhập bằng gói login
+                    first = next(packets, None)
+                    if not first:
+                        return
+
+                # -------- LOGIN --------
+                username = self.login_step(conn, first)
+                if not username:
+                    return
+                self.join_session(conn, username)
+            packets.set_codec(conn.codec)
+
+            # -------- Vòng lặp nhận tin --------
+            for packet in packets:
+                if not self.handle_packet(conn, username, packet):
+                    break
+
+        except Exception as e:
+            print(f"[ERROR] {e}")
+
+        finally:
+            self.leave_session(conn, username)
+
+    # =====================================================
+    # SESSION STEPS (dùng chung cho engine thread và asyncio)
+    # =====================================================
+    def register_step(self, conn, packet):
+        """Xử lý gói register. Trả về True nếu được phép đăng nhập tiếp."""
+        username = packet.get("username", "").strip()
+        password = packet.get("password", "")
+        ok, msg = self.handle_register(username, password)
+        send_json(
+            conn,
+            {"type": "register_result", "ok": ok, "message": msg},
+        )
+        return ok
+
+    def login_step(self, conn, packet):
+        """Xử lý gói login. Trả về username nếu thành công, ngược lại None."""
+        if packet.get("type") != "login":
+            send_json(
+                conn,
+                {
+                    "type": "login_result",
+                    "ok": False,
+                    "message": "Thiếu gói login",
+                },
+            )
+            return None
+
+        username = packet.get("username", "").strip()
+        password = packet.get("password", "")
+        ok, msg = self.handle_login(username, password)
+        result = {"type": "login_result", "ok": ok, "message": msg}
+        encoding = packet.get("encoding")
+        if ok and encoding in SUPPORTED_ENCODINGS:
+            result["encoding"] = encoding
+            # nén chỉ áp dụng cho frame nhị phân
+            if packet.get("compression") == DEFLATE and self.deflate_codec:
+                result["compression"] = DEFLATE
+        features = frozenset(
+            str(f) for f in packet.get("features", ()) if isinstance(f, str)
+        )
+        token = None
+        if ok and FEATURE_RESUME in features and self.resume_window > 0:
+            token = secrets.token_urlsafe(16)
+            result["resume"] = token
+            result["resume_window"] = self.resume_window
+        # login_result luôn là JSON; gói sau đó mới dùng mã hoá đã chọn
+        send_json(conn, result)
+        if not ok:
+            return None
+        conn.features = features
+        conn.codec = self.session_codec(result)
+        if token is not None:
+            # từ đây mọi frame của phiên có seq (frame sau login_result là 1)
+            conn.replay = ReplayBuffer(conn, username, token)
+            with self.lock:
+                self.resume_tokens[token] = conn.replay
+        return username
+
+    def resume_step(self, conn, packet):
+        """
+        Xử lý gói resume {"token", "seq"}: seq là số gói client đã nhận của
+        phiên cũ. Nếu phiên còn được giữ, kết nối này thay kết nối cũ và
+        nhận lại đúng các frame seq lớn hơn, không phát presence vào/ra.
+        Trả về username, hoặc None (resume_result ok=false, client đăng nhập
+        lại như thường).
+        """
+        token = packet.get("token")
+        seq = packet.get("seq")
+        with self.lock:
+            replay = self.resume_tokens.get(token) if isinstance(token, str) else None
+        missed = None
+        if replay is not None and isinstance(seq, int):
+            with replay.lock:
+                missed = None if replay.closed else replay.since(seq)
+                if missed is not None:
+                    old, previous = replay.conn, replay.owner
+                    # resume_result là JSON như login_result; sau đó dùng codec cũ
+                    send_json(
+                        conn, {"type": "resume_result", "ok": True, "seq": replay.seq}
+                    )
+                    conn.features = previous.features
+                    conn.codec = previous.codec
+                    for data in missed:
+                        conn.enqueue(data, replay)
+                    conn.replay = replay
+                    replay.conn = replay.owner = conn
+        if missed is None:
+            self.metrics.incr("sessions.resume_failed")
+            send_json(
+                conn,
+                {
+                    "type": "resume_result",
+                    "ok": False,
+                    "message": "Phiên đã hết hạn, hãy đăng nhập lại",
+                },
+            )
+            return None
+
+        username = replay.username
+        with self.lock:
+            # kết nối mới thay kết nối cũ trong mọi chỉ mục của server
+            if self.clients.pop(previous, None) is not None:
+                self.clients[conn] = username
+                self.user_sockets[username] = conn
+                for name in self.rooms.rooms_of(username):
+                    self.rooms.get(name).members[username] = conn
+        if old is not None:
+            # client thấy rớt mạng trước server (kết nối cũ nửa mở)
+            old.abort()
+        self.metrics.incr("sessions.resumed")
+        self.metrics.incr("sessions.replayed_frames", len(missed))
+        print(f"[RESUME] {username} nối lại phiên, phát lại {len(missed)} gói")
+        return username
+
+    def session_codec(self, login_result):
+        """Codec cho phiên theo mã hoá/nén đã chấp nhận trong login_result."""
+        if login_result.get("compression") == DEFLATE:
+            return self.deflate_codec
+        return get_codec(login_result.get("encoding"))
+
+    def join_session(self, conn, username):
+        """Ghi nhận phiên đã đăng nhập và thông báo cho cả phòng."""
+        with self.presence_lock:
+            with self.lock:
+                self.pending_logins.discard(username)
+                self.clients[conn] = username
+                self.user_sockets[username] = conn
+                lobby = self.rooms.join(DEFAULT_ROOM, username, conn)
+            # người mới nhận snapshot ngay; thông báo cho cả phòng được gộp
+            self.send_presence_snapshot(conn, lobby)
+
+        if self.bus is not None:
+            self.bus.publish_event({"kind": "session", "user": username, "online": True})
+        lobby.presence.joined(username)
+
+        seen = None
+        if FEATURE_HISTORY in conn.features and self.history_on_join:
+            messages = self.send_history(conn, username, limit=self.history_on_join)
+            if messages:
+                seen = (messages[0]["id"], messages[-1]["id"])
+        if self.mailbox is not None:
+            # đọc đĩa/bus và chờ client nhận: không chặn thread đăng nhập
+            threading.Thread(
+                target=self.deliver_mailbox, args=(conn, username, seen), daemon=True
+            ).start()
+
+    def handle_packet(self, conn, username, packet):
+        """
+        Xử lý một gói trong phiên đã đăng nhập.
+        Trả về False nếu client xin ngắt kết nối (quit).
+        """
+        ptype = packet.get("type")
+
+        if ptype == "chat":
+            text = str(packet.get("text", "")).strip()
+            if not text:
+                return True
+            room = packet.get("room", DEFAULT_ROOM)
+            with self.lock:
+                member = room in self.rooms.rooms_of(username)
+            if not member:
                 send_json(
-                    client_socket,
-                    {"type": "register_result", "ok": ok, "message": msg},
+                    conn, {"type": "system", "text": f"Bạn chưa vào phòng '{room}'."}
                 )
-                if not ok:
-                    client_socket.close()
-                    return
+                return True
+            ts = datetime.now().strftime("%H:%M:%S")
+            message = {
+                "type": "chat",
+                "from": username,
+                "text": text,
+                "ts": ts,
+                "room": room,
+            }
+            self.publish_message(message)
 
-                # Cho phép người dùng tiếp tục đăng nhập bằng gói login
-                first = next(iter_json_lines(client_socket), None)
-                if not first:
-                    client_socket.close()
-                    return
+        # ----- DM (tin nhắn riêng) -----
+        elif ptype == "dm":
+            to_user = str(packet.get("to", "")).strip()
+            text = str(packet.get("text", "")).strip()
+            if not to_user:
+                send_json(conn, {"type": "system", "text": "Bạn chưa chọn người nhận."})
+                return True
+            if not text:
+                return True
+            with self.lock:
+                exists = to_user in self.users
+            if not exists:
+                send_json(conn, {"type": "system", "text": f"User '{to_user}' không tồn tại."})
+                return True
 
-            # -------- LOGIN --------
-            if first.get("type") != "login":
+            # kiểm tra trước khi gửi: người nhận vừa đăng nhập sau đó vẫn nhận
+            # được tin (trực tiếp hoặc từ hộp thư), chỉ thông báo là lệch
+            online = self.is_online(to_user)
+            if not online and self.mailbox is None:
+                send_json(conn, {"type": "system", "text": f"User '{to_user}' không online."})
+                return True
+            ts = datetime.now().strftime("%H:%M:%S")
+            message = {
+                "type": "dm",
+                "from": username,
+                "to": to_user,
+                "text": text,
+                "ts": ts,
+            }
+            self.publish_message(message)
+            if not online:
                 send_json(
-                    client_socket,
+                    conn,
                     {
-                        "type": "login_result",
-                        "ok": False,
-                        "message": "Thiếu gói login",
+                        "type": "system",
+                        "text": f"User '{to_user}' không online, tin sẽ được gửi khi họ đăng nhập.",
                     },
                 )
-                client_socket.close()
-                return
 
-            username = first.get("username", "").strip()
-            password = first.get("password", "")
-            ok, msg = self.handle_login(username, password)
-            send_json(
-                client_socket,
-                {"type": "login_result", "ok": ok, "message": msg},
-            )
-            if not ok:
-                client_socket.close()
-                return
+        # ----- lịch sử (cuộn lên xem tin cũ) -----
+        elif ptype == "history":
+            try:
+                before = packet.get("before")
+                after = packet.get("after")
+                self.send_history(
+                    conn,
+                    username,
+                    before=None if before is None else int(before),
+                    after=None if after is None else int(after),
+                    limit=int(packet.get("limit", DEFAULT_JOIN_LIMIT)),
+                    room=packet.get("room"),
+                )
+            except (TypeError, ValueError):
+                send_json(conn, {"type": "system", "text": "Gói history không hợp lệ"})
 
-            # ❗ IF LOGIN FAIL → NGẮT LUÔN
-            if not ok:
-                client_socket.close()
-                return
+        # ----- tìm kiếm lịch sử -----
+        elif ptype == "search":
+            self.send_search(conn, username, packet)
 
-            # ĐĂNG NHẬP THÀNH CÔNG
+        # ----- phòng chat -----
+        elif ptype == "join":
+            self.join_room(conn, username, packet.get("room"))
+
+        elif ptype == "leave":
+            self.leave_room(conn, username, packet.get("room"))
+
+        elif ptype == "list_rooms":
             with self.lock:
-                self.clients[client_socket] = username
-                self.user_sockets[username] = client_socket
+                rooms = self.rooms.listing(username)
+            send_json(conn, {"type": "rooms", "rooms": rooms})
 
-            self.broadcast_system(
-                f"[{username}] đã tham gia phòng chat!", exclude=username
+        # ----- client xin đồng bộ lại presence (bị lệch version) -----
+        elif ptype == "presence_sync":
+            with self.presence_lock:
+                with self.lock:
+                    room = self.rooms.get(packet.get("room", DEFAULT_ROOM))
+                    member = room is not None and username in room.members
+                if member:
+                    self.send_presence_snapshot(conn, room)
+
+        # ----- số liệu server -----
+        elif ptype == "stats":
+            send_json(conn, {"type": "stats_result", "stats": self.get_stats()})
+
+        # ----- quit -----
+        elif ptype == "quit":
+            if conn.replay is not None:
+                with conn.replay.lock:
+                    conn.replay.closed = True  # thoát chủ động: không giữ phiên
+            return False
+
+        else:
+            send_json(
+                conn,
+                {
+                    "type": "system",
+                    "text": f"Loại gói không hỗ trợ: {ptype}",
+                },
             )
-            self.send_presence()
+        return True
 
-            # -------- Vòng lặp nhận tin --------
-            for packet in iter_json_lines(client_socket):
-                ptype = packet.get("type")
-
-                if ptype == "chat":
-                    text = str(packet.get("text", "")).strip()
-                    if not text:
-                        continue
-                    ts = datetime.now().strftime("%H:%M:%S")
-                    self.broadcast(
-                        {
-                            "type": "chat",
-                            "from": username,
-                            "text": text,
-                            "ts": ts,
-                        },
-                        exclude=None,
+    def leave_session(self, conn, username, park=True):
+        """
+        Dọn dẹp khi kết nối đóng (dù đã đăng nhập hay chưa). Phiên có resume
+        token được giữ lại resume_window giây thay vì rời phòng ngay
+        (park=False để kết thúc hẳn, xem expire_session).
+        """
+        replay = conn.replay
+        if replay is not None:
+            with self.lock:
+                joined = conn in self.clients
+            with replay.lock:
+                superseded = replay.owner is not conn
+                parked = park and joined and replay.valid and not replay.closed
+                if parked:
+                    replay.conn = None
+                elif not superseded:
+                    replay.closed = True
+            if superseded or parked:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                if parked:
+                    self.metrics.incr("sessions.parked")
+                    self.call_later(
+                        self.resume_window, lambda: self.expire_session(replay, conn)
                     )
+                return
+            with self.lock:
+                self.resume_tokens.pop(replay.token, None)
 
-                # ----- DM (tin nhắn riêng) -----
-                elif ptype == "dm":
-                    to_user = str(packet.get("to", "")).strip()
-                    text = str(packet.get("text", "")).strip()
-                    if not to_user or not text:
-                        continue
-                    ts = datetime.now().strftime("%H:%M:%S")
-                    self.send_dm(
-                        from_user=username,
-                        to_user=to_user,
-                        obj={
-                            "type": "dm",
-                            "from": username,
-                            "to": to_user,
-                            "text": text,
-                            "ts": ts,
-                        },
-                    )
+        with self.lock:
+            left_rooms = []
+            if conn in self.clients:
+                uname = self.clients.pop(conn)
+                self.user_sockets.pop(uname, None)
+                left_rooms = self.rooms.leave_all(uname)
+            else:
+                # đăng nhập thành công nhưng chưa kịp join_session
+                if username:
+                    self.pending_logins.discard(username)
+                uname = None
 
-                    if not to_user:
-                        send_json(client_socket, {"type": "system", "text": "Bạn chưa chọn người nhận."})
-                        continue
+        try:
+            conn.close()
+        except Exception:
+            pass
 
-                    if to_user not in self.user_sockets:
-                        send_json(client_socket, {"type": "system", "text": f"User '{to_user}' không online."})
-                        continue
+        for room in left_rooms:
+            room.presence.left(uname)
 
-                    ts = datetime.now().strftime("%H:%M:%S")
+        if self.bus is not None and username:
+            if uname:
+                self.bus.publish_event(
+                    {"kind": "session", "user": uname, "online": False}
+                )
+            self.bus.release(f"login:{username}")
 
-                    obj = {
-                        "type": "dm",
-                        "from": username,
-                        "to": to_user,
-                        "text": text,
-                        "ts": ts
-                    }
+    def expire_session(self, replay, conn):
+        """Hết resume_window mà client chưa nối lại: kết thúc phiên thật."""
+        with replay.lock:
+            if replay.closed or replay.conn is not None or replay.owner is not conn:
+                return  # đã resume (hoặc đã kết thúc)
+        self.metrics.incr("sessions.expired")
+        self.leave_session(conn, replay.username, park=False)
 
-                    self.send_dm(username, to_user, obj)
+    def parked_session(self, username):
+        """Kết nối của phiên username đang chờ resume, ngược lại None."""
+        with self.lock:
+            conn = self.user_sockets.get(username)
+        if conn is None or conn.replay is None:
+            return None
+        with conn.replay.lock:
+            return conn if conn.replay.conn is None and not conn.replay.closed else None
 
-                # ----- quit -----
-                elif ptype == "quit":
-                    break
+    def publish_message(self, message):
+        """
+        Gán id, lưu và phát gói chat/dm. Chế độ nhiều worker: gửi lên hub,
+        hub gán id rồi phát lại cho mọi worker (xem on_bus_message).
+        """
+        if self.bus is not None:
+            self.bus.publish_message(message)
+            return
+        self.log_message(message)
+        self.deliver_message(message)
 
+    def deliver_message(self, message, hold=True):
+        """
+        Gửi gói chat/dm tới người nhận đang kết nối vào tiến trình này. DM
+        tới người offline vào hộp thư nếu hold (nhiều node: hub tự cất khi
+        người nhận không ở node nào, node giữ người nhận cất phần còn lại,
+        xem bus.py).
+        """
+        if message.get("type") == "dm":
+            self.send_dm(message["from"], message["to"], message, hold)
+        else:
+            self.broadcast(message, room=message.get("room", DEFAULT_ROOM))
+
+    def log_message(self, packet):
+        """
+        Gán packet["id"] cho gói chat/dm, ghi vào message log (nếu bật) và
+        thêm vào lịch sử trong RAM.
+        """
+        with self.message_lock:
+            try:
+                if self.message_log is not None:
+                    self.message_log.append(packet)
                 else:
-                    send_json(
-                        client_socket,
-                        {
-                            "type": "system",
-                            "text": f"Loại gói không hỗ trợ: {ptype}",
-                        },
-                    )
+                    packet["id"] = self.history.last_id + 1
+            except Exception as e:
+                print(f"[ERROR] Không ghi được tin vào log: {e}")
+                return
+            self.remember_message(packet)
 
+    def remember_message(self, packet):
+        """Thêm gói đã có id vào lịch sử trong RAM và chỉ mục tìm kiếm."""
+        self.history.add(packet)
+        if self.search_index is not None:
+            self.search_index.submit(packet)
+
+    def on_bus_message(self, msg):
+        """Frame từ hub (chạy trên thread nhận của bus, xem BusNode.start)."""
+        if msg.get("op") == "message":
+            packet = msg["packet"]
+            self.remember_message(packet)
+            self.deliver_message(packet, msg.get("owner", False))
+            return
+
+        worker = msg.get("worker")
+        event = msg.get("event", {})
+        kind = event.get("kind")
+        if kind == "presence":
+            with self.lock:
+                self.rooms.apply_remote(
+                    event["room"], worker, event["joined"], event["left"]
+                )
+            self.announce_presence(event["room"], event["joined"], event["left"])
+        elif kind == "session":
+            with self.lock:
+                if event["online"]:
+                    self.remote_sessions[event["user"]] = worker
+                elif self.remote_sessions.get(event["user"]) == worker:
+                    del self.remote_sessions[event["user"]]
+        elif kind == "user":
+            self.reload_users([event["user"]])
+        elif kind == "worker_down":
+            with self.lock:
+                self.remote_sessions = {
+                    u: w for u, w in self.remote_sessions.items() if w != worker
+                }
+                dropped = self.rooms.drop_worker(worker)
+            for name, users in dropped.items():
+                self.announce_presence(name, [], users)
+            print(f"[BUS] Node {worker} đã dừng")
+
+    def reload_users(self, usernames):
+        """
+        Tài khoản tạo/đổi mật khẩu ở node khác: bus chỉ báo tên, hash đọc
+        lại từ user store dùng chung của cụm. Đọc ở thread nền để không
+        chặn thread nhận của bus.
+        """
+        usernames = list(usernames)
+        if not usernames:
+            return
+
+        def load():
+            for username in usernames:
+                try:
+                    secret = self.user_store.get(username)
+                except Exception as e:
+                    print(f"[ERROR] Không đọc được tài khoản {username}: {e}")
+                    continue
+                if secret is not None:
+                    with self.lock:
+                        self.users[username] = secret
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def fetch_user(self, username):
+        """
+        Đọc một tài khoản chưa có trong self.users từ user store dùng chung
+        (vừa tạo ở node khác, reload_users chưa kịp đọc). Trả về secret
+        hoặc None; gọi ngoài event loop.
+        """
+        try:
+            secret = self.user_store.get(username)
         except Exception as e:
-            print(f"[ERROR] {e}")
+            print(f"[ERROR] Không đọc được tài khoản {username}: {e}")
+            return None
+        if secret is None:
+            return None
+        with self.lock:
+            # reload_users có thể đã ghi bản mới hơn trong lúc đọc
+            return self.users.setdefault(username, secret)
 
-        finally:
-            # cleanup
+    def is_online(self, username):
+        """username đang đăng nhập ở worker này hoặc worker khác."""
+        with self.lock:
+            return username in self.user_sockets or username in self.remote_sessions
+
+    # =====================================================
+    # ROOMS
+    # =====================================================
+    def make_room_presence(self, room):
+        """PresenceAggregator cho một phòng mới (gọi bởi RoomIndex)."""
+        return PresenceAggregator(
+            lambda joined, left: self.flush_presence(room, joined, left),
+            self.call_later,
+            window=self.presence_window,
+            metrics=self.metrics,
+        )
+
+    def join_room(self, conn, username, name):
+        """Vào phòng name (tạo mới nếu chưa có), trả room_joined + snapshot."""
+        if not valid_room(name):
+            send_json(conn, {"type": "system", "text": "Tên phòng không hợp lệ."})
+            return
+        with self.presence_lock:
             with self.lock:
-                if client_socket in self.clients:
-                    uname = self.clients.pop(client_socket)
-                    self.user_sockets.pop(uname, None)
+                rooms = self.rooms.rooms_of(username)
+                already = name in rooms
+                if not already and len(rooms) >= MAX_ROOMS_PER_USER:
+                    room = None
                 else:
-                    uname = username
+                    room = self.rooms.join(name, username, conn)
+            if room is None:
+                send_json(
+                    conn,
+                    {
+                        "type": "system",
+                        "text": f"Bạn chỉ được vào tối đa {MAX_ROOMS_PER_USER} phòng.",
+                    },
+                )
+                return
+            # đã ở trong phòng: chỉ gửi lại snapshot (client chuyển phòng)
+            send_json(conn, {"type": "room_joined", "room": name})
+            self.send_presence_snapshot(conn, room)
+        if not already:
+            room.presence.joined(username)
 
-            try:
-                client_socket.close()
-            except Exception:
-                pass
+    def leave_room(self, conn, username, name):
+        with self.lock:
+            room = self.rooms.leave(name, username)
+        if room is None:
+            send_json(
+                conn, {"type": "system", "text": f"Bạn không ở trong phòng '{name}'."}
+            )
+            return
+        send_json(conn, {"type": "room_left", "room": name})
+        room.presence.left(username)
 
-            if uname:
-                self.broadcast_system(
-                    f"[{uname}] đã rời khỏi phòng chat!", exclude=None
-                )
-                self.send_presence()
+    def flush_presence(self, room, joined, left):
+        """
+        Phát một thông báo hệ thống và một gói presence cho mọi sự kiện
+        vào/ra của room đã gộp trong cửa sổ của PresenceAggregator.
+        """
+        if self.bus is not None:
+            self.bus.publish_event(
+                {"kind": "presence", "room": room.name, "joined": joined, "left": left}
+            )
+        self.announce_presence(room.name, joined, left, only=room)
+
+    def announce_presence(self, name, joined, left, only=None):
+        """
+        Gửi thay đổi thành viên của phòng name (ở worker này hoặc worker
+        khác) cho thành viên phòng ở worker này.
+        only: chỉ báo nếu phòng hiện tại đúng là Room đó.
+        """
+        with self.presence_lock:
+            with self.lock:
+                room = self.rooms.get(name)
+                # phòng đã bị xoá (người cuối rời đi): không còn ai để báo
+                if room is None or (only is not None and room is not only):
+                    return
+                room.version += 1
+            self.send_presence(room, joined, left)
+
+        where = "phòng chat" if room.name == DEFAULT_ROOM else f"phòng #{room.name}"
+        if joined:
+            self.broadcast_system(
+                f"{format_names(joined)} đã tham gia {where}!",
+                exclude=joined,
+                room=room.name,
+            )
+        if left:
+            self.broadcast_system(
+                f"{format_names(left)} đã rời khỏi {where}!",
+                exclude=None,
+                room=room.name,
+            )
 
     # =====================================================
     # AUTH HELPERS
@@ -289,82 +994,733 @@ class ChatServer:
         if not username or not password:
             return False, "Thiếu username/password"
 
+        if len(password.encode("utf-8")) > MAX_PASSWORD_BYTES:
+            return False, f"Mật khẩu quá dài (tối đa {MAX_PASSWORD_BYTES} byte)"
+
+        with self.lock:
+            if username in self.users:
+                return False, "Tên đã tồn tại"
+
+        try:
+            secret = self.hasher.hash(password)
+        except HasherBusy:
+            return False, "Server đang bận, thử lại sau"
+
+        # nhiều worker: giữ tên trên hub để hai worker không cùng đăng ký
+        if self.bus is not None:
+            try:
+                if not self.bus.claim(f"user:{username}"):
+                    return False, "Tên đã tồn tại"
+            except OSError:
+                return False, "Server đang bận, thử lại sau"
+        try:
+            return self._save_new_user(username, secret)
+        finally:
+            if self.bus is not None:
+                self.bus.release(f"user:{username}")
+
+    def _save_new_user(self, username, secret):
         with self.lock:
             if username in self.users:
                 return False, "Tên đã tồn tại"
+            # giữ chỗ trong RAM, ghi đĩa bên ngoài self.lock
+            self.users[username] = secret
 
-            # (ở branch này vẫn dùng plaintext; branch #9 dùng bcrypt)
-            self.users[username] = password
-            save_users(self.users)
+        try:
+            # create() không ghi đè: node khác có thể vừa tạo cùng tên
+            self.user_store.create(username, secret)
+        except UserExists:
+            with self.lock:
+                if self.users.get(username) == secret:
+                    del self.users[username]
+            return False, "Tên đã tồn tại"
+        except Exception as e:
+            with self.lock:
+                if self.users.get(username) == secret:
+                    del self.users[username]
+            print(f"[ERROR] Không lưu được tài khoản {username}: {e}")
+            return False, "Lỗi lưu tài khoản, thử lại sau"
 
+        self.publish_user(username)
         print(f"[REGISTER] {username} đã đăng ký")
         return True, "Đăng ký thành công"
 
+    def publish_user(self, username):
+        """
+        Báo tài khoản mới/mật khẩu mới cho các node khác. Chỉ gửi tên: hash
+        đã nằm trong user store dùng chung, không đi qua bus.
+        """
+        if self.bus is not None:
+            self.bus.publish_event({"kind": "user", "user": username})
+
     def handle_login(self, username, password):
         stored = self.users.get(username)
+        if stored is None and self.bus is not None:
+            stored = self.fetch_user(username)
         if stored is None:
             return False, "Sai tài khoản hoặc mật khẩu"
 
+        parked = self.parked_session(username)
+        with self.lock:
+            if (
+                username in self.user_sockets and parked is None
+            ) or username in self.remote_sessions:
+                return False, "Tài khoản đang đăng nhập ở nơi khác"
+
+        try:
+            ok = self.hasher.verify(password, stored)
+        except HasherBusy:
+            return False, "Server đang bận, thử lại sau"
+        if not ok:
+            return False, "Sai tài khoản hoặc mật khẩu"
+        if parked is not None:
+            # đăng nhập mới thay cho phiên đang chờ resume: kết thúc phiên cũ
+            self.expire_session(parked.replay, parked)
+
+        # kiểm tra lại sau bcrypt (~vài trăm ms) và giữ chỗ tên đăng nhập
         with self.lock:
-            if username in self.user_sockets:
+            if username in self.user_sockets or username in self.pending_logins:
+                return False, "Tài khoản đang đăng nhập ở nơi khác"
+            self.pending_logins.add(username)
+
+        # nhiều worker: hub chỉ cho một worker giữ tên đăng nhập
+        # (leave_session trả lại)
+        if self.bus is not None:
+            try:
+                claimed = self.bus.claim(f"login:{username}")
+            except OSError:
+                claimed = None
+            if not claimed:
+                with self.lock:
+                    self.pending_logins.discard(username)
+                if claimed is None:
+                    return False, "Server đang bận, thử lại sau"
                 return False, "Tài khoản đang đăng nhập ở nơi khác"
 
+        if not is_hashed(stored):
+            # mật khẩu plaintext cũ: băm lại ở nền, không làm chậm login
+            threading.Thread(
+                target=self.rehash_password,
+                args=(username, password, stored),
+                daemon=True,
+            ).start()
+
         return True, "Đăng nhập thành công"
 
+    def rehash_password(self, username, password, legacy):
+        """Thay mật khẩu plaintext cũ bằng bcrypt hash (chỉ làm một lần)."""
+        try:
+            secret = self.hasher.hash(password)
+        except HasherBusy:
+            return  # lần đăng nhập sau sẽ thử lại
+        with self.lock:
+            if self.users.get(username) != legacy:
+                return
+            self.users[username] = secret
+        try:
+            self.user_store.save(username, secret)
+            self.publish_user(username)
+            print(f"[AUTH] Đã băm lại mật khẩu cũ của {username}")
+        except Exception as e:
+            print(f"[ERROR] Không lưu được mật khẩu mới của {username}: {e}")
+
+    # =====================================================
+    # HISTORY
+    # =====================================================
+    def first_message_id(self):
+        """Id nhỏ nhất còn đọc được (đầu message log, hoặc đầu ring buffer)."""
+        if self.message_log is not None:
+            return self.message_log.first_id
+        return self.history.first_id
+
+    def load_message(self, msg_id):
+        """Tin theo id: ring buffer trước, không có thì đọc message log."""
+        packet = self.history.get(msg_id)
+        if packet is None and self.message_log is not None:
+            packet = self.message_log.get(msg_id)
+        return packet
+
+    def collect_history(
+        self, username, before=None, after=None, limit=DEFAULT_JOIN_LIMIT,
+        rooms=None, dms=True,
+    ):
+        """
+        Tìm tối đa limit tin mà username được xem (tin của các phòng rooms,
+        kèm DM của username nếu dms).
+        - after: các tin có id > after (tăng dần),
+        - before (hoặc không có cursor): các tin có id < before, mới nhất trước.
+        Trả về (tin theo thứ tự id tăng dần, cursor cho yêu cầu kế tiếp, còn nữa).
+        """
+        limit = max(1, min(limit, MAX_LIMIT))
+        last = self.history.last_id
+        first = self.first_message_id()
+        found = []
+        scanned = 0
+
+        if after is not None:
+            msg_id = max(after + 1, first)
+            while msg_id <= last and len(found) < limit and scanned < SCAN_LIMIT:
+                packet = self.load_message(msg_id)
+                if packet is not None and visible_to(packet, username, rooms, dms):
+                    found.append(packet)
+                msg_id += 1
+                scanned += 1
+            return found, msg_id - 1, msg_id <= last
+
+        msg_id = last if before is None else min(before - 1, last)
+        while msg_id >= first and len(found) < limit and scanned < SCAN_LIMIT:
+            packet = self.load_message(msg_id)
+            if packet is not None and visible_to(packet, username, rooms, dms):
+                found.append(packet)
+            msg_id -= 1
+            scanned += 1
+        found.reverse()
+        return found, msg_id + 1, msg_id >= first
+
+    def send_history(
+        self, conn, username, before=None, after=None, limit=DEFAULT_JOIN_LIMIT,
+        room=None,
+    ):
+        """
+        Gửi kết quả history thành các trang history_page có giới hạn.
+        room: chỉ lấy tin của phòng đó (không kèm DM); mặc định lấy tin của
+        mọi phòng username đang ở cùng DM của họ.
+        Trả về các tin đã gửi (id tăng dần).
+        """
+        with self.lock:
+            rooms = self.rooms.rooms_of(username)
+        if room is not None:
+            if room not in rooms:
+                send_json(
+                    conn, {"type": "system", "text": f"Bạn chưa vào phòng '{room}'."}
+                )
+                return []
+            rooms = frozenset((room,))
+        messages, cursor, more = self.collect_history(
+            username, before, after, limit, rooms, dms=room is None
+        )
+        pages = paginate(messages)
+        for i, page in enumerate(pages):
+            reply = {"type": "history_page", "messages": page, "final": False}
+            if room is not None:
+                reply["room"] = room
+            if i == len(pages) - 1:
+                # trang cuối mang cursor để xin tiếp trang cũ/mới hơn
+                reply.update(
+                    final=True,
+                    direction="after" if after is not None else "before",
+                    cursor=cursor,
+                    more=more,
+                )
+            send_json(conn, reply)
+        self.metrics.incr("history.requests")
+        self.metrics.incr("history.messages", len(messages))
+        return messages
+
+    # =====================================================
+    # MAILBOX (DM nhận lúc offline)
+    # =====================================================
+    def deliver_mailbox(self, conn, username, seen=None):
+        """
+        Chuyển DM chờ trong hộp thư của username, mỗi lần một trang
+        MAILBOX_PAGE tin. Trang sau chỉ gửi khi writer đã ghi xong trang
+        trước; tin chỉ bị xoá khỏi hộp thư sau khi đã ghi xuống socket, nên
+        ngắt kết nối giữa chừng thì phần còn lại chờ lần đăng nhập sau.
+        Client không khai báo FEATURE_MAILBOX nhận từng gói dm như bình thường.
+        seen: (id đầu, id cuối) của trang history đã gửi lúc đăng nhập; DM
+        trong khoảng đó client đã có nên chỉ bị xoá, không gửi lại.
+        """
+        try:
+            if seen is not None:
+                self.mailbox.ack(username, seen[1], seen[0])
+            total = self.mailbox.count(username)
+            after = delivered = 0
+            while delivered < total:
+                page = self.mailbox.fetch(username, after, MAILBOX_PAGE)
+                if not page:
+                    break
+                delivered += len(page)
+                dropped = conn.queue.dropped
+                if FEATURE_MAILBOX in conn.features:
+                    remaining = max(0, total - delivered)
+                    send_json(
+                        conn,
+                        {
+                            "type": "mailbox",
+                            "messages": page,
+                            "total": total,
+                            "remaining": remaining,
+                            "final": remaining == 0 or len(page) < MAILBOX_PAGE,
+                        },
+                    )
+                else:
+                    for packet in page:
+                        send_json(conn, packet)
+                done = self.wait_delivered(conn, MAILBOX_SEND_TIMEOUT)
+                if done is None:
+                    return
+                if done.queue.dropped != (dropped if done is conn else 0):
+                    return  # có frame bị bỏ vì client chậm: giữ lại cho lần sau
+                after = page[-1]["id"]
+                self.mailbox.ack(username, after)
+            if delivered:
+                print(f"[MAILBOX] Đã chuyển {delivered} DM chờ cho {username}")
+        except Exception as e:
+            print(f"[MAILBOX] Lỗi chuyển hộp thư của {username}: {e}")
+
+    def wait_delivered(self, conn, timeout):
+        """
+        Chờ writer ghi xong mọi frame đã gửi cho phiên của conn. Phiên resume
+        được thì chờ trên kết nối đang nhận frame (replay.conn): sau resume,
+        kết nối cũ bị huỷ và frame client chưa nhận được phát lại ở kết nối
+        mới. Trả về kết nối đã ghi xong, None nếu hết giờ hoặc phiên kết thúc.
+        """
+        deadline = time.monotonic() + timeout
+        replay = conn.replay
+        while True:
+            target = conn
+            if replay is not None:
+                with replay.lock:
+                    if replay.closed:
+                        return None
+                    target = replay.conn
+            if target is not None and target.queue.wait_sent(
+                target.queue.enqueued, max(0.0, deadline - time.monotonic())
+            ):
+                if replay is None or replay.conn is target:
+                    return target
+                continue  # vừa resume sang kết nối khác: chờ tiếp ở đó
+            if replay is None or time.monotonic() > deadline:
+                return None
+            time.sleep(0.05)  # kết nối đứt, chờ client resume
+
+    # =====================================================
+    # SEARCH
+    # =====================================================
+    def send_search(self, conn, username, packet):
+        """
+        Trả lời gói search bằng một search_result (một trang kết quả).
+        Filter có thể nằm trong "q" (from:alice since:2024-05-01) hoặc là
+        trường riêng của gói ("from", "to", "room", "since", "until"). Chỉ
+        tìm trong các phòng username đang ở.
+        """
+        if self.search_index is None:
+            send_json(conn, {"type": "system", "text": "Server không bật tìm kiếm."})
+            return
+        q = str(packet.get("q", ""))
+        try:
+            filters = {
+                key: packet[key] for key in ("from", "to", "room") if packet.get(key)
+            }
+            for key in ("since", "until"):
+                if packet.get(key) is not None:
+                    filters[key] = parse_time(packet[key])
+            offset = int(packet.get("offset", 0))
+            limit = int(packet.get("limit", SEARCH_LIMIT))
+            with self.lock:
+                rooms = self.rooms.rooms_of(username)
+            results, total, complete = self.search_index.search(
+                username, q, filters, offset, limit, rooms
+            )
+        except (TypeError, ValueError) as e:
+            send_json(
+                conn, {"type": "system", "text": f"Gói search không hợp lệ: {e}"}
+            )
+            return
+
+        # một frame: cắt bớt nếu kết quả quá lớn, phần còn lại ở next_offset
+        page = paginate([p for _, p in results], page_size=len(results) or 1)[0]
+        offset = max(0, offset)
+        next_offset = offset + len(page)
+        send_json(
+            conn,
+            {
+                "type": "search_result",
+                "q": q,
+                "results": [
+                    dict(p, score=score) for score, p in results[:len(page)]
+                ],
+                "total": total,
+                "offset": offset,
+                "next_offset": next_offset if next_offset < total else None,
+                "complete": self.search_index.ready and complete,
+            },
+        )
+
+    # =====================================================
+    # STATS
+    # =====================================================
+    def outbound_stats(self):
+        """Độ sâu hàng đợi gửi và số frame bị bỏ của từng người dùng."""
+        with self.lock:
+            sessions = list(self.user_sockets.items())
+        return {uname: conn.queue.stats() for uname, conn in sessions}
+
+    def syscalls_per_frame(self):
+        """
+        Số syscall ghi trung bình cho mỗi frame đã gửi (1.0 = không gộp).
+        Chỉ tính các lần ghi biết số syscall (engine thread); engine asyncio
+        không đếm được nên là None.
+        """
+        frames = self.metrics.get("outbound.syscall_frames")
+        if not frames:
+            return None
+        return round(self.metrics.get("outbound.syscalls") / frames, 4)
+
+    def get_stats(self):
+        stats = {
+            "counters": self.metrics.snapshot(),
+            "outbound": self.outbound_stats(),
+        }
+        if self.bus is not None:
+            stats["worker"] = self.bus.worker_id
+        return stats
+
     # =====================================================
     # BROADCAST / PRESENCE / DM
     # =====================================================
-    def broadcast(self, message, exclude=None):
+    def broadcast(self, message, exclude=None, room=None):
         """
-        Gửi message (dict JSON) tới tất cả client đang kết nối.
-        - exclude: tên người dùng để bỏ qua khi gửi (không gửi cho họ)
+        Gửi message (dict JSON) tới thành viên phòng room, hoặc tới tất cả
+        client đang kết nối nếu room là None.
+        - exclude: tên (hoặc tập tên) người dùng để bỏ qua khi gửi
         """
         with self.lock:
-            targets = list(self.clients.items())  # [(socket, username), ...]
+            if room is None:
+                targets = [(uname, sock) for sock, uname in self.clients.items()]
+            else:
+                # chỉ duyệt thành viên phòng, không quét mọi client
+                members = self.rooms.get(room)
+                targets = list(members.members.items()) if members else []
 
-        for sock, uname in targets:
-            if exclude and uname == exclude:
+        if isinstance(exclude, str):
+            exclude = (exclude,)
+        skip = frozenset(exclude or ())
+
+        # mã hoá một lần cho mỗi codec, mọi người nhận dùng chung frame
+        frames = PacketFrames(message)
+        for uname, sock in targets:
+            if uname in skip:
                 continue
-            try:
-                send_json(sock, message)
-            except Exception:
-                pass
+            send_frame(sock, frames.get(sock.codec))
 
-    def broadcast_system(self, text, exclude=None):
-        self.broadcast({"type": "system", "text": text}, exclude)
+    def broadcast_system(self, text, exclude=None, room=None):
+        message = {"type": "system", "text": text}
+        if room is not None:
+            message["room"] = room
+        self.broadcast(message, exclude, room)
 
-    def send_presence(self):
+    def presence_snapshot(self, room):
         with self.lock:
-            online = list(self.user_sockets.keys())
-        self.broadcast({"type": "presence", "users": online})
+            return {
+                "type": "presence",
+                "room": room.name,
+                "users": self.rooms.member_names(room),
+                "version": room.version,
+            }
+
+    def send_presence_snapshot(self, conn, room):
+        """Gửi danh sách thành viên đầy đủ của room kèm version cho một client."""
+        send_json(conn, self.presence_snapshot(room))
 
-    def send_dm(self, from_user, to_user, obj):
+    def send_presence(self, room, joined=(), left=()):
+        """
+        Phát thay đổi presence của room tới thành viên phòng (gọi khi đang
+        giữ presence_lock), một gói cho mỗi version:
+        - client có tính năng "presence_delta" nhận presence_join,
+          presence_leave, hoặc presence_delta khi có cả vào lẫn ra,
+        - client cũ nhận danh sách đầy đủ như trước.
+        """
+        with self.lock:
+            targets = list(room.members.values())
+            version = room.version
+
+        if joined and left:
+            delta = {"type": "presence_delta", "joined": list(joined), "left": list(left)}
+        elif joined:
+            delta = {"type": "presence_join", "users": list(joined)}
+        else:
+            delta = {"type": "presence_leave", "users": list(left)}
+        delta["room"] = room.name
+        delta["version"] = version
+        delta = PacketFrames(delta)
+
+        full = None
+        for conn in targets:
+            if FEATURE_PRESENCE_DELTA in conn.features:
+                send_frame(conn, delta.get(conn.codec))
+            else:
+                if full is None:
+                    full = PacketFrames(self.presence_snapshot(room))
+                send_frame(conn, full.get(conn.codec))
+
+    def send_dm(self, from_user, to_user, obj, hold=True):
         """
         Gửi tin nhắn riêng (DM) từ from_user tới to_user.
         Đồng thời gửi bản sao cho from_user để họ thấy tin đã gửi.
+        to_user chưa vào phiên ở đây: cất obj vào hộp thư nếu hold (nhiều
+        node: chỉ node hub báo là đang giữ khoá đăng nhập của to_user).
         """
         with self.lock:
             to_sock = self.user_sockets.get(to_user)
             from_sock = self.user_sockets.get(from_user)
+            # put trong lock: join_session (cũng giữ lock) xong trước thì tin
+            # đi thẳng, ngược lại tin đã nằm trong hộp thư khi deliver_mailbox
+            # đọc (với bus: frame mailbox_put tới hub trước lượt gọi đọc)
+            if to_sock is None and hold and self.mailbox is not None:
+                self.mailbox.put(to_user, obj)
 
+        frames = PacketFrames(obj)
         if to_sock:
-            try:
-                send_json(to_sock, obj)
-            except Exception:
-                pass
+            send_frame(to_sock, frames.get(to_sock.codec))
 
         if from_sock:
-            try:
-                send_json(from_sock, obj)
-            except Exception:
-                pass
+            send_frame(from_sock, frames.get(from_sock.codec))
 
 
-if __name__ == "__main__":
+def build_server(engine="thread", host="127.0.0.1", port=5555, **options):
+    """Tạo server theo engine được chọn: "thread" (mặc định) hoặc "asyncio"."""
+    if engine == "asyncio":
+        from async_server import AsyncChatServer
+
+        return AsyncChatServer(host, port, **options)
+    return ChatServer(host, port, **options)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UD Chat server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument(
+        "--engine",
+        choices=("thread", "asyncio"),
+        default="thread",
+        help="thread: mỗi kết nối một thread; asyncio: một event loop cho mọi kết nối",
+    )
+    parser.add_argument(
+        "--presence-window",
+        type=float,
+        default=DEFAULT_WINDOW,
+        help="số giây gộp sự kiện vào/ra trước khi phát presence (0 = tắt)",
+    )
+    parser.add_argument(
+        "--user-store",
+        choices=BACKENDS,
+        default="json",
+        help="nơi lưu tài khoản: users.json, nhật ký append-only hoặc SQLite WAL",
+    )
+    parser.add_argument(
+        "--user-store-path",
+        default=None,
+        help="đường dẫn file user store (mặc định theo backend)",
+    )
+    parser.add_argument(
+        "--auth-workers",
+        type=int,
+        default=None,
+        help="số process băm bcrypt (mặc định = số CPU)",
+    )
+    parser.add_argument(
+        "--auth-max-pending",
+        type=int,
+        default=DEFAULT_MAX_PENDING,
+        help="số yêu cầu băm/kiểm tra mật khẩu tối đa đang chờ",
+    )
+    parser.add_argument("--bcrypt-rounds", type=int, default=DEFAULT_ROUNDS)
+    parser.add_argument(
+        "--compress-threshold",
+        type=int,
+        default=DEFAULT_COMPRESS_THRESHOLD,
+        help="nén frame msgpack có payload từ số byte này trở lên",
+    )
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="không chấp nhận nén deflate khi client xin",
+    )
+    parser.add_argument(
+        "--message-log-dir",
+        default=LOG_DIR,
+        help="thư mục log tin nhắn (segment .log/.index)",
+    )
+    parser.add_argument(
+        "--no-message-log", action="store_true", help="không ghi log tin nhắn"
+    )
+    parser.add_argument(
+        "--segment-bytes",
+        type=int,
+        default=DEFAULT_SEGMENT_BYTES,
+        help="kích thước tối đa một segment log trước khi mở segment mới",
+    )
+    parser.add_argument(
+        "--retain-bytes",
+        type=int,
+        default=DEFAULT_RETAIN_BYTES,
+        help="tổng dung lượng log giữ lại, xoá segment cũ nhất khi vượt (0 = không giới hạn)",
+    )
+    parser.add_argument(
+        "--retain-hours",
+        type=float,
+        default=0,
+        help="xoá segment cũ hơn số giờ này (0 = không giới hạn)",
+    )
+    parser.add_argument(
+        "--history-size",
+        type=int,
+        default=DEFAULT_CAPACITY,
+        help="số tin gần nhất giữ trong RAM cho gói history",
+    )
+    parser.add_argument(
+        "--history-on-join",
+        type=int,
+        default=DEFAULT_JOIN_LIMIT,
+        help="số tin lịch sử gửi kèm khi đăng nhập (0 = không gửi)",
+    )
+    parser.add_argument(
+        "--no-search", action="store_true", help="không dựng chỉ mục tìm kiếm"
+    )
+    parser.add_argument(
+        "--mailbox-path",
+        default=MAILBOX_FILE,
+        help="file SQLite giữ DM cho người offline",
+    )
+    parser.add_argument(
+        "--no-mailbox", action="store_true", help="không giữ DM cho người offline"
+    )
+    parser.add_argument(
+        "--mailbox-size",
+        type=int,
+        default=DEFAULT_MAX_MESSAGES,
+        help="số DM tối đa chờ trong hộp thư mỗi người, vượt thì bỏ tin cũ nhất",
+    )
+    parser.add_argument(
+        "--mailbox-days",
+        type=float,
+        default=DEFAULT_MAX_DAYS,
+        help="xoá DM chờ quá số ngày này (0 = không giới hạn)",
+    )
+    parser.add_argument(
+        "--resume-window",
+        type=float,
+        default=DEFAULT_RESUME_WINDOW,
+        help="số giây giữ phiên đã rớt kết nối chờ client resume (0 = tắt)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="số tiến trình worker cùng lắng nghe cổng (SO_REUSEPORT, xem workers.py)",
+    )
+    parser.add_argument(
+        "--bus",
+        help="tham gia cụm: địa chỉ hub (host:port hoặc Unix socket) chạy bằng bus.py",
+    )
+    parser.add_argument(
+        "--bus-secret-file",
+        help="file chứa shared secret của cụm (mặc định đọc biến môi trường UDCHAT_BUS_SECRET)",
+    )
+    parser.add_argument(
+        "--loopback-nodes",
+        type=int,
+        default=0,
+        help="chạy thử cụm N node trong một tiến trình (cổng port..port+N-1)",
+    )
+    parser.add_argument(
+        "--outbound-limit",
+        type=int,
+        default=DEFAULT_LIMIT,
+        help="số frame tối đa trong hàng đợi gửi của mỗi client",
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        choices=POLICIES,
+        default=DROP_OLDEST,
+        help="xử lý khi hàng đợi gửi đầy",
+    )
+    parser.add_argument(
+        "--flush-window-ms",
+        type=float,
+        default=DEFAULT_FLUSH_WINDOW * 1000,
+        help="ms writer chờ gom thêm frame vào cùng một lần ghi (0 = chỉ gom frame đã chờ sẵn)",
+    )
+    parser.add_argument(
+        "--write-budget",
+        type=int,
+        default=DEFAULT_WRITE_BUDGET,
+        help="số byte tối đa gộp vào một lần ghi socket",
+    )
+    parser.add_argument(
+        "--no-nodelay", action="store_true", help="không bật TCP_NODELAY (để Nagle gộp gói)"
+    )
+    parser.add_argument(
+        "--writer-threads",
+        type=int,
+        default=DEFAULT_WRITER_THREADS,
+        help="engine thread: số thread ghi dùng chung (0 = mỗi kết nối một writer thread)",
+    )
+    args = parser.parse_args(argv)
+
     print("=" * 50)
     print(f"CHAT SERVER v{__version__} (register/login + public + DM)")
+    print(f"Engine: {args.engine}")
     print("=" * 50)
-    server = ChatServer()
+    options = dict(
+        outbound_limit=args.outbound_limit,
+        overflow_policy=args.overflow_policy,
+        flush_window=args.flush_window_ms / 1000,
+        write_budget=args.write_budget,
+        nodelay=not args.no_nodelay,
+        writer_threads=args.writer_threads,
+        presence_window=args.presence_window,
+        user_store=args.user_store,
+        user_store_path=args.user_store_path,
+        auth_workers=args.auth_workers,
+        auth_max_pending=args.auth_max_pending,
+        bcrypt_rounds=args.bcrypt_rounds,
+        compression=not args.no_compression,
+        compress_threshold=args.compress_threshold,
+        message_log_dir=None if args.no_message_log else args.message_log_dir,
+        segment_bytes=args.segment_bytes,
+        retain_bytes=args.retain_bytes,
+        retain_hours=args.retain_hours,
+        history_size=args.history_size,
+        history_on_join=args.history_on_join,
+        search=not args.no_search,
+        mailbox_path=None if args.no_mailbox else args.mailbox_path,
+        mailbox_size=args.mailbox_size,
+        mailbox_days=args.mailbox_days,
+        resume_window=args.resume_window,
+    )
+    if args.loopback_nodes:
+        from workers import run_loopback
+
+        run_loopback(args.engine, args.host, args.port, args.loopback_nodes, options)
+        return
+    bus_secret = None
+    if args.bus:
+        from bus import load_secret
+
+        bus_secret = load_secret(args.bus_secret_file)
+        if not bus_secret:
+            parser.error("--bus cần shared secret: --bus-secret-file hoặc UDCHAT_BUS_SECRET")
+    if args.workers > 1:
+        from workers import run_supervisor
+
+        run_supervisor(
+            args.engine, args.host, args.port, args.workers, options, args.bus, bus_secret
+        )
+        return
+    if args.bus:
+        from workers import _shared_user_store, run_worker
+
+        options = _shared_user_store(options)
+        run_worker(
+            args.engine, args.host, args.port, options, args.bus,
+            reuse_port=False, secret=bus_secret,
+        )
+        return
+
+    server = build_server(args.engine, args.host, args.port, **options)
     try:
         server.start()
     except KeyboardInterrupt:
@@ -372,3 +1728,7 @@ if __name__ == "__main__":
         server.shutdown()
     finally:
         print("[SERVER] Đã tắt xong.")
+
+
+if __name__ == "__main__":
+    main()
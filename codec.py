@@ -0,0 +1,422 @@
+# codec.py
+"""
+Mã hoá gói tin trên dây.
+
+- "json" (mặc định): JSON Lines, mỗi gói một dòng UTF-8 kết thúc bằng '\n'.
+- "msgpack": frame nhị phân = 4 byte độ dài payload (big-endian) + payload
+  MessagePack.
+
+Client xin mã hoá nhị phân bằng "encoding": "msgpack" trong gói login. Nếu
+server chấp nhận, login_result (vẫn là JSON) mang "encoding": "msgpack" và
+từ gói kế tiếp cả hai chiều dùng frame nhị phân. Client cũ không gửi trường
+này nên vẫn dùng JSON Lines như trước.
+
+Dùng thư viện msgpack (C) nếu đã cài; không có thì dùng bản pure-Python
+trong file này, chỉ hỗ trợ các kiểu giao thức cần: None, bool, int, float,
+str, bytes, list/tuple, dict.
+
+Nén (chỉ với frame nhị phân): client thêm "compression": "deflate" trong
+gói login. Frame có payload từ ngưỡng trở lên được nén raw deflate với một
+preset dictionary cố định (PRESET_DICT) mà hai phía cùng biết; bit cao nhất
+của header độ dài đánh dấu frame nén. Mỗi frame nén độc lập nên một frame
+broadcast được nén một lần rồi dùng chung cho mọi người nhận.
+"""
+import json
+import struct
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:  # tuỳ chọn: pip install msgpack
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+DEFLATE = "deflate"
+
+# header frame nhị phân: độ dài payload, bit cao nhất = payload đã nén
+FRAME_HEADER = struct.Struct("!I")
+FLAG_COMPRESSED = 0x80000000
+LENGTH_MASK = 0x7FFFFFFF
+
+DEFAULT_COMPRESS_THRESHOLD = 512  # byte payload; nhỏ hơn thì gửi thô
+COMPRESS_LEVEL = 6
+MAX_INFLATED = 1024 * 1024  # chặn "zip bomb" khi giải nén frame từ mạng
+
+
+def split_header(value):
+    """Tách giá trị header thành (độ dài payload, có nén hay không)."""
+    return value & LENGTH_MASK, bool(value & FLAG_COMPRESSED)
+
+
+# =====================================================
+# MessagePack pure-Python (fallback)
+# =====================================================
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_U64 = struct.Struct("!Q")
+_I8 = struct.Struct("!b")
+_I16 = struct.Struct("!h")
+_I32 = struct.Struct("!i")
+_I64 = struct.Struct("!q")
+_F32 = struct.Struct("!f")
+_F64 = struct.Struct("!d")
+
+
+def _pack_len(out, n, fix, fix_max, op8, op16, op32):
+    if n <= fix_max:
+        out.append(fix | n)
+    elif op8 is not None and n <= 0xFF:
+        out.append(op8)
+        out.append(n)
+    elif n <= 0xFFFF:
+        out.append(op16)
+        out += _U16.pack(n)
+    elif n <= 0xFFFFFFFF:
+        out.append(op32)
+        out += _U32.pack(n)
+    else:
+        raise ValueError("Đối tượng quá lớn cho MessagePack")
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif isinstance(obj, int):
+        if 0 <= obj <= 0x7F:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xFF)
+        elif obj > 0:
+            if obj <= 0xFF:
+                out.append(0xCC)
+                out.append(obj)
+            elif obj <= 0xFFFF:
+                out.append(0xCD)
+                out += _U16.pack(obj)
+            elif obj <= 0xFFFFFFFF:
+                out.append(0xCE)
+                out += _U32.pack(obj)
+            else:
+                out.append(0xCF)
+                out += _U64.pack(obj)
+        elif obj >= -0x80:
+            out.append(0xD0)
+            out += _I8.pack(obj)
+        elif obj >= -0x8000:
+            out.append(0xD1)
+            out += _I16.pack(obj)
+        elif obj >= -0x80000000:
+            out.append(0xD2)
+            out += _I32.pack(obj)
+        else:
+            out.append(0xD3)
+            out += _I64.pack(obj)
+    elif isinstance(obj, float):
+        out.append(0xCB)
+        out += _F64.pack(obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        _pack_len(out, len(data), 0xA0, 31, 0xD9, 0xDA, 0xDB)
+        out += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        _pack_len(out, len(data), 0, -1, 0xC4, 0xC5, 0xC6)
+        out += data
+    elif isinstance(obj, (list, tuple)):
+        _pack_len(out, len(obj), 0x90, 15, None, 0xDC, 0xDD)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        _pack_len(out, len(obj), 0x80, 15, None, 0xDE, 0xDF)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"Không mã hoá được kiểu {type(obj).__name__}")
+
+
+def packb(obj):
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _unpack(data, pos):
+    """Giải mã một đối tượng tại pos, trả về (obj, vị trí kế tiếp)."""
+    b = data[pos]
+    pos += 1
+    if b <= 0x7F:
+        return b, pos
+    if b >= 0xE0:
+        return b - 0x100, pos
+    if 0xA0 <= b <= 0xBF:
+        return _str(data, pos, b & 0x1F)
+    if 0x90 <= b <= 0x9F:
+        return _array(data, pos, b & 0x0F)
+    if 0x80 <= b <= 0x8F:
+        return _map(data, pos, b & 0x0F)
+    if b == 0xC0:
+        return None, pos
+    if b == 0xC2:
+        return False, pos
+    if b == 0xC3:
+        return True, pos
+    fmt = _FIXED.get(b)
+    if fmt is not None:
+        return fmt.unpack_from(data, pos)[0], pos + fmt.size
+    sized = _SIZED.get(b)
+    if sized is None:
+        raise ValueError(f"Byte MessagePack không hỗ trợ: 0x{b:02x}")
+    size_fmt, read = sized
+    n = size_fmt.unpack_from(data, pos)[0]
+    return read(data, pos + size_fmt.size, n)
+
+
+def _str(data, pos, n):
+    end = pos + n
+    if end > len(data):
+        raise ValueError("MessagePack bị cắt cụt")
+    return str(data[pos:end], "utf-8"), end
+
+
+def _bin(data, pos, n):
+    end = pos + n
+    if end > len(data):
+        raise ValueError("MessagePack bị cắt cụt")
+    return bytes(data[pos:end]), end
+
+
+def _array(data, pos, n):
+    items = []
+    for _ in range(n):
+        item, pos = _unpack(data, pos)
+        items.append(item)
+    return items, pos
+
+
+def _map(data, pos, n):
+    obj = {}
+    for _ in range(n):
+        key, pos = _unpack(data, pos)
+        value, pos = _unpack(data, pos)
+        obj[key] = value
+    return obj, pos
+
+
+_FIXED = {
+    0xCA: _F32, 0xCB: _F64,
+    0xCC: _U8, 0xCD: _U16, 0xCE: _U32, 0xCF: _U64,
+    0xD0: _I8, 0xD1: _I16, 0xD2: _I32, 0xD3: _I64,
+}
+_SIZED = {
+    0xD9: (_U8, _str), 0xDA: (_U16, _str), 0xDB: (_U32, _str),
+    0xC4: (_U8, _bin), 0xC5: (_U16, _bin), 0xC6: (_U32, _bin),
+    0xDC: (_U16, _array), 0xDD: (_U32, _array),
+    0xDE: (_U16, _map), 0xDF: (_U32, _map),
+}
+
+
+def unpackb(data):
+    data = memoryview(data)
+    try:
+        obj, pos = _unpack(data, 0)
+    except (IndexError, struct.error) as e:
+        raise ValueError(f"MessagePack bị cắt cụt: {e}") from None
+    if pos != len(data):
+        raise ValueError("Thừa dữ liệu sau đối tượng MessagePack")
+    return obj
+
+
+# =====================================================
+# NÉN DEFLATE
+# =====================================================
+def _preset_dictionary():
+    """
+    Dictionary chứa các chuỗi lặp lại của giao thức (tên trường, loại gói)
+    ở dạng MessagePack. Phải giống hệt nhau ở client và server: đổi nội dung
+    thì phải đổi tên thuật toán nén ("deflate") để không lệch phiên bản.
+    """
+    samples = [
+        {"type": "presence_leave", "users": [""], "version": 0},
+        {"type": "presence_delta", "joined": [""], "left": [""], "version": 0},
+        {"type": "presence_join", "users": [""], "version": 0},
+        {"type": "presence", "users": [""], "version": 0},
+        {"type": "system", "text": " đã tham gia phòng chat!"},
+        {"type": "system", "text": " đã rời khỏi phòng chat!"},
+        {"type": "dm", "from": "", "to": "", "text": "", "ts": "00:00:00"},
+        {"type": "chat", "from": "", "text": "", "ts": "00:00:00"},
+    ]
+    # bản pure-Python cho kết quả giống hệt thư viện msgpack
+    return b"".join(packb(sample) for sample in samples)
+
+
+PRESET_DICT = _preset_dictionary()
+
+
+class Deflate:
+    """
+    Nén raw deflate với PRESET_DICT, mỗi frame độc lập.
+    Ghi số liệu vào metrics (nếu có):
+    - compression.frames / compression.skipped: số frame nén / bỏ qua,
+    - compression.bytes_in / bytes_out / bytes_saved: trước và sau nén,
+    - compression.cpu_s, compression.inflate_cpu_s: CPU mỗi lần nén/giải nén.
+    """
+
+    name = DEFLATE
+
+    def __init__(self, threshold=DEFAULT_COMPRESS_THRESHOLD, level=COMPRESS_LEVEL, metrics=None):
+        self.threshold = threshold
+        self.level = level
+        self.metrics = metrics
+
+    def compress(self, payload):
+        """Trả về payload đã nén, hoặc None nếu không đáng nén."""
+        if len(payload) < self.threshold:
+            return None
+        started = time.thread_time()
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=PRESET_DICT)
+        data = comp.compress(payload) + comp.flush()
+        spent = time.thread_time() - started
+        if self.metrics is not None:
+            self.metrics.observe("compression.cpu_s", spent)
+        if len(data) >= len(payload):
+            self._count("compression.skipped")
+            return None
+        if self.metrics is not None:
+            self.metrics.incr("compression.frames")
+            self.metrics.incr("compression.bytes_in", len(payload))
+            self.metrics.incr("compression.bytes_out", len(data))
+            self.metrics.incr("compression.bytes_saved", len(payload) - len(data))
+        return data
+
+    def decompress(self, data, limit=MAX_INFLATED):
+        started = time.thread_time()
+        decomp = zlib.decompressobj(-15, zdict=PRESET_DICT)
+        try:
+            payload = decomp.decompress(data, limit)
+        except zlib.error as e:
+            raise ValueError(f"Frame nén hỏng: {e}") from None
+        if decomp.unconsumed_tail:
+            raise ValueError(f"Frame giải nén vượt {limit} byte")
+        if not decomp.eof:
+            raise ValueError("Frame nén bị cắt cụt")
+        if self.metrics is not None:
+            self.metrics.observe("compression.inflate_cpu_s", time.thread_time() - started)
+        return payload
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+
+# =====================================================
+# CODECS
+# =====================================================
+def _invalid(payload):
+    text = bytes(payload[:50]).decode("utf-8", errors="replace")
+    return {"type": "system", "text": f"Gói tin không hợp lệ: {text}..."}
+
+
+def _as_packet(obj):
+    if not isinstance(obj, dict):
+        return {"type": "system", "text": "Gói tin phải là JSON object"}
+    return obj
+
+
+class JsonCodec:
+    """JSON Lines: mỗi frame là một dòng UTF-8."""
+
+    name = JSON
+    binary = False
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+
+    def encode(self, obj):
+        return (json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def decode(self, line):
+        try:
+            # giao thức cố định UTF-8: bỏ bước dò encoding của json.loads(bytes)
+            packet = self._decoder.decode(str(line, "utf-8"))
+        except ValueError:  # JSONDecodeError hoặc UTF-8 hỏng
+            text = bytes(line[:50]).decode("utf-8", errors="replace")
+            return {"type": "system", "text": f"JSON không hợp lệ: {text}..."}
+        return _as_packet(packet)
+
+
+class MsgpackCodec:
+    """
+    Frame nhị phân: FRAME_HEADER (độ dài) + payload MessagePack.
+    compression (vd. Deflate) chỉ đặt khi phiên đã thương lượng nén.
+    """
+
+    name = MSGPACK
+    binary = True
+
+    def __init__(self, native=msgpack is not None, compression=None):
+        self.native = native
+        self.compression = compression
+        if native:
+            self._packb = lambda obj: msgpack.packb(obj, use_bin_type=True)
+            self._unpackb = lambda data: msgpack.unpackb(data, raw=False)
+        else:
+            self._packb = packb
+            self._unpackb = unpackb
+
+    def encode(self, obj):
+        payload = self._packb(obj)
+        if self.compression is not None:
+            data = self.compression.compress(payload)
+            if data is not None:
+                return FRAME_HEADER.pack(len(data) | FLAG_COMPRESSED) + data
+        return FRAME_HEADER.pack(len(payload)) + payload
+
+    def decode(self, payload, compressed=False):
+        try:
+            if compressed:
+                if self.compression is None:
+                    return {"type": "system", "text": "Frame nén khi chưa thương lượng nén"}
+                payload = self.compression.decompress(payload)
+            packet = self._unpackb(payload)
+        except (ValueError, TypeError):
+            return _invalid(payload)
+        return _as_packet(packet)
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec()
+CODECS = {JSON: JSON_CODEC, MSGPACK: MSGPACK_CODEC}
+
+
+def get_codec(name):
+    """Codec theo tên; tên lạ trả về JSON (mặc định cho client cũ)."""
+    return CODECS.get(name, JSON_CODEC)
+
+
+class PacketFrames:
+    """
+    Frame của một gói theo từng codec, mã hoá lười và chỉ một lần cho mỗi
+    codec: broadcast tới người nhận JSON lẫn msgpack vẫn chỉ tốn tối đa
+    hai lần tuần tự hoá.
+    """
+
+    __slots__ = ("packet", "_frames")
+
+    def __init__(self, packet):
+        self.packet = packet
+        self._frames = {}
+
+    def get(self, codec):
+        # codec là đối tượng: msgpack thường và msgpack có nén là hai frame khác nhau
+        data = self._frames.get(codec)
+        if data is None:
+            data = self._frames[codec] = codec.encode(self.packet)
+        return data
@@ -0,0 +1,185 @@
+# dm_mailbox.py
+"""
+Hộp thư DM cho người dùng offline (store-and-forward).
+
+DM gửi tới người đang offline được lưu vào hộp thư bền vững của người nhận
+(SQLite chế độ WAL, file mailbox.db) và được chuyển khi họ đăng nhập lại
+(xem ChatServer.deliver_mailbox): gửi theo từng trang, trang sau chỉ gửi
+khi trang trước đã ghi xong xuống socket, và chỉ xoá khỏi hộp thư những tin
+đã gửi đi. Người có hàng nghìn tin chờ vì vậy không làm chậm đăng nhập và
+không bị dồn cả nghìn frame một lúc.
+
+Giới hạn mỗi hộp thư:
+- max_messages: vượt thì bỏ tin cũ nhất,
+- max_age: tin cũ hơn bị xoá (dọn định kỳ và bỏ qua khi đọc).
+
+put() chỉ xếp hàng rồi trả về ngay (không chặn event loop/broadcast); một
+thread committer ghi theo lô, một transaction cho mỗi lô (group commit).
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+MAILBOX_FILE = "mailbox.db"
+DEFAULT_MAX_MESSAGES = 1000
+DEFAULT_MAX_DAYS = 30
+DEFAULT_MAX_BATCH = 1024
+EXPIRE_EVERY = 60.0  # giây giữa hai lần dọn tin quá hạn
+PAGE_SIZE = 50
+
+
+class Mailbox:
+    def __init__(
+        self,
+        path=MAILBOX_FILE,
+        max_messages=DEFAULT_MAX_MESSAGES,
+        max_age=DEFAULT_MAX_DAYS * 86400,
+        max_batch=DEFAULT_MAX_BATCH,
+        metrics=None,
+    ):
+        self.path = Path(path)
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.max_batch = max_batch
+        self.metrics = metrics
+
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS mailbox ("
+            " username TEXT NOT NULL, id INTEGER NOT NULL, ts REAL NOT NULL,"
+            " packet TEXT NOT NULL, PRIMARY KEY (username, id)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        self._last_expire = 0.0
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._queued = 0      # số tin đã put
+        self._committed = 0   # số tin đã ghi xong
+        self._closed = False
+        self._thread = threading.Thread(target=self._commit_loop, daemon=True)
+        self._thread.start()
+
+    # =====================================================
+    # GHI
+    # =====================================================
+    def put(self, username, packet):
+        """Xếp DM (đã có "id") vào hộp thư của username. Không chặn."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Mailbox đã đóng")
+            self._pending.append((username, packet, time.time()))
+            self._queued += 1
+            self._cond.notify()
+        self._count("mailbox.queued")
+
+    def flush(self, timeout=None):
+        """Chờ tới khi mọi tin đã put đều đã ghi xuống đĩa."""
+        with self._cond:
+            target = self._queued
+            return self._cond.wait_for(lambda: self._committed >= target, timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._db_lock:
+            self._db.close()
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+
+            t0 = time.perf_counter()
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                print(f"[MAILBOX] Lỗi ghi {len(batch)} tin: {e}")
+            if self.metrics is not None:
+                self.metrics.observe("mailbox.commit_batch", len(batch))
+                self.metrics.observe("mailbox.commit_s", time.perf_counter() - t0)
+            with self._cond:
+                self._committed += len(batch)
+                self._cond.notify_all()
+
+    def _write_batch(self, batch):
+        rows = [
+            (username, packet["id"], ts, json.dumps(packet, ensure_ascii=False))
+            for username, packet, ts in batch
+        ]
+        users = {username for username, _, _ in batch}
+        dropped = 0
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO mailbox (username, id, ts, packet)"
+                " VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            # hộp thư đầy: bỏ tin cũ nhất
+            for username in users:
+                dropped += self._db.execute(
+                    "DELETE FROM mailbox WHERE username = ? AND id NOT IN ("
+                    " SELECT id FROM mailbox WHERE username = ?"
+                    " ORDER BY id DESC LIMIT ?)",
+                    (username, username, self.max_messages),
+                ).rowcount
+            now = time.time()
+            if self.max_age and now - self._last_expire >= EXPIRE_EVERY:
+                self._last_expire = now
+                expired = self._db.execute(
+                    "DELETE FROM mailbox WHERE ts < ?", (now - self.max_age,)
+                ).rowcount
+                self._count("mailbox.expired", expired)
+        self._count("mailbox.dropped", dropped)
+
+    # =====================================================
+    # ĐỌC / XOÁ
+    # =====================================================
+    def fetch(self, username, after_id=0, limit=PAGE_SIZE):
+        """Tối đa limit tin có id > after_id (tăng dần) trong hộp thư."""
+        self.flush()
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT packet FROM mailbox WHERE username = ? AND id > ?"
+                " AND ts >= ? ORDER BY id LIMIT ?",
+                (username, after_id, self._cutoff(), limit),
+            ).fetchall()
+        return [json.loads(packet) for (packet,) in rows]
+
+    def count(self, username):
+        self.flush()
+        with self._db_lock:
+            (n,) = self._db.execute(
+                "SELECT COUNT(*) FROM mailbox WHERE username = ? AND ts >= ?",
+                (username, self._cutoff()),
+            ).fetchone()
+        return n
+
+    def ack(self, username, upto_id, first_id=0):
+        """Xoá các tin first_id <= id <= upto_id (đã chuyển tới người nhận)."""
+        self.flush()
+        with self._db_lock, self._db:
+            n = self._db.execute(
+                "DELETE FROM mailbox WHERE username = ? AND id BETWEEN ? AND ?",
+                (username, first_id, upto_id),
+            ).rowcount
+        self._count("mailbox.delivered", n)
+
+    def _cutoff(self):
+        return time.time() - self.max_age if self.max_age else 0.0
+
+    def _count(self, name, n=1):
+        if self.metrics is not None and n:
+            self.metrics.incr(name, n)
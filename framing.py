@@ -0,0 +1,213 @@
+# framing.py
+"""
+Đọc gói từ socket cho cả server và client.
+
+FrameReader giữ một bytearray cho suốt vòng đời kết nối và đọc bằng
+recv_into() qua memoryview, nên:
+- không tạo file object (makefile) mới cho mỗi giai đoạn register/login/
+  chat — byte đã đọc trước không bao giờ bị mất giữa các giai đoạn,
+- mọi dòng hoàn chỉnh trong một lần recv được tách bằng một lần split()
+  (chạy trong C) thay vì readline() từng dòng qua TextIOWrapper,
+- không strip() tạo thêm bản sao; decode UTF-8 rồi parse thẳng,
+- dòng dài hơn max_line bị từ chối (FrameTooLarge) thay vì phình bộ nhớ.
+
+Buffer bắt đầu nhỏ (RECV_SIZE) và chỉ nới ra (gấp đôi, tối đa max_line +
+header) khi một dòng/frame chưa trọn đã lấp đầy nó. Mỗi lần recv vì vậy
+chỉ tách ra vài chục dòng, đỉnh bộ nhớ của reader ngang makefile thay vì
+giữ sẵn buffer 64 KB cùng hàng trăm dòng đã tách (xem bench_framing.py).
+
+Sau khi đăng nhập có thể chuyển sang frame nhị phân (set_codec, xem
+codec.py): frame được giải mã thẳng từ memoryview trên buffer, không copy.
+
+StreamPacketReader là bản asyncio (trên StreamReader) cùng định dạng, dùng
+cho engine asyncio của server và client asyncio (chat_sdk.py).
+"""
+import asyncio
+
+from codec import FRAME_HEADER, JSON_CODEC, split_header
+
+MAX_LINE = 64 * 1024
+RECV_SIZE = 8 * 1024  # kích thước buffer ban đầu; nới dần tới max_line khi cần
+
+
+class FrameTooLarge(ValueError):
+    """Gói vượt quá kích thước tối đa cho phép."""
+
+
+# giữ tên cũ cho engine asyncio / code ngoài
+parse_json_line = JSON_CODEC.decode
+
+
+class FrameReader:
+    """
+    Iterator gói tin trên một socket (JSON Lines hoặc frame nhị phân).
+    Dùng một reader cho toàn bộ kết nối: next(reader, None) lấy gói kế tiếp,
+    `for packet in reader` đọc tiếp từ đúng chỗ đã dừng.
+    """
+
+    def __init__(self, sock, max_line=MAX_LINE, codec=JSON_CODEC):
+        self.sock = sock
+        self.max_line = max_line
+        self.codec = codec
+        # tối đa: đủ chỗ cho một dòng max_line + '\n' hoặc header + payload
+        self.limit = max_line + FRAME_HEADER.size + 1
+        self.buf = bytearray(min(RECV_SIZE, self.limit))
+        self.view = memoryview(self.buf)
+        self.start = 0  # byte đầu tiên chưa trả cho người đọc
+        self.end = 0    # cuối dữ liệu hợp lệ trong buf
+        self.eof = False
+        # các dòng đã tách sẵn từ một lần recv (tách bằng split() trong C)
+        self.lines = []
+        self.index = 0
+
+    def __iter__(self):
+        return self
+
+    def set_codec(self, codec):
+        """Đổi cách đọc từ byte kế tiếp (vd. sang msgpack sau login_result)."""
+        self.codec = codec
+        # bỏ các dòng đã tách sẵn; self.start đã trỏ đúng byte chưa đọc
+        self.lines = []
+        self.index = 0
+
+    def __next__(self):
+        if self.codec.binary:
+            frame = self.read_frame()
+            if frame is None:
+                raise StopIteration
+            payload, compressed = frame
+            return self.codec.decode(payload, compressed)
+        while True:
+            line = self.read_line()
+            if line is None:
+                raise StopIteration
+            if line and not line.isspace():
+                return self.codec.decode(line)
+
+    def read_frame(self):
+        """
+        Trả về (payload, compressed) của frame nhị phân kế tiếp — payload là
+        memoryview trên buffer, chỉ hợp lệ tới lần đọc sau — hoặc None khi
+        hết dữ liệu.
+        """
+        header = FRAME_HEADER.size
+        while True:
+            available = self.end - self.start
+            if available >= header:
+                n, compressed = split_header(
+                    FRAME_HEADER.unpack_from(self.buf, self.start)[0]
+                )
+                if n > self.max_line:
+                    raise FrameTooLarge(f"Frame dài hơn {self.max_line} byte")
+                if available >= header + n:
+                    begin = self.start + header
+                    self.start = begin + n
+                    return self.view[begin:self.start], compressed
+            if self.eof:
+                return None  # frame dở dang khi đóng kết nối: bỏ qua
+            self._fill()
+
+    def read_line(self):
+        """Trả về một dòng (không gồm '\n') hoặc None khi hết dữ liệu."""
+        while True:
+            if self.index < len(self.lines):
+                line = self.lines[self.index]
+                self.index += 1
+                self.start += len(line) + 1
+                return line
+
+            last = self.buf.rfind(b"\n", self.start, self.end)
+            if last >= 0:
+                # tách mọi dòng hoàn chỉnh trong buffer bằng một lần split()
+                self.lines = self.buf[self.start:last].split(b"\n")
+                self.index = 0
+                continue
+
+            if self.end - self.start > self.max_line:
+                raise FrameTooLarge(f"Dòng dài hơn {self.max_line} byte")
+            if self.eof:
+                if self.start < self.end:
+                    line = bytes(self.view[self.start:self.end])
+                    self.start = self.end
+                    return line
+                return None
+            self._fill()
+
+    def _fill(self):
+        # dồn phần dư lên đầu buffer khi hết chỗ phía sau
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            remaining = self.end - self.start
+            if remaining == len(self.buf):
+                self._grow()
+            else:
+                # copy phần dư (ngắn) trước: nguồn và đích chồng lên nhau
+                self.buf[:remaining] = bytes(self.view[self.start:self.end])
+                self.start, self.end = 0, remaining
+        n = self.sock.recv_into(self.view[self.end:])
+        if n == 0:
+            self.eof = True
+        self.end += n
+
+    def _grow(self):
+        """Buffer đầy một dòng/frame chưa trọn: cấp buffer gấp đôi (tới limit)."""
+        remaining = self.end - self.start
+        if remaining >= self.limit:
+            raise FrameTooLarge(f"Gói dài hơn {self.max_line} byte")
+        # buffer mới thay vì resize: payload trả trước đó vẫn trỏ vào buffer cũ
+        buf = bytearray(min(max(2 * len(self.buf), remaining + 1), self.limit))
+        buf[:remaining] = self.view[self.start:self.end]
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.start, self.end = 0, remaining
+
+
+class StreamPacketReader:
+    """
+    Phiên bản async của FrameReader trên asyncio.StreamReader:
+    - JSON Lines: bỏ qua dòng rỗng, JSON không hợp lệ thành gói hệ thống,
+    - frame nhị phân (sau set_codec): đọc header độ dài rồi payload.
+    """
+
+    def __init__(self, reader, codec=JSON_CODEC):
+        self.reader = reader
+        self.codec = codec
+
+    def set_codec(self, codec):
+        self.codec = codec
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            if self.codec.binary:
+                header = await self.reader.readexactly(FRAME_HEADER.size)
+                n, compressed = split_header(FRAME_HEADER.unpack(header)[0])
+                if n > MAX_LINE:
+                    raise FrameTooLarge(f"Frame dài hơn {MAX_LINE} byte")
+                payload = await self.reader.readexactly(n)
+                return self.codec.decode(payload, compressed)
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    raise StopAsyncIteration
+                if not line.isspace():
+                    return self.codec.decode(line)
+        except asyncio.IncompleteReadError:
+            # kết nối đóng giữa chừng một frame
+            raise StopAsyncIteration from None
+
+
+def aiter_json_lines(reader):
+    """Giữ tên cũ: reader gói JSON Lines (có thể chuyển codec sau login)."""
+    return StreamPacketReader(reader)
+
+
+async def next_packet(packets):
+    """Lấy gói kế tiếp (tương đương next(it, None) cho async generator)."""
+    try:
+        return await packets.__anext__()
+    except StopAsyncIteration:
+        return None
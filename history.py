@@ -0,0 +1,79 @@
+# history.py
+"""
+Lịch sử tin nhắn cho gói "history".
+
+HistoryBuffer là ring buffer các tin gần nhất trong RAM. Id tin liên tục
+(mỗi chat/dm một id), nên tin id nằm ở ô id % capacity: tra cứu O(1), không
+cần tìm kiếm. Tin cũ hơn ring buffer được đọc từ message log trên đĩa
+(xem ChatServer.load_message).
+
+Kết quả được gửi thành nhiều trang có giới hạn (số tin và ước lượng byte)
+để mỗi frame luôn nhỏ hơn giới hạn của FrameReader.
+"""
+import threading
+
+from rooms import DEFAULT_ROOM
+
+DEFAULT_CAPACITY = 1000
+DEFAULT_JOIN_LIMIT = 50   # số tin gửi kèm khi đăng nhập
+MAX_LIMIT = 200           # số tin tối đa cho một yêu cầu history
+SCAN_LIMIT = 5000         # số id tối đa duyệt cho một yêu cầu (bỏ qua DM người khác)
+PAGE_SIZE = 50
+PAGE_BYTES = 32 * 1024
+
+
+class HistoryBuffer:
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._slots = [None] * capacity
+        self._lock = threading.Lock()
+        self.last_id = 0
+
+    def add(self, packet):
+        """Thêm tin đã có "id" (id tăng dần)."""
+        msg_id = packet["id"]
+        with self._lock:
+            self._slots[msg_id % self.capacity] = packet
+            if msg_id > self.last_id:
+                self.last_id = msg_id
+
+    def get(self, msg_id):
+        """Tin có id msg_id nếu còn trong ring buffer, ngược lại None."""
+        packet = self._slots[msg_id % self.capacity]
+        if packet is not None and packet["id"] == msg_id:
+            return packet
+        return None
+
+    @property
+    def first_id(self):
+        return max(1, self.last_id - self.capacity + 1)
+
+
+def visible_to(packet, username, rooms=None, dms=True):
+    """
+    DM chỉ người gửi/người nhận thấy (và chỉ khi dms=True). Tin trong phòng
+    chỉ hiện nếu phòng thuộc rooms (rooms=None: không lọc theo phòng); tin
+    cũ chưa có "room" thuộc phòng mặc định.
+    """
+    if packet.get("type") == "dm":
+        return dms and username in (packet.get("from"), packet.get("to"))
+    return rooms is None or packet.get("room", DEFAULT_ROOM) in rooms
+
+
+def paginate(messages, page_size=PAGE_SIZE, page_bytes=PAGE_BYTES):
+    """Chia danh sách tin thành các trang theo số tin và ước lượng byte."""
+    pages = []
+    page = []
+    size = 0
+    for packet in messages:
+        # ước lượng thô: UTF-8 tối đa 3 byte/ký tự + phần khung gói
+        cost = 3 * len(str(packet.get("text", ""))) + 128
+        if page and (len(page) >= page_size or size + cost > page_bytes):
+            pages.append(page)
+            page = []
+            size = 0
+        page.append(packet)
+        size += cost
+    if page or not pages:
+        pages.append(page)
+    return pages
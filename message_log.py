@@ -0,0 +1,496 @@
+# message_log.py
+"""
+Nhật ký tin nhắn append-only, chia segment, cho server.
+
+Mỗi gói chat/dm server chuyển tiếp được gán một id tăng dần (bắt đầu từ 1)
+và ghi vào thư mục log:
+
+    <base_id>.log    dữ liệu: mỗi tin một dòng JSON (gói kèm "id")
+    <base_id>.index  chỉ mục: mỗi tin một entry cố định (offset, thời gian)
+
+base_id là id của tin đầu tiên trong segment, nên entry của tin id nằm ở
+vị trí (id - base_id) * INDEX_ENTRY.size: tra theo id là O(1) qua mmap,
+tra theo thời gian là tìm nhị phân trên chỉ mục (thời gian tăng dần).
+
+append() chỉ gán id và xếp hàng rồi trả về ngay; một thread committer gom
+các tin thành lô, ghi + fsync một lần (group commit) nên đường broadcast
+không phải chờ ổ đĩa. Segment đầy (--segment-bytes hoặc hết chỗ chỉ mục)
+thì đóng lại và mở segment mới; segment cũ bị xoá theo tổng dung lượng
+(--retain-bytes) hoặc tuổi (--retain-hours). Retention cũng chạy định kỳ
+(RETENTION_INTERVAL) khi server im lặng: segment đang ghi mà mọi tin đã quá
+tuổi được đóng lại để xoá được.
+
+committed_id chỉ tăng tới tin cuối đã thật sự ghi + fsync. Ghi lỗi (vd. đầy
+đĩa) thì phần chưa ghi được giữ lại và thử lại sau RETRY_DELAY (tăng dần),
+flush() báo lỗi cho người chờ thay vì coi như đã bền vững.
+"""
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+LOG_DIR = "messages"
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_SEGMENT_ENTRIES = 64 * 1024
+DEFAULT_RETAIN_BYTES = 1024 * 1024 * 1024
+DEFAULT_MAX_BATCH = 1024
+RETENTION_INTERVAL = 60.0  # giây giữa hai lần áp retention khi không có tin mới
+RETRY_DELAY = 0.5          # giây chờ trước khi ghi lại lô bị lỗi (nhân đôi tới RETRY_MAX)
+RETRY_MAX = 10.0
+
+# entry chỉ mục: offset của dòng trong file .log, thời gian (epoch giây)
+INDEX_ENTRY = struct.Struct("!Qd")
+
+
+class Segment:
+    """Một cặp file .log/.index. Chỉ segment cuối (active) được ghi thêm."""
+
+    def __init__(self, directory, base_id, capacity):
+        self.base_id = base_id
+        self.capacity = capacity
+        self.data_path = Path(directory) / f"{base_id:020d}.log"
+        self.index_path = Path(directory) / f"{base_id:020d}.index"
+        self.count = 0
+        self.size = 0
+        self.active = False
+        self._fd = None
+        self._index = None
+
+    # ----- mở / tạo -----
+    @classmethod
+    def create(cls, directory, base_id, capacity):
+        seg = cls(directory, base_id, capacity)
+        seg.data_path.touch()
+        with open(seg.index_path, "wb") as f:
+            f.truncate(capacity * INDEX_ENTRY.size)
+        seg._open_active()
+        return seg
+
+    @classmethod
+    def open_sealed(cls, directory, base_id, capacity):
+        seg = cls(directory, base_id, capacity)
+        seg.count = seg.index_path.stat().st_size // INDEX_ENTRY.size
+        seg.size = seg.data_path.stat().st_size
+        seg._fd = os.open(seg.data_path, os.O_RDONLY)
+        seg._map_index(writable=False)
+        return seg
+
+    @classmethod
+    def recover(cls, directory, base_id, capacity):
+        """
+        Mở lại segment cuối sau khi khởi động (có thể sau crash): quét file
+        .log, bỏ dòng cuối ghi dở và dựng lại chỉ mục từ dữ liệu thật.
+        """
+        seg = cls(directory, base_id, capacity)
+        offsets = []
+        valid = 0
+        with open(seg.data_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # ghi dở khi crash
+                offsets.append(valid)
+                valid += len(line)
+        if valid != seg.data_path.stat().st_size:
+            os.truncate(seg.data_path, valid)
+
+        old_times = []
+        if seg.index_path.exists():
+            raw = seg.index_path.read_bytes()
+            old_times = [
+                INDEX_ENTRY.unpack_from(raw, i * INDEX_ENTRY.size)[1]
+                for i in range(len(raw) // INDEX_ENTRY.size)
+            ]
+        fallback = seg.data_path.stat().st_mtime
+        capacity = max(capacity, len(offsets))
+        seg.capacity = capacity
+        with open(seg.index_path, "wb") as f:
+            f.truncate(capacity * INDEX_ENTRY.size)
+        seg._open_active()
+        for i, offset in enumerate(offsets):
+            # tin đã có trong .log nhưng chưa kịp ghi chỉ mục: lấy mtime
+            ts = old_times[i] if i < len(old_times) and old_times[i] else fallback
+            INDEX_ENTRY.pack_into(seg._index, i * INDEX_ENTRY.size, offset, ts)
+        seg.count = len(offsets)
+        seg.size = valid
+        return seg
+
+    def _open_active(self):
+        self.active = True
+        self._fd = os.open(self.data_path, os.O_RDWR | os.O_APPEND)
+        self._map_index(writable=True)
+
+    def _map_index(self, writable):
+        length = self.index_path.stat().st_size
+        if length == 0:
+            self._index = None
+            return
+        with open(self.index_path, "r+b" if writable else "rb") as f:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self._index = mmap.mmap(f.fileno(), length, access=access)
+
+    # ----- ghi (chỉ thread committer) -----
+    def full(self, segment_bytes):
+        return self.count >= self.capacity or self.size >= segment_bytes
+
+    def append_batch(self, lines, times):
+        """
+        Ghi một lô dòng + fsync, sau đó mới ghi chỉ mục. Lỗi giữa chừng thì
+        cắt file về kích thước cũ: segment giữ nguyên như trước lần ghi.
+        """
+        data = memoryview(b"".join(lines))
+        try:
+            while data:
+                data = data[os.write(self._fd, data):]
+            os.fsync(self._fd)
+        except OSError:
+            try:
+                os.ftruncate(self._fd, self.size)
+            except OSError:
+                pass
+            raise
+        offset = self.size
+        for i, (line, ts) in enumerate(zip(lines, times)):
+            INDEX_ENTRY.pack_into(
+                self._index, (self.count + i) * INDEX_ENTRY.size, offset, ts
+            )
+            offset += len(line)
+        self.count += len(lines)
+        self.size = offset
+
+    def seal(self):
+        """Đóng segment: cắt chỉ mục về đúng số entry, mở lại chỉ đọc."""
+        self._index.flush()
+        self._index.close()
+        os.truncate(self.index_path, self.count * INDEX_ENTRY.size)
+        os.close(self._fd)
+        self.active = False
+        self._fd = os.open(self.data_path, os.O_RDONLY)
+        self._map_index(writable=False)
+
+    # ----- đọc -----
+    def entry(self, i):
+        return INDEX_ENTRY.unpack_from(self._index, i * INDEX_ENTRY.size)
+
+    def time_at(self, i):
+        return self.entry(i)[1]
+
+    def read(self, i):
+        """Dòng dữ liệu của tin thứ i trong segment."""
+        offset = self.entry(i)[0]
+        end = self.entry(i + 1)[0] if i + 1 < self.count else self.size
+        return os.pread(self._fd, end - offset, offset)
+
+    def disk_bytes(self):
+        return self.size + self.count * INDEX_ENTRY.size
+
+    def close(self):
+        if self._index is not None:
+            if self.active:
+                self._index.flush()
+            self._index.close()
+            self._index = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def delete(self):
+        self.close()
+        for path in (self.data_path, self.index_path):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class MessageLog:
+    """
+    Log tin nhắn chia segment với group commit.
+    - append(packet): gán packet["id"], xếp hàng ghi, trả về id (không chặn),
+    - get(id), read(after_id, limit), find_time(ts): đọc tin đã bền vững,
+    - flush(): chờ mọi tin đã append được ghi xuống đĩa.
+    """
+
+    def __init__(
+        self,
+        directory=LOG_DIR,
+        segment_bytes=DEFAULT_SEGMENT_BYTES,
+        segment_entries=DEFAULT_SEGMENT_ENTRIES,
+        retain_bytes=DEFAULT_RETAIN_BYTES,
+        retain_seconds=0,
+        max_batch=DEFAULT_MAX_BATCH,
+        metrics=None,
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.segment_entries = segment_entries
+        self.retain_bytes = retain_bytes
+        self.retain_seconds = retain_seconds
+        self.max_batch = max_batch
+        self.metrics = metrics
+
+        # segments/committed_id đổi trong committer, đọc từ thread khác
+        self._segments_lock = threading.RLock()
+        self.segments = self._load_segments()
+        active = self.segments[-1]
+        self.committed_id = active.base_id + active.count - 1
+
+        self._cond = threading.Condition()
+        self._pending = []
+        self._next_id = self.committed_id + 1
+        self._closed = False
+        self.error = None  # lỗi ghi gần nhất, None khi lần ghi sau đã thành công
+        self._thread = threading.Thread(target=self._commit_loop, daemon=True)
+        self._thread.start()
+
+    def _load_segments(self):
+        bases = sorted(
+            int(p.stem) for p in self.directory.glob("*.log") if p.stem.isdigit()
+        )
+        if not bases:
+            return [Segment.create(self.directory, 1, self.segment_entries)]
+        segments = [
+            Segment.open_sealed(self.directory, base, self.segment_entries)
+            for base in bases[:-1]
+        ]
+        segments.append(
+            Segment.recover(self.directory, bases[-1], self.segment_entries)
+        )
+        print(
+            f"[LOG] Mở {len(segments)} segment, tin cuối id="
+            f"{segments[-1].base_id + segments[-1].count - 1}"
+        )
+        return segments
+
+    # =====================================================
+    # GHI
+    # =====================================================
+    def append(self, packet):
+        """Gán id tăng dần cho packet (sửa trực tiếp dict) và xếp hàng ghi."""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Message log đã đóng")
+            msg_id = self._next_id
+            self._next_id += 1
+            packet["id"] = msg_id
+            self._pending.append((packet, time.time()))
+            self._cond.notify()
+        return msg_id
+
+    def flush(self, timeout=None):
+        """
+        Chờ tới khi mọi tin đã append đều đã ghi xuống đĩa. Hết giờ mà ghi
+        đang lỗi thì ném lại lỗi đó (committer vẫn tiếp tục thử), không lỗi
+        thì trả về False. timeout=None: ném lỗi ngay khi có lỗi ghi.
+        """
+        with self._cond:
+            target = self._next_id - 1
+            self._cond.wait_for(
+                lambda: self.committed_id >= target
+                or (timeout is None and self.error is not None),
+                timeout,
+            )
+            if self.committed_id >= target:
+                return True
+            if self.error is not None:
+                raise self.error
+            return False
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        with self._segments_lock:
+            for seg in self.segments:
+                seg.close()
+
+    def _commit_loop(self):
+        delay = RETRY_DELAY
+        while True:
+            with self._cond:
+                if not self._pending and not self._closed:
+                    self._cond.wait(RETENTION_INTERVAL if self.retain_seconds else None)
+                if not self._pending and self._closed:
+                    return
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+            if not batch:
+                # hết giờ chờ mà không có tin mới (ngoài _cond: append không phải chờ)
+                self._expire_idle()
+                continue
+
+            t0 = time.perf_counter()
+            written, error = self._write_batch(batch)
+            if self.metrics is not None:
+                self.metrics.observe("messages.commit_batch", written)
+                self.metrics.observe("messages.commit_s", time.perf_counter() - t0)
+            with self._cond:
+                if written:
+                    self.committed_id = batch[written - 1][0]["id"]
+                if error is None:
+                    self.error = None
+                else:
+                    # giữ thứ tự id: phần chưa ghi quay lại đầu hàng đợi
+                    self._pending[:0] = batch[written:]
+                    self.error = error
+                self._cond.notify_all()
+            if error is None:
+                delay = RETRY_DELAY
+                continue
+
+            print(f"[LOG] Lỗi ghi {len(batch) - written} tin, thử lại sau {delay:g}s: {error}")
+            if self.metrics is not None:
+                self.metrics.incr("messages.write_errors")
+            with self._cond:
+                if self._closed:
+                    print(f"[LOG] Đóng log, bỏ {len(self._pending)} tin chưa ghi được")
+                    self._pending.clear()
+                    return
+                self._cond.wait(delay)
+            delay = min(delay * 2, RETRY_MAX)
+
+    def _write_batch(self, batch):
+        """Ghi lô; trả về (số tin đầu lô đã ghi bền vững, lỗi hoặc None)."""
+        lines = [
+            (json.dumps(packet, ensure_ascii=False) + "\n").encode("utf-8")
+            for packet, _ in batch
+        ]
+        times = [ts for _, ts in batch]
+        start = 0
+        try:
+            while start < len(lines):
+                seg = self.segments[-1]
+                if seg.full(self.segment_bytes) or not seg.active:
+                    seg = self._roll(batch[start][0]["id"])
+                room = min(seg.capacity - seg.count, len(lines) - start)
+                seg.append_batch(lines[start:start + room], times[start:start + room])
+                start += room
+        except Exception as e:
+            return start, e
+        return start, None
+
+    def _expire_idle(self):
+        """
+        Retention khi không có tin mới. Segment đang ghi không bao giờ bị xoá,
+        nên nếu mọi tin của nó đã quá tuổi thì đóng nó lại (mở segment rỗng)
+        để _apply_retention xoá được. Chỉ gọi từ committer, khi hàng đợi rỗng.
+        """
+        if not self.retain_seconds:
+            return
+        cutoff = time.time() - self.retain_seconds
+        try:
+            active = self.segments[-1]
+            if active.active and active.count and active.time_at(active.count - 1) < cutoff:
+                self._roll(self.committed_id + 1)
+            else:
+                with self._segments_lock:
+                    self._apply_retention()
+        except Exception as e:
+            print(f"[LOG] Lỗi áp retention: {e}")
+
+    def _roll(self, base_id):
+        """Đóng segment hiện tại, mở segment mới, áp dụng chính sách giữ lại."""
+        with self._segments_lock:
+            if self.segments[-1].active:  # lần roll trước có thể lỗi sau seal()
+                self.segments[-1].seal()
+            seg = Segment.create(self.directory, base_id, self.segment_entries)
+            self.segments.append(seg)
+            self._apply_retention()
+        if self.metrics is not None:
+            self.metrics.incr("messages.segments_rolled")
+        return seg
+
+    def _apply_retention(self):
+        total = sum(seg.disk_bytes() for seg in self.segments)
+        cutoff = time.time() - self.retain_seconds if self.retain_seconds else None
+        # không bao giờ xoá segment đang ghi
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            too_big = self.retain_bytes and total > self.retain_bytes
+            too_old = (
+                cutoff is not None
+                and (oldest.count == 0 or oldest.time_at(oldest.count - 1) < cutoff)
+            )
+            if not (too_big or too_old):
+                break
+            total -= oldest.disk_bytes()
+            self.segments.pop(0)
+            oldest.delete()
+            print(f"[LOG] Xoá segment cũ {oldest.data_path.name}")
+
+    # =====================================================
+    # ĐỌC
+    # =====================================================
+    @property
+    def last_id(self):
+        return self.committed_id
+
+    def _locate(self, msg_id):
+        """(segment, vị trí) chứa msg_id, hoặc None. Gọi khi giữ _segments_lock."""
+        bases = [seg.base_id for seg in self.segments]
+        idx = bisect.bisect_right(bases, msg_id) - 1
+        if idx < 0:
+            return None
+        seg = self.segments[idx]
+        pos = msg_id - seg.base_id
+        if pos >= seg.count:
+            return None
+        return seg, pos
+
+    def get(self, msg_id):
+        """Gói có id msg_id (dict), None nếu không có hoặc đã bị xoá."""
+        with self._segments_lock:
+            if msg_id > self.committed_id:
+                return None
+            found = self._locate(msg_id)
+            if found is None:
+                return None
+            seg, pos = found
+            return json.loads(seg.read(pos))
+
+    def read(self, after_id=0, limit=100, with_times=False):
+        """
+        Tối đa limit tin có id > after_id, theo thứ tự id.
+        with_times=True: trả về các cặp (gói, thời gian ghi).
+        """
+        out = []
+        with self._segments_lock:
+            msg_id = max(after_id + 1, self.first_id)
+            last = self.committed_id
+            while msg_id <= last and len(out) < limit:
+                found = self._locate(msg_id)
+                if found is None:
+                    break
+                seg, pos = found
+                packet = json.loads(seg.read(pos))
+                out.append((packet, seg.time_at(pos)) if with_times else packet)
+                msg_id += 1
+        return out
+
+    @property
+    def first_id(self):
+        with self._segments_lock:
+            return self.segments[0].base_id
+
+    def find_time(self, ts):
+        """Id của tin đầu tiên có thời gian >= ts (None nếu không có)."""
+        with self._segments_lock:
+            last = self.committed_id
+            for seg in self.segments:
+                count = min(seg.count, last - seg.base_id + 1)
+                if count <= 0 or seg.time_at(count - 1) < ts:
+                    continue
+                lo, hi = 0, count - 1
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if seg.time_at(mid) < ts:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                return seg.base_id + lo
+        return None
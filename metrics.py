@@ -0,0 +1,56 @@
+# metrics.py
+"""
+Bộ đếm số liệu đơn giản, an toàn với nhiều thread, dùng cho server.
+
+- incr(name, n): cộng dồn bộ đếm.
+- observe(name, value): ghi nhận một mẫu (count/avg/max), vd. thời gian chờ.
+- register_gauge(name, fn): giá trị tức thời, tính khi lấy snapshot.
+- snapshot(): dict {tên: giá trị} để in log hoặc trả về qua gói "stats".
+"""
+import threading
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._summaries = {}  # {name: [count, sum, max]}
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def get(self, name, default=0):
+        with self._lock:
+            return self._counters.get(name, default)
+
+    def observe(self, name, value):
+        with self._lock:
+            summary = self._summaries.get(name)
+            if summary is None:
+                self._summaries[name] = [1, value, value]
+            else:
+                summary[0] += 1
+                summary[1] += value
+                if value > summary[2]:
+                    summary[2] = value
+
+    def register_gauge(self, name, fn):
+        with self._lock:
+            self._gauges[name] = fn
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self._counters)
+            for name, (count, total, peak) in self._summaries.items():
+                data[f"{name}.count"] = count
+                data[f"{name}.avg"] = round(total / count, 6)
+                data[f"{name}.max"] = peak
+            gauges = list(self._gauges.items())
+        for name, fn in gauges:
+            try:
+                data[name] = fn()
+            except Exception:
+                data[name] = None
+        return dict(sorted(data.items()))
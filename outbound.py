@@ -0,0 +1,624 @@
+# outbound.py
+"""
+Hàng đợi gửi (outbound) có giới hạn cho từng kết nối.
+
+Broadcast chỉ đẩy frame vào hàng đợi của mỗi người nhận rồi đi tiếp; việc
+ghi xuống socket do writer riêng của từng kết nối đảm nhận. Một client chậm
+(TCP window đầy) vì vậy chỉ làm đầy hàng đợi của chính nó, không làm trễ
+cả phòng.
+
+Khi hàng đợi đầy, xử lý theo policy:
+- "drop_oldest": bỏ frame cũ nhất để nhận frame mới,
+- "drop_newest": bỏ frame mới đến,
+- "disconnect":  ngắt kết nối client chậm.
+
+Phiên có thể nối lại (resume, xem ChatServer.resume_step) giữ thêm một
+ReplayBuffer: mọi frame gửi trong phiên được đánh số seq và giữ lại
+RESUME_BUFFER frame gần nhất để phát lại cho kết nối mới.
+
+Writer gộp frame (coalescing): mỗi lần ghi lấy mọi frame đang chờ, tối đa
+write_budget byte, và gửi bằng một lệnh sendmsg (vectored, không nối
+buffer). flush_window > 0 cho writer chờ thêm tối đa chừng đó giây sau
+frame đầu để gom được nhiều frame hơn, đổi lại tăng độ trễ. Socket đặt
+TCP_NODELAY: writer đã tự gom nên Nagle chỉ thêm trễ. Số lần ghi, số
+syscall và tuổi frame cũ nhất lúc ghi (outbound.queue_delay_s) vào metrics.
+
+Engine thread: mặc định các kết nối dùng chung một WriterPool (vài thread
+ghi + một thread selector) thay vì mỗi kết nối một writer thread. Writer
+riêng tốn thêm một thread cho mỗi kết nối (stack, ~100 KB RSS/kết nối đo
+bằng bench_engines.py); pool ghi không chặn (MSG_DONTWAIT) nên client chậm
+chỉ nằm chờ trong selector, không giữ thread ghi nào. Kết nối có timeout
+(vd. link của hub bus) hoặc nền tảng không có MSG_DONTWAIT vẫn dùng writer
+riêng.
+"""
+import heapq
+import itertools
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from codec import JSON_CODEC
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+DEFAULT_LIMIT = 1000
+RESUME_BUFFER = 1000  # số frame gần nhất giữ lại để phát lại khi resume
+DEFAULT_FLUSH_WINDOW = 0.0       # giây chờ gom thêm frame (0 = chỉ gom frame đã có sẵn)
+DEFAULT_WRITE_BUDGET = 64 * 1024  # byte tối đa cho một lần ghi
+DEFAULT_WRITER_THREADS = 4  # thread ghi của WriterPool (0 = mỗi kết nối một writer)
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+# gửi không chặn trên socket chặn, không đổi chế độ socket của thread đọc
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+def set_nodelay(sock, enabled=True):
+    """Bật/tắt TCP_NODELAY; bỏ qua socket không phải TCP (vd. Unix socket)."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if enabled else 0)
+    except (OSError, AttributeError):
+        pass
+
+
+def send_frames(sock, frames):
+    """
+    Ghi toàn bộ frames xuống socket (chặn) bằng sendmsg, mỗi lệnh tối đa
+    IOV_MAX frame; gửi thiếu thì tiếp từ đúng byte đã dừng. Trả về số syscall.
+    Nền tảng không có sendmsg: nối lại và sendall một lần.
+    """
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(frames))
+        return 1
+    calls = 0
+    while frames:
+        sent = sock.sendmsg(frames[:IOV_MAX])
+        calls += 1
+        frames = _advance(frames, sent)
+    return calls
+
+
+def send_frames_nowait(sock, frames):
+    """
+    Như send_frames nhưng không chặn (MSG_DONTWAIT): dừng khi buffer gửi
+    của socket đầy. Trả về (phần chưa gửi, số syscall); phần chưa gửi rỗng
+    là đã ghi hết.
+    """
+    calls = 0
+    while frames:
+        try:
+            sent = sock.sendmsg(frames[:IOV_MAX], [], MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            break
+        calls += 1
+        frames = _advance(frames, sent)
+    return frames, calls
+
+
+def _advance(frames, sent):
+    """Bỏ sent byte đầu đã gửi khỏi danh sách frame."""
+    i = 0
+    while i < len(frames) and sent >= len(frames[i]):
+        sent -= len(frames[i])
+        i += 1
+    frames = frames[i:]
+    if sent:
+        frames[0] = memoryview(frames[0])[sent:]
+    return frames
+
+
+class OutboundQueue:
+    """Hàng đợi frame có giới hạn, an toàn với nhiều thread."""
+
+    def __init__(self, maxsize=DEFAULT_LIMIT, policy=DROP_OLDEST, metrics=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Policy không hợp lệ: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.metrics = metrics
+        self.frames = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.pending_bytes = 0
+        # lúc frame cũ nhất đang chờ vào hàng đợi (xấp xỉ khi còn dư sau take())
+        self.first_at = 0.0
+
+        # bộ đếm
+        self.enqueued = 0
+        self.sent = 0
+        self.dropped = 0
+        self.high_water = 0
+        self.writes = 0
+        self.syscalls = None  # None: chưa biết (chưa ghi, hoặc writer asyncio)
+
+    def put(self, data):
+        """
+        Thêm frame vào hàng đợi, không bao giờ chặn.
+        Trả về False nếu policy "disconnect" yêu cầu ngắt kết nối.
+        """
+        with self.cond:
+            if self.closed:
+                return True
+            if len(self.frames) >= self.maxsize:
+                if self.policy == DISCONNECT:
+                    self._count("outbound.overflow_disconnects")
+                    return False
+                self.dropped += 1
+                self._count(f"outbound.{self.policy}")
+                if self.policy == DROP_NEWEST:
+                    return True
+                self.pending_bytes -= len(self.frames.popleft())
+            if not self.frames:
+                self.first_at = time.monotonic()
+            self.frames.append(data)
+            self.pending_bytes += len(data)
+            self.enqueued += 1
+            if len(self.frames) > self.high_water:
+                self.high_water = len(self.frames)
+            self.cond.notify()
+        return True
+
+    def get(self):
+        """Lấy frame kế tiếp (chặn). Trả về None khi đã đóng và hết frame."""
+        with self.cond:
+            while not self.frames and not self.closed:
+                self.cond.wait()
+            return self._pop()
+
+    def get_nowait(self):
+        """Lấy frame kế tiếp nếu có, ngược lại trả về None."""
+        with self.cond:
+            return self._pop()
+
+    def _pop(self):
+        if not self.frames:
+            return None
+        data = self.frames.popleft()
+        self.pending_bytes -= len(data)
+        return data
+
+    def take(self, max_bytes=DEFAULT_WRITE_BUDGET):
+        """
+        Lấy các frame đang chờ cho một lần ghi (không chặn): ít nhất một
+        frame, thêm tiếp khi tổng chưa vượt max_bytes. Trả về (frames,
+        first_at) — first_at là lúc frame cũ nhất vào hàng đợi — hoặc None
+        khi hàng đợi rỗng.
+        """
+        with self.cond:
+            if not self.frames:
+                return None
+            first_at = self.first_at
+            data = self.frames.popleft()
+            frames = [data]
+            size = len(data)
+            while self.frames and size + len(self.frames[0]) <= max_bytes:
+                data = self.frames.popleft()
+                frames.append(data)
+                size += len(data)
+            self.pending_bytes -= size
+            if self.frames:
+                self.first_at = time.monotonic()
+            return frames, first_at
+
+    def get_batch(self, max_bytes=DEFAULT_WRITE_BUDGET, window=DEFAULT_FLUSH_WINDOW):
+        """
+        Như take() nhưng chặn tới khi có frame; window > 0 thì chờ thêm tới
+        window giây sau frame đầu (hoặc tới khi đủ max_bytes) để gom thêm.
+        Trả về None khi đã đóng và hết frame.
+        """
+        with self.cond:
+            while not self.frames and not self.closed:
+                self.cond.wait()
+            if window > 0:
+                deadline = self.first_at + window
+                while not self.closed and self.pending_bytes < max_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            return self.take(max_bytes)
+
+    def record_write(self, frames, calls, first_at):
+        """
+        Ghi nhận một lần ghi: frames frame, calls syscall. calls=None khi
+        writer không biết số syscall (transport asyncio tự quyết định gửi
+        ngay hay đệm lại): lần ghi đó không tính vào syscalls_per_frame.
+        """
+        self.sent += frames
+        self.writes += 1
+        if calls is not None:
+            self.syscalls = (self.syscalls or 0) + calls
+        if self.metrics is not None:
+            self.metrics.incr("outbound.frames", frames)
+            self.metrics.incr("outbound.writes")
+            if calls is not None:
+                self.metrics.incr("outbound.syscalls", calls)
+                self.metrics.incr("outbound.syscall_frames", frames)
+            self.metrics.observe("outbound.batch_frames", frames)
+            self.metrics.observe("outbound.queue_delay_s", time.monotonic() - first_at)
+
+    def wait_sent(self, mark, timeout=None):
+        """
+        Chờ writer xử lý xong frame thứ mark (đã gửi hoặc bị bỏ). Writer không
+        báo khi gửi xong nên chỉ poll. False nếu hàng đợi đóng hoặc hết giờ.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.sent + self.dropped < mark:
+            if self.closed or (deadline is not None and time.monotonic() > deadline):
+                return False
+            time.sleep(0.05)
+        return True
+
+    def close(self):
+        """Không nhận thêm frame; writer gửi nốt phần còn lại rồi dừng."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def abort(self):
+        """Đóng ngay và bỏ toàn bộ frame đang chờ."""
+        with self.cond:
+            self.closed = True
+            self.frames.clear()
+            self.pending_bytes = 0
+            self.cond.notify_all()
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.incr(name)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.frames),
+                "high_water": self.high_water,
+                "enqueued": self.enqueued,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "writes": self.writes,
+                "syscalls": self.syscalls,
+            }
+
+
+class ReplayBuffer:
+    """
+    Các frame đã gửi trong một phiên, đánh số seq 1, 2, ... theo thứ tự
+    (frame đầu tiên sau login_result là seq 1; client đếm gói nhận được
+    theo cùng cách nên seq không cần nằm trong frame, frame broadcast vẫn
+    mã hoá một lần cho mọi người nhận).
+
+    Dùng chung cho mọi kết nối của phiên: conn là kết nối đang nhận frame
+    (None khi phiên đang chờ resume), owner là kết nối làm khoá trong
+    clients/user_sockets/rooms của server. Mọi trường đọc/ghi khi giữ lock.
+    """
+
+    def __init__(self, conn, username, token, maxlen=RESUME_BUFFER):
+        self.lock = threading.Lock()
+        self.frames = deque(maxlen=maxlen)
+        self.seq = 0
+        self.conn = conn
+        self.owner = conn
+        self.username = username
+        self.token = token
+        self.valid = True    # False khi có frame bị bỏ: không phát lại chính xác được
+        self.closed = False  # phiên đã kết thúc, không nhận resume nữa
+
+    def record(self, data):
+        self.seq += 1
+        self.frames.append(data)
+
+    def since(self, seq):
+        """Các frame có seq lớn hơn seq, None nếu không còn đủ để phát lại."""
+        missed = self.seq - seq
+        if not self.valid or missed < 0 or missed > len(self.frames):
+            return None
+        return list(self.frames)[len(self.frames) - missed:]
+
+
+class OutboundConnection:
+    """
+    Phần dùng chung của kết nối có hàng đợi gửi (engine thread và asyncio).
+    Lớp con cài đặt _wakeup() (báo writer có frame mới) và abort().
+    """
+
+    def __init__(
+        self,
+        maxsize=DEFAULT_LIMIT,
+        policy=DROP_OLDEST,
+        metrics=None,
+        flush_window=DEFAULT_FLUSH_WINDOW,
+        write_budget=DEFAULT_WRITE_BUDGET,
+    ):
+        self.queue = OutboundQueue(maxsize, policy, metrics)
+        # gộp frame khi ghi (xem đầu file)
+        self.flush_window = flush_window
+        self.write_budget = write_budget
+        # tính năng client khai báo trong gói login (vd. "presence_delta")
+        self.features = frozenset()
+        # mã hoá frame đã thương lượng khi login (xem codec.py)
+        self.codec = JSON_CODEC
+        # phiên có thể resume: frame đi qua ReplayBuffer tới kết nối hiện tại
+        self.replay = None
+
+    def sendall(self, data):
+        replay = self.replay
+        if replay is None:
+            self.enqueue(data)
+            return
+        # ghi lại + chuyển trong cùng lock: resume không lọt/trùng frame nào
+        with replay.lock:
+            replay.record(data)
+            if replay.conn is not None:
+                replay.conn.enqueue(data, replay)
+
+    def enqueue(self, data, replay=None):
+        """Đưa frame vào hàng đợi của chính kết nối này (không qua replay)."""
+        dropped = self.queue.dropped
+        if not self.queue.put(data):
+            print(f"[SLOW] {self.getpeername()} đầy hàng đợi gửi, ngắt kết nối")
+            self.abort()
+            return
+        if replay is not None and self.queue.dropped != dropped:
+            replay.valid = False
+        self._wakeup()
+
+    def _wakeup(self):
+        pass
+
+    def abort(self):
+        raise NotImplementedError
+
+    def getpeername(self):
+        return None
+
+
+class QueuedConnection(OutboundConnection):
+    """
+    Kết nối cho engine thread: sendall() chỉ đưa frame vào hàng đợi,
+    writer rút hàng đợi và ghi cả lô xuống socket bằng một sendmsg. Writer
+    là pool dùng chung nếu có (xem WriterPool), ngược lại một writer thread
+    riêng cho kết nối này.
+    """
+
+    def __init__(
+        self, sock, maxsize=DEFAULT_LIMIT, policy=DROP_OLDEST, metrics=None,
+        pool=None, **options
+    ):
+        super().__init__(maxsize, policy, metrics, **options)
+        self.sock = sock
+        # socket chỉ được đóng khi cả phía đọc (close()) lẫn writer đã xong
+        self._refs = 2
+        self._refs_lock = threading.Lock()
+        self._closing = False
+        self.writer = None
+        self.pool = pool if pool is not None and pool.accepts(sock) else None
+        if self.pool is None:
+            self.writer = threading.Thread(target=self._write_loop, daemon=True)
+            self.writer.start()
+        else:
+            self._scheduled = False  # đang nằm trong pool (hàng chờ/selector/hẹn giờ)
+            self._finished = False
+            self._partial = None     # lô đang ghi dở: [phần còn lại, số frame, first_at, syscall]
+            self._sched_lock = threading.Lock()
+            self._done = threading.Event()
+
+    def close(self):
+        with self._refs_lock:
+            if self._closing:
+                return
+            self._closing = True
+        self.queue.close()
+        self._wakeup()
+        self._release()
+
+    def abort(self):
+        self.queue.abort()
+        self._shutdown()
+        self._wakeup()
+
+    def join(self, timeout=None):
+        if self.writer is not None:
+            self.writer.join(timeout)
+        else:
+            self._done.wait(timeout)
+
+    def getpeername(self):
+        try:
+            return self.sock.getpeername()
+        except OSError:
+            return None
+
+    def _shutdown(self):
+        # shutdown() đánh thức cả thread đang chặn ở recv() trên socket này
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _release(self):
+        with self._refs_lock:
+            self._refs -= 1
+            last = self._refs == 0
+        if last:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def _write_loop(self):
+        try:
+            while True:
+                batch = self.queue.get_batch(self.write_budget, self.flush_window)
+                if batch is None:
+                    break
+                frames, first_at = batch
+                calls = send_frames(self.sock, frames)
+                self.queue.record_write(len(frames), calls, first_at)
+        except OSError:
+            self.queue.abort()
+        finally:
+            self._shutdown()
+            self._release()
+
+    # ----- ghi qua WriterPool -----
+    def _wakeup(self):
+        if self.pool is None:
+            return
+        with self._sched_lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.pool.schedule(self, self._delay())
+
+    def _delay(self):
+        """Số giây còn chờ gom thêm frame (flush_window, như get_batch)."""
+        if self.flush_window <= 0 or self.queue.pending_bytes >= self.write_budget:
+            return 0.0
+        return max(0.0, self.queue.first_at + self.flush_window - time.monotonic())
+
+    def _flush(self):
+        """Ghi một lô (chạy trên thread của pool, mỗi lúc một thread)."""
+        try:
+            if self._partial is None:
+                batch = self.queue.take(self.write_budget)
+                if batch is None:
+                    with self._sched_lock:
+                        # frame vào sau take() nhưng trước khi bỏ cờ: ghi tiếp
+                        idle = not self.queue.frames
+                        if idle:
+                            self._scheduled = self.queue.closed
+                    if not idle:
+                        self.pool.schedule(self)
+                    elif self.queue.closed:
+                        self._finish()
+                    return
+                frames, first_at = batch
+                self._partial = [frames, len(frames), first_at, 0]
+            frames, count, first_at, calls = self._partial
+            left, n = send_frames_nowait(self.sock, frames)
+            if left:
+                # buffer gửi đầy (client chậm): chờ socket ghi được
+                self._partial = [left, count, first_at, calls + n]
+                self.pool.wait_writable(self)
+                return
+            self._partial = None
+            self.queue.record_write(count, calls + n, first_at)
+            # lô sau xếp cuối hàng: công bằng giữa các kết nối
+            self.pool.schedule(self, self._delay())
+        except OSError:
+            self.queue.abort()
+            self._finish()
+
+    def _finish(self):
+        if self._finished:
+            return
+        self._finished = True
+        self._shutdown()
+        self._release()
+        self._done.set()
+
+
+class WriterPool:
+    """
+    Writer dùng chung cho các QueuedConnection của engine thread: threads
+    thread ghi và một thread selector thay cho mỗi kết nối một writer
+    thread. Kết nối có frame mới được xếp vào hàng chờ, thread ghi lấy ra và
+    gửi một lô không chặn; socket đầy thì kết nối được giao cho selector và
+    xếp lại khi socket ghi được. Selector cũng giữ hẹn giờ flush_window.
+    """
+
+    def __init__(self, threads=DEFAULT_WRITER_THREADS, metrics=None):
+        self.metrics = metrics
+        self._ready = deque()
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+        self._waiting = []  # kết nối chờ socket ghi được, chưa đăng ký selector
+        self._timers = []   # heap (hạn, thứ tự, kết nối) đang gom frame
+        self._order = itertools.count()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        for _ in range(threads):
+            threading.Thread(target=self._work_loop, daemon=True).start()
+        threading.Thread(target=self._select_loop, daemon=True).start()
+
+    @staticmethod
+    def accepts(sock):
+        """Socket pool ghi được: chặn không timeout và có MSG_DONTWAIT."""
+        return bool(MSG_DONTWAIT) and hasattr(sock, "sendmsg") and sock.gettimeout() is None
+
+    def schedule(self, conn, delay=0.0):
+        """Xếp conn vào hàng chờ ghi (sau delay giây nếu delay > 0)."""
+        if delay > 0:
+            with self._lock:
+                heapq.heappush(
+                    self._timers, (time.monotonic() + delay, next(self._order), conn)
+                )
+            self._wake()
+            return
+        with self._cond:
+            self._ready.append(conn)
+            self._cond.notify()
+
+    def wait_writable(self, conn):
+        """Xếp lại conn khi socket của nó ghi được."""
+        with self._lock:
+            self._waiting.append(conn)
+        self._wake()
+        if self.metrics is not None:
+            self.metrics.incr("outbound.pool_blocked")
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass  # buffer đầy: selector đã có sẵn tín hiệu chưa đọc
+
+    def _work_loop(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                conn = self._ready.popleft()
+            conn._flush()
+
+    def _select_loop(self):
+        while True:
+            with self._lock:
+                waiting, self._waiting = self._waiting, []
+                now = time.monotonic()
+                due = []
+                while self._timers and self._timers[0][0] <= now:
+                    due.append(heapq.heappop(self._timers)[2])
+                timeout = self._timers[0][0] - now if self._timers else None
+            for conn in waiting:
+                try:
+                    self._selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+                except (ValueError, KeyError, OSError):
+                    due.append(conn)  # socket đã đóng: lần ghi sau sẽ báo lỗi
+            for conn in due:
+                self.schedule(conn)
+            if due:
+                continue
+            for key, _ in self._selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self._selector.unregister(key.fileobj)
+                self.schedule(key.data)
@@ -0,0 +1,86 @@
+# presence.py
+"""
+Gộp sự kiện vào/ra phòng (presence) trong một cửa sổ thời gian ngắn.
+
+Khi server khởi động lại, hàng trăm client kết nối lại gần như cùng lúc.
+Thay vì mỗi lần login/logout phát một thông báo hệ thống và một gói
+presence, PresenceAggregator gom các sự kiện trong `window` giây rồi gọi
+flush_fn(joined, left) một lần. Người vào rồi ra (hoặc ra rồi vào lại)
+trong cùng cửa sổ được triệt tiêu.
+"""
+import threading
+
+DEFAULT_WINDOW = 0.2  # giây
+
+
+def format_names(names, limit=5):
+    """'[a], [b], [c] và 12 người khác' - rút gọn khi danh sách dài."""
+    shown = ", ".join(f"[{n}]" for n in names[:limit])
+    if len(names) > limit:
+        shown += f" và {len(names) - limit} người khác"
+    return shown
+
+
+class PresenceAggregator:
+    def __init__(self, flush_fn, schedule, window=DEFAULT_WINDOW, metrics=None):
+        """
+        flush_fn(joined, left): phát thay đổi đã gộp.
+        schedule(delay, fn):    hẹn giờ gọi fn (timer thread hoặc event loop).
+        window <= 0:            không gộp, flush ngay mỗi sự kiện.
+        """
+        self.flush_fn = flush_fn
+        self.schedule = schedule
+        self.window = window
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._joined = {}  # dict giữ thứ tự xuất hiện
+        self._left = {}
+        self._events = 0
+        self._scheduled = False
+
+    def joined(self, username):
+        with self._lock:
+            self._events += 1
+            if username in self._left:
+                del self._left[username]  # ra rồi vào lại: không đổi gì
+            else:
+                self._joined[username] = None
+        self._arm()
+
+    def left(self, username):
+        with self._lock:
+            self._events += 1
+            if username in self._joined:
+                del self._joined[username]  # vào rồi ra: không đổi gì
+            else:
+                self._left[username] = None
+        self._arm()
+
+    def _arm(self):
+        if self.window <= 0:
+            self.flush()
+            return
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.schedule(self.window, self.flush)
+
+    def flush(self):
+        with self._lock:
+            joined = list(self._joined)
+            left = list(self._left)
+            events = self._events
+            self._joined.clear()
+            self._left.clear()
+            self._events = 0
+            self._scheduled = False
+
+        if not events:
+            return
+        if self.metrics is not None:
+            self.metrics.incr("presence.flushes")
+            self.metrics.incr("presence.events", events)
+            self.metrics.observe("presence.events_per_flush", events)
+        if joined or left:
+            self.flush_fn(joined, left)
@@ -0,0 +1,136 @@
+# rooms.py
+"""
+Phòng chat (room) và chỉ mục thành viên cho server.
+
+Mỗi Room giữ tập thành viên {username: conn} của riêng nó, nên broadcast
+trong phòng chỉ duyệt thành viên phòng đó (O(kích thước phòng)) thay vì
+mọi client của server. RoomIndex còn giữ chiều ngược lại
+{username: tập tên phòng} để rời mọi phòng khi ngắt kết nối.
+
+Mọi người dùng tự vào phòng mặc định DEFAULT_ROOM khi đăng nhập, nên client
+cũ không biết tới room vẫn chat như một phòng chung. Phòng khác được tạo
+khi có người join và bị xoá khi người cuối cùng rời đi.
+
+Mỗi phòng có version presence và PresenceAggregator riêng: thay đổi thành
+viên chỉ phát cho người trong phòng.
+
+Khi chạy nhiều worker (workers.py), thành viên ở worker khác được giữ trong
+RoomIndex.remote ({phòng: {username: worker}}), cập nhật từ sự kiện presence
+trên bus; snapshot và danh sách phòng gộp cả hai.
+
+RoomIndex không có lock riêng: mọi hàm phải được gọi khi giữ server.lock
+(cùng lock bảo vệ clients/user_sockets).
+"""
+import re
+
+DEFAULT_ROOM = "lobby"
+MAX_ROOMS_PER_USER = 32
+_ROOM_NAME = re.compile(r"^[\w-]{1,32}$")
+
+
+def valid_room(name):
+    """Tên phòng: 1-32 ký tự chữ/số/_/-."""
+    return isinstance(name, str) and bool(_ROOM_NAME.match(name))
+
+
+class Room:
+    def __init__(self, name, presence=None):
+        self.name = name
+        self.members = {}   # {username: conn}, giữ thứ tự vào phòng
+        self.version = 0    # version presence của phòng
+        self.presence = presence
+
+
+class RoomIndex:
+    def __init__(self, make_presence=None):
+        """make_presence(room): tạo PresenceAggregator cho phòng mới."""
+        self.make_presence = make_presence
+        self.rooms = {}       # {tên phòng: Room}
+        self.user_rooms = {}  # {username: set(tên phòng)}
+        self.remote = {}      # {tên phòng: {username: worker}} ở worker khác
+        self._create(DEFAULT_ROOM)
+
+    def _create(self, name):
+        room = Room(name)
+        if self.make_presence is not None:
+            room.presence = self.make_presence(room)
+        self.rooms[name] = room
+        return room
+
+    def get(self, name):
+        return self.rooms.get(name)
+
+    def join(self, name, username, conn):
+        """Thêm username vào phòng (tạo phòng nếu chưa có). Trả về Room."""
+        room = self.rooms.get(name)
+        if room is None:
+            room = self._create(name)
+        room.members[username] = conn
+        self.user_rooms.setdefault(username, set()).add(name)
+        return room
+
+    def leave(self, name, username):
+        """Bỏ username khỏi phòng. Trả về Room nếu username đã ở trong phòng."""
+        room = self.rooms.get(name)
+        if room is None or room.members.pop(username, None) is None:
+            return None
+        names = self.user_rooms.get(username)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self.user_rooms[username]
+        if not room.members and name != DEFAULT_ROOM:
+            del self.rooms[name]
+        return room
+
+    def leave_all(self, username):
+        """Bỏ username khỏi mọi phòng (khi ngắt kết nối). Trả về các Room."""
+        return [
+            room
+            for name in sorted(self.user_rooms.get(username, ()))
+            if (room := self.leave(name, username)) is not None
+        ]
+
+    # ----- thành viên ở worker khác -----
+    def apply_remote(self, name, worker, joined, left):
+        members = self.remote.setdefault(name, {})
+        for user in left:
+            members.pop(user, None)
+        for user in joined:
+            members[user] = worker
+        if not members:
+            del self.remote[name]
+
+    def drop_worker(self, worker):
+        """Bỏ thành viên của worker đã dừng. Trả về {phòng: [username]}."""
+        dropped = {}
+        for name in list(self.remote):
+            members = self.remote[name]
+            users = [u for u, w in members.items() if w == worker]
+            for user in users:
+                del members[user]
+            if users:
+                dropped[name] = users
+            if not members:
+                del self.remote[name]
+        return dropped
+
+    def member_names(self, room):
+        """Thành viên của room ở worker này rồi tới các worker khác."""
+        names = list(room.members)
+        names.extend(u for u in self.remote.get(room.name, ()) if u not in room.members)
+        return names
+
+    def rooms_of(self, username):
+        return frozenset(self.user_rooms.get(username, ()))
+
+    def listing(self, username):
+        """[{"name", "members", "joined"}] cho gói rooms."""
+        mine = self.user_rooms.get(username, ())
+        listing = []
+        for name in sorted(set(self.rooms) | set(self.remote)):
+            room = self.rooms.get(name)
+            count = len(room.members) if room is not None else 0
+            count += len(self.remote.get(name, ()))
+            listing.append({"name": name, "members": count, "joined": name in mine})
+        return listing
@@ -0,0 +1,50 @@
+# scrollback.py
+"""
+Kho scrollback cho client: các dòng đã cắt khỏi đầu khung chat.
+
+Khung chat (Tk Text) chỉ giữ một số dòng giới hạn; phần cũ hơn được cắt
+theo khối và cất ở đây, mỗi khối nén zlib ghi vào một file tạm, trong RAM
+chỉ còn (offset, kích thước, số dòng) của từng khối. Bộ nhớ client vì vậy
+không tăng theo độ dài phiên.
+
+Các khối xếp chồng theo thứ tự cắt: khối trên cùng là phần nằm ngay trên
+dòng đầu của khung chat, nên khi người dùng cuộn lên, pop() trả lại đúng
+khối đó (và cắt bớt file, không để lại rác).
+
+Một khối là danh sách [text, tag] (tag "" nếu không có) để chèn lại giữ
+nguyên màu.
+"""
+import json
+import tempfile
+import zlib
+
+
+class ScrollbackStore:
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.chunks = []  # [(offset, size, số dòng)]
+        self.lines = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def push(self, runs, lines):
+        """Cất một khối runs ([[text, tag], ...]) gồm lines dòng."""
+        data = zlib.compress(json.dumps(runs, ensure_ascii=False).encode("utf-8"))
+        offset = self.chunks[-1][0] + self.chunks[-1][1] if self.chunks else 0
+        self.file.seek(offset)
+        self.file.write(data)
+        self.chunks.append((offset, len(data), lines))
+        self.lines += lines
+
+    def pop(self):
+        """Lấy lại khối cất gần nhất: (runs, số dòng)."""
+        offset, size, lines = self.chunks.pop()
+        self.file.seek(offset)
+        data = self.file.read(size)
+        self.file.truncate(offset)
+        self.lines -= lines
+        return json.loads(zlib.decompress(data)), lines
+
+    def close(self):
+        self.file.close()
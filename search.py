@@ -0,0 +1,333 @@
+# search.py
+"""
+Tìm kiếm toàn văn lịch sử chat cho gói "search".
+
+SearchIndex là chỉ mục đảo (inverted index) trong RAM: mỗi từ -> {id tin:
+các vị trí của từ trong tin}. Từ được "gập dấu" (fold): bỏ dấu tiếng Việt,
+đ -> d, chữ thường, nên "Họp", "hop", "HỌP" là cùng một từ. Vị trí từ dùng
+để khớp cụm từ trong ngoặc kép ("báo cáo quý").
+
+Chỉ mục được cập nhật tăng dần: ChatServer.log_message chỉ xếp gói vào
+hàng đợi (submit), một thread indexer riêng tách từ và cập nhật chỉ mục,
+nên đường broadcast không phải chờ. Khi khởi động, thread này dựng lại
+chỉ mục từ message log trước khi nhận tin mới.
+
+Cú pháp truy vấn (có thể kết hợp):
+    họp quý             mọi từ đều phải có (AND)
+    "báo cáo quý"       cụm từ liền nhau
+    from:alice          người gửi
+    to:bob              người nhận DM
+    room:dev            phòng chat
+    since:2024-05-01    từ thời điểm (ISO, hoặc epoch giây)
+    until:2024-05-08    tới trước thời điểm
+
+Kết quả xếp hạng theo BM25 (tin mới hơn đứng trước nếu bằng điểm). DM chỉ
+hiện với người gửi/người nhận; tin trong phòng chỉ hiện với người đang ở
+phòng đó (xem history.visible_to).
+"""
+import heapq
+import itertools
+import math
+import queue
+import re
+import threading
+import time
+import unicodedata
+from datetime import datetime
+
+from rooms import DEFAULT_ROOM
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 50
+PRUNE_EVERY = 10000  # dọn tin đã bị xoá khỏi log sau mỗi chừng này tin mới
+REBUILD_BATCH = 1000
+# truy vấn chỉ có filter (from:alice) không có danh sách từ để thu hẹp: chỉ
+# duyệt chừng này tin mới nhất, kết quả khi đó đánh dấu là chưa đầy đủ
+FILTER_SCAN_MAX = 20000
+
+# tham số BM25
+K1 = 1.2
+B = 0.75
+
+# bỏ mọi dấu kết hợp (sau NFD) và đổi đ/Đ thành d
+_FOLD = dict.fromkeys(range(0x300, 0x370))
+_FOLD[ord("đ")] = "d"
+_FOLD[ord("Đ")] = "d"
+_WORD = re.compile(r"\w+")
+_QUERY = re.compile(r'"([^"]*)"|(\w+):(\S+)|(\S+)')
+FILTERS = ("from", "to", "room", "since", "until")
+
+
+def fold(text):
+    """'Đi HỌP nhé' -> 'di hop nhe'."""
+    return unicodedata.normalize("NFD", text).translate(_FOLD).casefold()
+
+
+def tokenize(text):
+    """Danh sách từ đã gập dấu, theo thứ tự xuất hiện."""
+    return _WORD.findall(fold(text))
+
+
+def parse_time(value):
+    """Epoch giây (số) hoặc chuỗi ISO '2024-05-01' / '2024-05-01T14:00'."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value)
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def parse_query(q):
+    """
+    Tách chuỗi truy vấn thành (terms, phrases, filters).
+    Ném ValueError nếu filter thời gian sai định dạng.
+    """
+    terms = []
+    phrases = []
+    filters = {}
+    for phrase, key, value, word in _QUERY.findall(q):
+        if key and key.lower() in FILTERS:
+            filters[key.lower()] = value
+        elif phrase or key:
+            # cụm trong ngoặc, hoặc "a:b" không phải filter (vd. giờ 15:30)
+            tokens = tokenize(phrase or f"{key}:{value}")
+            if len(tokens) > 1:
+                phrases.append(tokens)
+            else:
+                terms.extend(tokens)
+        else:
+            terms.extend(tokenize(word))
+    for key in ("since", "until"):
+        if key in filters:
+            filters[key] = parse_time(filters[key])
+    return terms, phrases, filters
+
+
+class SearchIndex:
+    def __init__(self, loader, first_id=None, metrics=None):
+        """
+        loader(id):  trả về gói tin theo id (ring buffer / message log).
+        first_id():  id nhỏ nhất còn đọc được; tin cũ hơn bị dọn khỏi chỉ mục.
+        """
+        self.loader = loader
+        self.first_id = first_id
+        self.metrics = metrics
+        self.postings = {}   # {từ: {id: (vị trí, ...)}}
+        self.docs = {}       # {id: (from, to, phòng, thời gian, số từ)}
+        self.total_tokens = 0
+        self.ready = False   # False khi đang dựng lại từ log
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._since_prune = 0
+        self._thread = None
+
+    # =====================================================
+    # CẬP NHẬT
+    # =====================================================
+    def start(self, message_log=None):
+        """Chạy thread indexer; dựng lại chỉ mục từ message_log trước."""
+        self._thread = threading.Thread(
+            target=self._index_loop, args=(message_log,), daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, packet, ts=None):
+        """Xếp gói (đã có "id") vào hàng đợi index. Không chặn."""
+        self._queue.put((packet, time.time() if ts is None else ts))
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=2)
+
+    def _index_loop(self, message_log):
+        if message_log is not None:
+            self.rebuild(message_log)
+        self.ready = True
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self.add(*item)
+                self._since_prune += 1
+                if self._since_prune >= PRUNE_EVERY and self.first_id is not None:
+                    self._since_prune = 0
+                    self.prune(self.first_id())
+            except Exception as e:
+                print(f"[SEARCH] Lỗi khi index tin: {e}")
+
+    def rebuild(self, message_log):
+        """Index mọi tin còn trong message log (kèm thời gian ghi)."""
+        t0 = time.perf_counter()
+        after = message_log.first_id - 1
+        count = 0
+        while True:
+            batch = message_log.read(after, REBUILD_BATCH, with_times=True)
+            if not batch:
+                break
+            for packet, ts in batch:
+                self.add(packet, ts)
+            after = batch[-1][0]["id"]
+            count += len(batch)
+        if count:
+            print(
+                f"[SEARCH] Đã index {count} tin từ log trong "
+                f"{time.perf_counter() - t0:.2f}s"
+            )
+
+    def add(self, packet, ts):
+        msg_id = packet["id"]
+        tokens = tokenize(str(packet.get("text", "")))
+        positions = {}
+        for pos, token in enumerate(tokens):
+            positions.setdefault(token, []).append(pos)
+        with self._lock:
+            if msg_id in self.docs:
+                return
+            is_dm = packet.get("type") == "dm"
+            self.docs[msg_id] = (
+                packet.get("from"),
+                packet.get("to") if is_dm else None,
+                None if is_dm else packet.get("room", DEFAULT_ROOM),
+                ts,
+                len(tokens),
+            )
+            self.total_tokens += len(tokens)
+            for token, pos in positions.items():
+                self.postings.setdefault(token, {})[msg_id] = tuple(pos)
+        if self.metrics:
+            self.metrics.incr("search.indexed")
+
+    def prune(self, first_id):
+        """Bỏ các tin có id < first_id (đã bị retention xoá khỏi log)."""
+        with self._lock:
+            old = [msg_id for msg_id in self.docs if msg_id < first_id]
+            if not old:
+                return
+            for msg_id in old:
+                self.total_tokens -= self.docs.pop(msg_id)[4]
+            for token in list(self.postings):
+                plist = self.postings[token]
+                for msg_id in old:
+                    plist.pop(msg_id, None)
+                if not plist:
+                    del self.postings[token]
+        print(f"[SEARCH] Dọn {len(old)} tin cũ khỏi chỉ mục")
+
+    # =====================================================
+    # TRUY VẤN
+    # =====================================================
+    def search(
+        self, username, q, filters=None, offset=0, limit=DEFAULT_LIMIT, rooms=None
+    ):
+        """
+        Tìm tin khớp q mà username được xem (tin của các phòng rooms và DM
+        của username; rooms=None: mọi phòng).
+        filters (nếu có) ghi đè filter trong q.
+        Trả về (danh sách (điểm, gói) theo thứ hạng, tổng số tin khớp,
+        complete). complete là False khi truy vấn chỉ có filter và chỉ
+        FILTER_SCAN_MAX tin mới nhất được duyệt.
+        """
+        terms, phrases, parsed = parse_query(q)
+        if filters:
+            parsed.update(filters)
+        if not terms and not phrases and not parsed:
+            raise ValueError("Truy vấn rỗng")
+        limit = max(1, min(limit, MAX_LIMIT))
+        offset = max(0, offset)
+
+        t0 = time.perf_counter()
+        with self._lock:
+            scored, complete = self._match(username, rooms, terms, phrases, parsed)
+            total = len(scored)
+            top = heapq.nlargest(offset + limit, scored)[offset:]
+
+        results = []
+        for score, msg_id in top:
+            packet = self.loader(msg_id)
+            if packet is not None:
+                results.append((round(score, 3), packet))
+        if self.metrics:
+            self.metrics.incr("search.queries")
+            self.metrics.observe("search.query_s", time.perf_counter() - t0)
+        return results, total, complete
+
+    def _match(self, username, rooms, terms, phrases, filters):
+        """
+        ([(điểm, id)] của các tin khớp, complete). Gọi khi giữ _lock.
+        """
+        words = set(terms)
+        for phrase in phrases:
+            words.update(phrase)
+
+        if words:
+            plists = [self.postings.get(word) for word in words]
+            if not all(plists):
+                return [], True
+            # giao từ danh sách ngắn nhất
+            plists.sort(key=len)
+            candidates = [
+                msg_id for msg_id in plists[0]
+                if all(msg_id in plist for plist in plists[1:])
+            ]
+            complete = True
+        else:
+            # docs theo thứ tự thêm vào (id tăng dần): duyệt từ tin mới nhất
+            complete = len(self.docs) <= FILTER_SCAN_MAX
+            candidates = itertools.islice(reversed(self.docs), FILTER_SCAN_MAX)
+
+        sender = filters.get("from")
+        recipient = filters.get("to")
+        room_filter = filters.get("room")
+        since = filters.get("since")
+        until = filters.get("until")
+        n_docs = len(self.docs)
+        avg_len = self.total_tokens / n_docs if n_docs else 1.0
+        idf = {
+            word: math.log(1 + (n_docs - len(self.postings[word]) + 0.5)
+                           / (len(self.postings[word]) + 0.5))
+            for word in words
+        }
+
+        scored = []
+        for msg_id in candidates:
+            doc_from, doc_to, doc_room, ts, length = self.docs[msg_id]
+            # DM chỉ người gửi/người nhận thấy, tin phòng chỉ thành viên thấy
+            if doc_to is not None and username not in (doc_from, doc_to):
+                continue
+            if doc_room is not None and rooms is not None and doc_room not in rooms:
+                continue
+            if room_filter is not None and doc_room != room_filter:
+                continue
+            if sender is not None and doc_from != sender:
+                continue
+            if recipient is not None and doc_to != recipient:
+                continue
+            if since is not None and ts < since:
+                continue
+            if until is not None and ts >= until:
+                continue
+            if not all(self._has_phrase(msg_id, p) for p in phrases):
+                continue
+            score = 0.0
+            norm = K1 * (1 - B + B * length / avg_len)
+            for word in words:
+                tf = len(self.postings[word][msg_id])
+                score += idf[word] * tf * (K1 + 1) / (tf + norm)
+            scored.append((score, msg_id))
+        return scored, complete
+
+    def _has_phrase(self, msg_id, phrase):
+        starts = set(self.postings[phrase[0]][msg_id])
+        for i, word in enumerate(phrase[1:], 1):
+            starts &= {pos - i for pos in self.postings[word][msg_id]}
+            if not starts:
+                return False
+        return True
+
+    @property
+    def stats(self):
+        return {"docs": len(self.docs), "terms": len(self.postings)}
@@ -0,0 +1,128 @@
+# user_list.py
+"""
+Danh sách người online cho Listbox của client.
+
+OnlineUsers giữ mọi username trong một list sắp xếp theo khoá (tên đã gập
+dấu, tên gốc) (xem search.fold), nên "An", "an", "Ân" đứng cạnh nhau và
+tra cứu chỉ cần bisect: có online không, vị trí chèn/xoá, và dải tên bắt
+đầu bằng một tiền tố (ô lọc). Listbox luôn hiện đúng dải keys[lo:hi] khớp
+tiền tố đang lọc, nên vị trí một tên trong Listbox là i - lo.
+
+Mọi thay đổi chỉ gửi sang Listbox số lệnh insert/delete tối thiểu:
+- join/leave: một lệnh cho mỗi tên (và chỉ khi tên nằm trong dải đang hiện),
+- snapshot presence: so với danh sách cũ, áp phần chênh lệch; nếu chênh
+  quá nhiều thì vẽ lại bằng một delete + một insert,
+- đổi tiền tố lọc: dải mới so với dải cũ, tối đa hai lệnh xoá ở hai đầu
+  và hai lệnh chèn.
+
+listbox chỉ cần insert(index, *items) và delete(first, last=None) như
+tk.Listbox.
+"""
+import bisect
+
+from search import fold
+
+_PREFIX_END = "\U0010ffff"  # lớn hơn mọi ký tự: (p,) .. (p + _PREFIX_END,) là dải tiền tố p
+
+
+def user_key(username):
+    return (fold(username), username)
+
+
+class OnlineUsers:
+    def __init__(self, listbox):
+        self.listbox = listbox
+        self.keys = []    # [(fold(u), u)] đã sắp xếp
+        self.prefix = ""  # tiền tố lọc (đã gập dấu)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, username):
+        key = user_key(username)
+        i = bisect.bisect_left(self.keys, key)
+        return i < len(self.keys) and self.keys[i] == key
+
+    def users(self):
+        return [k[1] for k in self.keys]
+
+    def visible(self):
+        """Các tên đang hiện trong Listbox (khớp tiền tố lọc)."""
+        lo, hi = self._range()
+        return [k[1] for k in self.keys[lo:hi]]
+
+    def _range(self, prefix=None):
+        prefix = self.prefix if prefix is None else prefix
+        if not prefix:
+            return 0, len(self.keys)
+        lo = bisect.bisect_left(self.keys, (prefix,))
+        hi = bisect.bisect_left(self.keys, (prefix + _PREFIX_END,), lo)
+        return lo, hi
+
+    def add(self, username):
+        """Thêm một người; False nếu đã có."""
+        key = user_key(username)
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return False
+        self.keys.insert(i, key)
+        if key[0].startswith(self.prefix):
+            lo, _ = self._range()
+            self.listbox.insert(i - lo, username)
+        return True
+
+    def discard(self, username):
+        """Bỏ một người; False nếu không có."""
+        key = user_key(username)
+        i = bisect.bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return False
+        if key[0].startswith(self.prefix):
+            lo, _ = self._range()
+            self.listbox.delete(i - lo)
+        del self.keys[i]
+        return True
+
+    def replace(self, users):
+        """Áp snapshot đầy đủ: chỉ chèn/xoá phần khác với danh sách hiện có."""
+        new = {user_key(u) for u in users if u}
+        old = set(self.keys)
+        left = old - new
+        joined = new - old
+        if len(left) + len(joined) <= max(len(new), len(old)) // 2:
+            for key in left:
+                self.discard(key[1])
+            for key in joined:
+                self.add(key[1])
+            return
+        # gần như thay toàn bộ: vẽ lại một lần rẻ hơn từng lệnh một
+        self.keys = sorted(new)
+        self._redraw()
+
+    def set_filter(self, text):
+        """Chỉ hiện những tên bắt đầu bằng text (không phân biệt hoa/dấu)."""
+        prefix = fold(text.strip())
+        if prefix == self.prefix:
+            return
+        lo, hi = self._range()
+        self.prefix = prefix
+        new_lo, new_hi = self._range()
+        if new_hi <= lo or new_lo >= hi:
+            self._redraw(new_lo, new_hi)
+            return
+        # hai dải giao nhau: cắt/thêm ở hai đầu
+        if hi > new_hi:
+            self.listbox.delete(new_hi - lo, "end")
+        if new_lo > lo:
+            self.listbox.delete(0, new_lo - lo - 1)
+        if new_lo < lo:
+            self.listbox.insert(0, *[k[1] for k in self.keys[new_lo:lo]])
+        if new_hi > hi:
+            self.listbox.insert("end", *[k[1] for k in self.keys[hi:new_hi]])
+
+    def _redraw(self, lo=None, hi=None):
+        if lo is None:
+            lo, hi = self._range()
+        self.listbox.delete(0, "end")
+        if hi > lo:
+            self.listbox.insert("end", *[k[1] for k in self.keys[lo:hi]])
@@ -0,0 +1,352 @@
+# user_store.py
+"""
+Lưu trữ tài khoản người dùng cho server.
+
+- "json"    (mặc định): users.json như trước, tương thích load_users/save_users.
+- "journal": file nhật ký append-only (JSON Lines), mỗi lần ghi chỉ nối thêm.
+- "sqlite":  SQLite ở chế độ WAL.
+
+Mọi backend dùng group commit: các lượt đăng ký đến gần nhau được gom
+thành một lần ghi + fsync bởi một thread committer riêng. Người gọi save()
+chờ tới khi bản ghi đã bền vững trên đĩa nhưng không giữ self.lock của
+server, nên login/broadcast không phải chờ ổ đĩa.
+
+Journal và SQLite tự migrate một lần từ users.json nếu file đó tồn tại;
+SQLite cũng migrate được từ journal (chế độ nhiều node).
+
+save() ghi đè (dùng khi băm lại mật khẩu); create() chỉ thêm tài khoản mới
+và ném UserExists nếu tên đã có, kể cả khi tiến trình khác vừa ghi nó.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+USERS_FILE = Path("users.json")
+
+# Tài khoản mẫu được sử dụng lần đầu
+DEFAULT_USERS = {"admin": "admin123", "user1": "pass1", "user2": "pass2"}
+
+BACKENDS = ("json", "journal", "sqlite")
+
+
+class UserExists(Exception):
+    """create(): tên đăng nhập đã có trong store."""
+
+
+def _write_atomic(path, text):
+    """Ghi file mới rồi os.replace: không bao giờ để lại file ghi dở."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_users(path=USERS_FILE):
+    path = Path(path)
+    if path.exists():
+        return json.loads(path.read_text(encoding="utf-8"))
+    users = dict(DEFAULT_USERS)
+    save_users(users, path)
+    return users
+
+
+def save_users(users, path=USERS_FILE):
+    _write_atomic(path, json.dumps(users, ensure_ascii=False, indent=2))
+
+
+def _read_journal(path):
+    """Đọc journal: trả về (users, số byte hợp lệ), bỏ dòng cuối ghi dở."""
+    users = {}
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # dòng cuối ghi dở khi crash: bỏ qua
+            valid_bytes += len(line)
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            users[rec["u"]] = rec["p"]
+    return users, valid_bytes
+
+
+class _Waiter:
+    __slots__ = ("event", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error = None
+
+
+class GroupCommitStore:
+    """
+    Nền chung: hàng đợi bản ghi + thread committer ghi theo lô.
+    Lớp con cài đặt load(), get(username) và _write_batch(records, created):
+    created là tập chỉ số các bản ghi chỉ được thêm mới, hàm trả về tập chỉ
+    số bị từ chối vì tên đã tồn tại.
+    """
+
+    def __init__(self, max_batch=1024, metrics=None):
+        self.max_batch = max_batch
+        self.metrics = metrics
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._commit_loop, daemon=True)
+        self._thread.start()
+
+    def load(self):
+        raise NotImplementedError
+
+    def get(self, username):
+        """
+        Đọc lại secret của một tài khoản từ đĩa (None nếu không có), kể cả
+        bản ghi do tiến trình khác dùng chung store vừa ghi.
+        """
+        raise NotImplementedError
+
+    def _write_batch(self, records, created=frozenset()):
+        raise NotImplementedError
+
+    def save(self, username, secret):
+        """Ghi (username, secret) và chờ tới khi đã bền vững trên đĩa."""
+        self._submit(username, secret, False)
+
+    def create(self, username, secret):
+        """Như save() nhưng không ghi đè: ném UserExists nếu tên đã có."""
+        self._submit(username, secret, True)
+
+    def _submit(self, username, secret, create):
+        waiter = _Waiter()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("User store đã đóng")
+            self._pending.append(((username, secret), create, waiter))
+            self._cond.notify()
+        waiter.event.wait()
+        if waiter.error is not None:
+            raise waiter.error
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _commit_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+
+            t0 = time.perf_counter()
+            error = None
+            rejected = ()
+            created = {i for i, (_, create, _) in enumerate(batch) if create}
+            try:
+                rejected = self._write_batch(
+                    [record for record, _, _ in batch], created
+                )
+            except Exception as e:
+                error = e
+                print(f"[USERS] Lỗi ghi {len(batch)} tài khoản: {e}")
+            if self.metrics is not None:
+                self.metrics.observe("users.commit_batch", len(batch))
+                self.metrics.observe("users.commit_s", time.perf_counter() - t0)
+            for i, (record, _, waiter) in enumerate(batch):
+                if error is None and i in rejected:
+                    waiter.error = UserExists(record[0])
+                else:
+                    waiter.error = error
+                waiter.event.set()
+
+
+class JsonUserStore(GroupCommitStore):
+    """users.json: mỗi lô ghi lại toàn bộ file (ghi nguyên tử)."""
+
+    def __init__(self, path=USERS_FILE, **kwargs):
+        self.path = Path(path)
+        self._users = {}
+        super().__init__(**kwargs)
+
+    def load(self):
+        self._users = load_users(self.path)
+        return dict(self._users)
+
+    def get(self, username):
+        if not self.path.exists():
+            return None
+        return json.loads(self.path.read_text(encoding="utf-8")).get(username)
+
+    def _write_batch(self, records, created=frozenset()):
+        rejected = set()
+        for i, (username, secret) in enumerate(records):
+            if i in created and username in self._users:
+                rejected.add(i)
+            else:
+                self._users[username] = secret
+        save_users(self._users, self.path)
+        return rejected
+
+
+class JournalUserStore(GroupCommitStore):
+    """Nhật ký append-only: mỗi dòng {"u": username, "p": secret}."""
+
+    def __init__(self, path="users.journal", legacy_path=USERS_FILE, **kwargs):
+        self.path = Path(path)
+        self.legacy_path = Path(legacy_path)
+        self._file = None
+        self._names = set()   # tên đã có trong journal, cho create()
+        super().__init__(**kwargs)
+
+    def load(self):
+        if not self.path.exists():
+            self._migrate()
+        users, valid_bytes = _read_journal(self.path)
+        if valid_bytes != self.path.stat().st_size:
+            os.truncate(self.path, valid_bytes)
+        self._file = open(self.path, "ab")
+        self._names = set(users)
+        return users
+
+    def get(self, username):
+        # đọc lại cả file: chỉ dùng khi một node; nhiều node đổi sang sqlite
+        secret = None
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    rec = json.loads(line)
+                    if rec["u"] == username:
+                        secret = rec["p"]
+        return secret
+
+    def _migrate(self):
+        if self.legacy_path.exists():
+            users = load_users(self.legacy_path)
+            print(f"[USERS] Migrate {len(users)} tài khoản từ {self.legacy_path}")
+        else:
+            users = dict(DEFAULT_USERS)
+        _write_atomic(self.path, "".join(self._encode(u, p) for u, p in users.items()))
+
+    @staticmethod
+    def _encode(username, secret):
+        return json.dumps({"u": username, "p": secret}, ensure_ascii=False) + "\n"
+
+    def _write_batch(self, records, created=frozenset()):
+        rejected = set()
+        lines = []
+        for i, (username, secret) in enumerate(records):
+            if i in created and username in self._names:
+                rejected.add(i)
+                continue
+            self._names.add(username)
+            lines.append(self._encode(username, secret))
+        self._file.write("".join(lines).encode("utf-8"))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return rejected
+
+    def close(self):
+        super().close()
+        if self._file is not None:
+            self._file.close()
+
+
+class SqliteUserStore(GroupCommitStore):
+    """
+    SQLite chế độ WAL, mỗi lô là một transaction. File mới được migrate từ
+    legacy_journal nếu có, không thì từ users.json (legacy_path).
+    """
+
+    def __init__(
+        self, path="users.db", legacy_path=USERS_FILE, legacy_journal=None, **kwargs
+    ):
+        self.path = Path(path)
+        self.legacy_path = Path(legacy_path)
+        self.legacy_journal = Path(legacy_journal) if legacy_journal else None
+        self._db = None
+        super().__init__(**kwargs)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=FULL")
+        return db
+
+    def load(self):
+        fresh = not self.path.exists()
+        self._db = self._connect()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS users ("
+            " username TEXT PRIMARY KEY, secret TEXT NOT NULL)"
+        )
+        if fresh:
+            if self.legacy_journal is not None and self.legacy_journal.exists():
+                users, _ = _read_journal(self.legacy_journal)
+                print(f"[USERS] Migrate {len(users)} tài khoản từ {self.legacy_journal}")
+            elif self.legacy_path.exists():
+                users = load_users(self.legacy_path)
+                print(f"[USERS] Migrate {len(users)} tài khoản từ {self.legacy_path}")
+            else:
+                users = dict(DEFAULT_USERS)
+            self._write_batch(list(users.items()))
+        return dict(self._db.execute("SELECT username, secret FROM users"))
+
+    def get(self, username):
+        # kết nối riêng: self._db thuộc thread committer
+        db = sqlite3.connect(self.path)
+        try:
+            row = db.execute(
+                "SELECT secret FROM users WHERE username = ?", (username,)
+            ).fetchone()
+        finally:
+            db.close()
+        return row[0] if row else None
+
+    def _write_batch(self, records, created=frozenset()):
+        # chỉ thread committer ghi sau khi load() xong
+        rejected = set()
+        with self._db:
+            # tài khoản mới: INSERT thường, PRIMARY KEY chặn trùng tên kể cả
+            # khi node khác vừa ghi cùng tên vào file dùng chung
+            for i in sorted(created):
+                try:
+                    self._db.execute(
+                        "INSERT INTO users (username, secret) VALUES (?, ?)",
+                        records[i],
+                    )
+                except sqlite3.IntegrityError:
+                    rejected.add(i)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO users (username, secret) VALUES (?, ?)",
+                [r for i, r in enumerate(records) if i not in created],
+            )
+        return rejected
+
+    def close(self):
+        super().close()
+        if self._db is not None:
+            self._db.close()
+
+
+def open_user_store(backend="json", path=None, metrics=None):
+    """Tạo user store theo tên backend; path=None dùng tên file mặc định."""
+    if backend == "json":
+        return JsonUserStore(path or USERS_FILE, metrics=metrics)
+    if backend == "journal":
+        return JournalUserStore(path or "users.journal", metrics=metrics)
+    if backend == "sqlite":
+        return SqliteUserStore(path or "users.db", metrics=metrics)
+    raise ValueError(f"Backend user store không hợp lệ: {backend}")
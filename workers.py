@@ -0,0 +1,244 @@
+# workers.py
+"""
+Chạy server với nhiều tiến trình worker (chat_server.py --workers N).
+
+Một tiến trình Python chỉ dùng được một lõi CPU cho code Python (GIL), nên
+để dùng nhiều lõi, supervisor chạy N worker, mỗi worker là một ChatServer
+đầy đủ (engine thread hoặc asyncio) cùng lắng nghe một cổng với
+SO_REUSEPORT: kernel chia kết nối mới cho các worker.
+
+Supervisor giữ hub của bus (xem bus.py): hub gán id cho mọi tin chat/dm,
+ghi message log (một nơi ghi duy nhất) rồi phát tin cho mọi worker, giữ
+hộp thư DM cho người offline, và giữ chỗ tên đăng nhập/đăng ký để kiểm tra
+trùng vẫn đúng giữa các worker. Mỗi
+worker tự giữ ring buffer history và chỉ mục tìm kiếm của riêng nó (dựng
+từ log của hub lúc khởi động, sau đó cập nhật từ tin trên bus).
+
+Tài khoản dùng chung qua user store sqlite (WAL, an toàn khi nhiều tiến
+trình cùng ghi); users.json ghi lại cả file nên không dùng được ở chế độ
+này và được đổi sang sqlite (tự chuyển dữ liệu từ users.json).
+
+Worker chết bất thường được chạy lại; Ctrl+C tắt mọi worker rồi tới hub.
+
+Hub trong supervisor nghe trên Unix socket trong thư mục tạm riêng và tự
+sinh shared secret ngẫu nhiên, chỉ truyền cho các worker của nó.
+
+Cụm nhiều máy: hub chạy riêng (python bus.py --listen 0.0.0.0:5556), mỗi
+máy chạy chat_server.py --bus HUB:5556 (kèm --workers N nếu muốn), các
+worker nối thẳng tới hub đó. Hub và mọi node dùng cùng shared secret
+(UDCHAT_BUS_SECRET hoặc file secret) và cùng user store (sqlite trên ổ dùng
+chung): bus chỉ báo tên tài khoản mới, node đọc hash từ store. run_loopback chạy cả cụm trong một tiến trình
+(LoopbackBus) để thử trên một máy.
+"""
+import multiprocessing
+import os
+import secrets
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from bus import BusClient, BusHub, LoopbackBus
+from dm_mailbox import Mailbox
+from message_log import MessageLog
+from metrics import Metrics
+from user_store import USERS_FILE, SqliteUserStore
+
+RESTART_GRACE = 5.0  # worker chết trong chừng này giây sau khi chạy: không chạy lại
+STOP_TIMEOUT = 5.0
+
+
+def _open_message_log(options):
+    log_dir = options.pop("message_log_dir", None)
+    if not log_dir:
+        return None
+    return MessageLog(
+        log_dir,
+        segment_bytes=options["segment_bytes"],
+        retain_bytes=options["retain_bytes"],
+        retain_seconds=options["retain_hours"] * 3600,
+    )
+
+
+def _open_mailbox(options, metrics):
+    path = options.pop("mailbox_path", None)
+    if not path:
+        return None
+    return Mailbox(
+        path,
+        max_messages=options["mailbox_size"],
+        max_age=options["mailbox_days"] * 86400,
+        metrics=metrics,
+    )
+
+
+def _shared_user_store(options):
+    """
+    Đổi users.json/journal sang sqlite để nhiều node cùng ghi được (journal
+    chỉ tra được bằng cách đọc lại cả file); migrate một lần.
+    """
+    options = dict(options)
+    backend = options.get("user_store", "json")
+    path = options.get("user_store_path")
+    legacy = {}
+    if backend == "json":
+        legacy["legacy_path"] = path or USERS_FILE
+    elif backend == "journal":
+        legacy["legacy_journal"] = path or "users.journal"
+    if legacy:
+        source = next(iter(legacy.values()))
+        print(f"[SERVER] Nhiều node: dùng user store sqlite thay cho {source}")
+        options["user_store"] = "sqlite"
+        # file .db cạnh file cũ: đường dẫn dùng chung vẫn dùng chung
+        if path:
+            options["user_store_path"] = str(Path(path).with_suffix(".db"))
+    # chuyển dữ liệu cũ (nếu có) một lần ở đây, trước khi các node cùng mở
+    store = SqliteUserStore(options.get("user_store_path") or "users.db", **legacy)
+    store.load()
+    store.close()
+    return options
+
+
+def run_worker(
+    engine, host, port, options, bus_address, index=0, reuse_port=True, secret=None
+):
+    """Điểm vào của một node: tiến trình worker, hoặc node đơn với --bus."""
+    from chat_server import build_server
+
+    bus = BusClient(bus_address, secret=secret)
+    bus.connect()
+    # mất hub thì không còn gán id tin được: tắt node như Ctrl+C
+    bus.on_close = lambda: os.kill(os.getpid(), signal.SIGINT)
+
+    print(f"[WORKER {index}] pid {os.getpid()}, node {bus.worker_id}")
+    server = build_server(
+        engine, host, port, reuse_port=reuse_port, bus=bus, **options
+    )
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        # Ctrl+C ở terminal tới cả supervisor lẫn worker: bỏ qua tín hiệu
+        # lặp lại để shutdown chạy hết
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        print(f"\n[WORKER {index}] Đang tắt...")
+        server.shutdown()
+
+
+def run_supervisor(engine, host, port, workers, options, bus_address=None, secret=None):
+    """
+    Chạy workers tiến trình worker, giữ chúng chạy tới khi Ctrl+C.
+    Hub chạy trong supervisor, trừ khi bus_address trỏ tới hub của cụm.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("[SERVER] Hệ điều hành không hỗ trợ SO_REUSEPORT, không chạy được --workers")
+
+    options = _shared_user_store(options)
+
+    hub = message_log = mailbox = bus_dir = None
+    if bus_address is None:
+        metrics = Metrics()
+        message_log = _open_message_log(options)
+        mailbox = _open_mailbox(options, metrics)
+        bus_dir = tempfile.mkdtemp(prefix="udchat-bus-")
+        secret = secrets.token_hex(32)
+        hub = BusHub(
+            os.path.join(bus_dir, "bus.sock"), message_log, metrics, mailbox, secret
+        )
+        hub.start()
+        bus_address = hub.path
+    else:
+        # log tin nhắn và hộp thư nằm ở hub của cụm
+        options.pop("message_log_dir", None)
+        options.pop("mailbox_path", None)
+
+    ctx = multiprocessing.get_context("spawn")
+
+    def spawn(index):
+        proc = ctx.Process(
+            target=run_worker,
+            args=(engine, host, port, options, bus_address, index, True, secret),
+            name=f"chat-worker-{index}",
+        )
+        proc.start()
+        return proc, time.monotonic()
+
+    procs = [spawn(i) for i in range(workers)]
+    print(f"[SERVER] {workers} worker trên {host}:{port} ({engine})")
+    try:
+        while procs:
+            time.sleep(1.0)
+            for i, (proc, started) in enumerate(procs):
+                if proc is None or proc.is_alive():
+                    continue
+                if time.monotonic() - started < RESTART_GRACE:
+                    print(f"[SERVER] Worker {i} thoát ngay khi chạy (mã {proc.exitcode}), không chạy lại")
+                    procs[i] = (None, started)
+                else:
+                    print(f"[SERVER] Worker {i} đã dừng (mã {proc.exitcode}), chạy lại")
+                    procs[i] = spawn(i)
+            if all(proc is None for proc, _ in procs):
+                print("[SERVER] Không còn worker nào chạy")
+                break
+    except KeyboardInterrupt:
+        print("\n[SERVER] Nhận Ctrl+C, đang tắt các worker...")
+    finally:
+        alive = [proc for proc, _ in procs if proc is not None and proc.is_alive()]
+        for proc in alive:
+            try:
+                os.kill(proc.pid, signal.SIGINT)
+            except OSError:
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for proc in alive:
+            proc.join(max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        if hub is not None:
+            hub.close()
+            shutil.rmtree(bus_dir, ignore_errors=True)
+            print(f"[STATS] {hub.metrics.snapshot()}")
+        if message_log is not None:
+            message_log.close()
+        if mailbox is not None:
+            mailbox.close()
+        print("[SERVER] Đã tắt xong.")
+
+
+def run_loopback(engine, host, port, nodes, options):
+    """
+    Chạy thử cụm nodes node trong một tiến trình: hub + LoopbackBus, node i
+    lắng nghe cổng port + i. Dùng để kiểm tra hành vi cụm trên một máy.
+    """
+    from chat_server import build_server
+
+    options = _shared_user_store(options)
+    metrics = Metrics()
+    message_log = _open_message_log(options)
+    mailbox = _open_mailbox(options, metrics)
+    hub = BusHub(message_log=message_log, metrics=metrics, mailbox=mailbox)
+    servers = []
+    for i in range(nodes):
+        bus = LoopbackBus(hub)
+        bus.connect()
+        server = build_server(engine, host, port + i, bus=bus, **options)
+        threading.Thread(target=server.start, daemon=True).start()
+        servers.append(server)
+    print(f"[SERVER] Cụm loopback {nodes} node trên {host}:{port}-{port + nodes - 1}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        print("\n[SERVER] Nhận Ctrl+C, đang tắt các node...")
+    finally:
+        for server in servers:
+            server.shutdown()
+        hub.close()
+        if message_log is not None:
+            message_log.close()
+        if mailbox is not None:
+            mailbox.close()
+        print(f"[STATS] {hub.metrics.snapshot()}")
+        print("[SERVER] Đã tắt xong.")